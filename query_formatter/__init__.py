@@ -8,4 +8,10 @@ INIT QUERY FORMATTER
 """
 __author__ = 'kokarev.nv'
 
-from .query_formatter import cast_to_type, SqlEscaper, QueryFormatter
+from .query_formatter import (
+    cast_to_type, SqlEscaper, ParamEscaper, Template, ResultCache, RenderStats, FieldError, RenderSession,
+    QueryFormatter, ParallelQueryFormatter
+)
+from .template_registry import TemplateRegistry
+from .copy_format import CopyEncoder, CopyStream, decode_copy
+from .template_cache import load_templates, precompile_templates
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+""" Query formatter tools: python -m query_formatter --help
+"""
+__author__ = 'kokarev.nv'
+
+import argparse
+import importlib
+import sys
+
+from . import SqlEscaper, QueryFormatter, TemplateRegistry
+from .template_cache import precompile_templates
+
+
+def import_formatter(spec):
+    """ Import the configured formatter by the spec "module:attribute".
+
+    Args:
+        spec (str): the module and the attribute of the formatter
+
+    Raises:
+        ValueError: returned the exception when the spec is malformed
+
+    Returns:
+        QueryFormatter: the formatter
+    """
+    module_name, _, attr = spec.partition(':')
+    if not module_name or not attr:
+        raise ValueError(f'Formatter "{spec}" must be specified as "module:attribute"')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def main(argv=None):
+    """ Run the command of the query formatter tools.
+
+    Args:
+        argv (list): command line arguments
+
+    Returns:
+        int: exit code
+    """
+    parser = argparse.ArgumentParser(prog='python -m query_formatter', description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+    precompile = commands.add_parser('precompile', help='compile the templates of the directory to the cache file')
+    precompile.add_argument('directory', help='directory of the templates')
+    precompile.add_argument('path', help='path of the cache file')
+    precompile.add_argument('--suffix', default='.sql', help='suffix of the template files')
+    precompile.add_argument('--encoding', default='utf-8', help='encoding of the template files')
+    precompile.add_argument('--minify', action='store_true', help='minify the templates')
+    precompile.add_argument(
+        '--formatter', help='the configured formatter as "module:attribute", the directives of it are compiled'
+    )
+    args = parser.parse_args(argv)
+
+    formatter = QueryFormatter(SqlEscaper()) if args.formatter is None else import_formatter(args.formatter)
+    if args.minify:
+        formatter.minify = True
+    registry = TemplateRegistry(args.directory, suffix=args.suffix, encoding=args.encoding)
+    count = precompile_templates(formatter, args.path, registry)
+    print(f'{count} templates of {len(registry)} are compiled to {args.path}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+""" QUERY FORMATTER BENCHMARKS
+"""
+__author__ = 'kokarev.nv'
+
+from .runner import Case, measure, measure_case, run_benchmarks, save_results, load_results, compare_results
+from .cases import CASES
+from .comparisons import comparisons_main
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+""" Run the benchmarks: python -m query_formatter.benchmarks --help
+"""
+__author__ = 'kokarev.nv'
+
+import argparse
+import sys
+
+from . import CASES, comparisons_main, run_benchmarks, save_results, load_results, compare_results
+
+
+def benchmark_main(argv=None):
+    """ Run the benchmarks, save the results and compare them with the baseline.
+
+    Args:
+        argv (list): command line arguments
+
+    Returns:
+        int: exit code, 1 if the regressions are found
+    """
+    parser = argparse.ArgumentParser(prog='python -m query_formatter.benchmarks', description=__doc__)
+    parser.add_argument('-k', dest='pattern', help='shell-style pattern of the case names, as "directive.*"')
+    parser.add_argument('--quick', action='store_true', help='skip the large inputs and measure shorter')
+    parser.add_argument('--json', dest='json_path', help='save the results to the JSON file')
+    parser.add_argument('--compare', dest='baseline_path', help='compare the results with the saved JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative growth flagged as the regression')
+    parser.add_argument('--list', action='store_true', help='print the names of the cases')
+    parser.add_argument('--comparisons', action='store_true', help='run the comparisons with the previous ways')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for case in CASES:
+            print(f'{case.name}{" (heavy)" if case.heavy else ""}')
+        return 0
+    if args.comparisons:
+        comparisons_main()
+        return 0
+
+    print(f'{"case":<28}{"time, us":>14}{"ops/s":>14}{"peak, KB":>12}')
+    results = run_benchmarks(
+        CASES, args.pattern, args.quick,
+        echo=lambda name, metrics: print(
+            f'{name:<28}{metrics["time_us"]:>14.3f}{metrics["ops_per_sec"]:>14.1f}{metrics["peak_kb"]:>12.1f}'
+        )
+    )
+    if args.json_path:
+        save_results(results, args.json_path)
+
+    if not args.baseline_path:
+        return 0
+
+    comparisons = compare_results(results, load_results(args.baseline_path), args.threshold)
+    print(f'\n{"case":<28}{"metric":<10}{"baseline":>14}{"current":>14}{"ratio":>8}')
+    for comparison in comparisons:
+        print(
+            f'{comparison.name:<28}{comparison.metric:<10}{comparison.baseline:>14.3f}{comparison.current:>14.3f}'
+            f'{comparison.ratio:>8.2f}{"  REGRESSION" if comparison.regression else ""}'
+        )
+    regressions = sum(comparison.regression for comparison in comparisons)
+    print(f'\n{regressions} regressions of {len(comparisons)} compared metrics')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(benchmark_main())
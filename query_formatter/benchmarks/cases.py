@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+""" BENCHMARK CASES: DIRECTIVES, NESTING DEPTH, INPUT SIZE AND WIDTH OF VARIABLES
+"""
+__author__ = 'kokarev.nv'
+
+from datetime import date, datetime
+from uuid import UUID
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .. import cast_to_type, SqlEscaper, QueryFormatter, CopyEncoder
+from .comparisons import FIELD_CASES
+from .runner import Case
+
+QF = QueryFormatter(SqlEscaper())
+
+# the query of the cases of directives
+BASE_QUERY = 'SELECT * FROM Contractor WHERE TRUE'
+
+# the name, the template of the field and the value of every directive
+DIRECTIVE_CASES = (
+    ('default', ' AND "Name" = \'{value}\'', "o'k"),
+    ('if', '{value:if: AND "Id" = {value}}', 5),
+    ('!if', '{value:!if: AND "Id" IS NULL}', 0),
+    ('in', '{value:in:1,2,3,4,5: AND "Kind" = \'{value}\'}', '3'),
+    ('!in', '{value:!in:1,2,3,4,5: AND "Kind" = \'{value}\'}', '7'),
+    ('exists', '{value:exists:3: AND "Id" IN ({value})}', [1, 2, 3]),
+    ('!exists', '{value:!exists:7: AND "Id" IN ({value})}', [1, 2, 3]),
+    ('eq', '{value:eq:5: AND "Id" = {value}}', 5),
+    ('!eq', '{value:!eq:5: AND "Id" = {value}}', 7),
+    ('gt', '{value:gt:3: AND "Id" > {value}}', 5),
+    ('lt', '{value:lt:3: AND "Id" < {value}}', 1),
+    ('repeat', ' AND "Id" IN ({value:repeat:, :{item}})', list(range(10))),
+    ('include', '{value:include}', [' AND "Id" = {id}{flag:if: AND "Flag"}', {'id': 1, 'flag': True}]),
+    ('tmpl', ' AND {value:tmpl}', '"Id" = 1'),
+    ('idf', ' AND {value:idf} IS NOT NULL', 'PersonId'),
+    ('cond', ' AND {value:cond:"Id"}', [1, 2, 3]),
+    ('copy', '; {value:copy:Contractor}', ['Id', 'Name'])
+)
+
+# the values of the escaped types
+ESCAPE_CASES = (
+    ('none', None),
+    ('int', 123456),
+    ('bool', True),
+    ('str', "o'k"),
+    ('date', date(2020, 1, 1)),
+    ('datetime', datetime(2020, 1, 1, 12, 30)),
+    ('uuid', UUID(int=1)),
+    ('list', list(range(100)))
+)
+
+# the operands of the casted types
+CAST_CASES = (
+    ('none', 'None', 'NoneType'),
+    ('int', '123456', 'int'),
+    ('bool', 'True', 'bool'),
+    ('str', "o'k", 'str'),
+    ('date', '2020-01-01', 'date'),
+    ('datetime', '2020-01-01 12:30:00', 'datetime'),
+    ('time', '12:30:00', 'time')
+)
+
+# sizes of the inputs, the cases of the sizes from this one are heavy
+IN_LIST_SIZES = (10, 1000, 100000, 1000000)
+# depths of the conditions nested in the repeated item of the included template
+NESTED_DEPTHS = (1, 5, 9)
+NESTED_ROWS = 1000
+WIDTHS = (10, 100, 1000, 10000)
+HEAVY_SIZE = 100000
+
+
+def format_case(format_string, **kwargs):
+    """ Build the call formatting the template.
+
+    Args:
+        format_string (str): template text
+        kwargs (dict): named variables
+
+    Returns:
+        callable: measured call
+    """
+    return lambda: QF.format(format_string, **kwargs)
+
+
+def size_name(size):
+    """ Get the short name of the size, as 1k or 1M.
+
+    Args:
+        size (int): the size
+
+    Returns:
+        str: the name
+    """
+    for unit, suffix in ((1000000, 'M'), (1000, 'k')):
+        if size >= unit and not size % unit:
+            return f'{size // unit}{suffix}'
+    return str(size)
+
+
+def build_cases():
+    """ Build all benchmark cases.
+
+    Returns:
+        list: benchmark cases
+    """
+    cases = []
+    for name, field, value in DIRECTIVE_CASES:
+        cases.append(Case(
+            f'directive.{name}', False,
+            lambda field=field, value=value: format_case(BASE_QUERY + field, value=value)
+        ))
+
+    for name, value, spec in FIELD_CASES:
+        cases.append(Case(
+            f'format_field.{name}', False,
+            lambda value=value, spec=spec: lambda: QF.format_field(value, spec, {})
+        ))
+
+    for name, value in ESCAPE_CASES:
+        cases.append(Case(
+            f'escape_literal.{name}', False, lambda value=value: lambda: SqlEscaper.escape_literal(value)
+        ))
+
+    for name, operand, to_type in CAST_CASES:
+        cases.append(Case(
+            f'cast_to_type.{name}', False,
+            lambda operand=operand, to_type=to_type: lambda: cast_to_type(operand, to_type)
+        ))
+
+    # nested conditions up to the recursion limit
+    for depth in range(1, 11):
+        cases.append(Case(
+            f'depth.{depth}', False,
+            lambda depth=depth: format_case(
+                BASE_QUERY + '{flag:if:' * depth + ' AND "Id" = {id}' + '}' * depth, flag=True, id=1
+            )
+        ))
+
+    for size in IN_LIST_SIZES:
+        heavy = size >= HEAVY_SIZE
+        cases.append(Case(
+            f'in_list.int.{size_name(size)}', heavy,
+            lambda size=size: format_case(BASE_QUERY + ' AND "Id" IN ({ids})', ids=list(range(size)))
+        ))
+        cases.append(Case(
+            f'in_list.str.{size_name(size)}', heavy,
+            lambda size=size: format_case(
+                BASE_QUERY + ' AND "Name" IN ({names})', names=[f"name'{i}" for i in range(size)]
+            )
+        ))
+        if numpy is not None:
+            cases.append(Case(
+                f'in_list.ndarray.{size_name(size)}', heavy,
+                lambda size=size: format_case(BASE_QUERY + ' AND "Id" IN ({ids})', ids=numpy.arange(size))
+            ))
+        cases.append(Case(
+            f'in_options.{size_name(size)}', heavy,
+            lambda size=size: format_case(
+                BASE_QUERY + '{ids:in:' + ','.join(map(str, range(size))) + ': AND "Id" IN ({ids})}',
+                ids=[size - 1, size + 1]
+            )
+        ))
+        cases.append(Case(
+            f'repeat.{size_name(size)}', heavy,
+            lambda size=size: format_case(
+                'INSERT INTO Contractor VALUES {rows:repeat:, :({item[0]}, \'{item[1]}\'{flag:if:, TRUE})}',
+                rows=[(i, f'name{i}') for i in range(size)], flag=True
+            )
+        ))
+        cases.append(Case(
+            f'copy_rows.{size_name(size)}', heavy,
+            lambda size=size: lambda rows=[(i, f"name'{i}", None) for i in range(size)]: list(
+                CopyEncoder.iter_encode(rows)
+            )
+        ))
+
+    # conditions inside the repeat inside the include
+    for depth in NESTED_DEPTHS:
+        item = '({item[0]}' + '{flag:if:' * depth + ', \'{item[1]}\'' + '}' * depth + ')'
+        cases.append(Case(
+            f'nested.include_repeat_if.{depth}', False,
+            lambda item=item: format_case(
+                '{insert:include}',
+                insert=['INSERT INTO Contractor VALUES {rows:repeat:, :' + item + '}', {'flag': True}],
+                rows=[(i, f'name{i}') for i in range(NESTED_ROWS)]
+            )
+        ))
+
+    for width in WIDTHS:
+        cases.append(Case(
+            f'wide_kwargs.{size_name(width)}', False,
+            lambda width=width: format_case(
+                BASE_QUERY + ' AND "Id" = {var0}{var1:if: AND "Flag"}{var2:gt:0: AND "Kind" = {var2}}',
+                **{f'var{i}': i for i in range(width)}
+            )
+        ))
+
+    return cases
+
+
+CASES = build_cases()
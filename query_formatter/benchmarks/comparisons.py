@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+""" BENCHMARKS OF THE OPTIMIZATIONS: THE PREVIOUS AND THE CURRENT WAY SIDE BY SIDE
+"""
+__author__ = 'kokarev.nv'
+
+import time
+import tracemalloc
+
+from .. import SqlEscaper, ResultCache, QueryFormatter
+from .runner import measure
+
+QF = QueryFormatter(SqlEscaper())
+
+# value and spec of the field for every directive
+FIELD_CASES = (
+    ('default', 444, ''),
+    ('include', 'SELECT 1', 'include'),
+    ('repeat', [1, 2], 'repeat:, :{item}'),
+    ('in', '0', 'in:2,1,0:... AND TRUE ...'),
+    ('!in', 'cotton', '!in:wool,polyester,silk,cotton:... AND FALSE ...'),
+    ('exists', [0, 'wool', 'None'], 'exists:None:... AND TRUE ...'),
+    ('!exists', [0, 'wool', 'None'], '!exists:bobcat:... AND TRUE ...'),
+    ('eq', 0, 'eq:0:... AND TRUE ...'),
+    ('!eq', 'cotton', '!eq:cotton:... AND FALSE ...'),
+    ('gt', 2, 'gt:0:... AND TRUE ...'),
+    ('lt', False, 'lt:True:... AND TRUE ...'),
+    ('if', False, 'if:... AND FALSE ...'),
+    ('!if', 'False', '!if:... AND FALSE ...'),
+    ('tmpl', 'SELECT 1', 'tmpl'),
+    ('idf', 'PersonId', 'idf')
+)
+
+
+def legacy_format_field(formatter, value, spec, kwargs):
+    """ Dispatch of the field by the dict of prefix checks built on every call, as format_field did before
+    the directive registry.
+
+    Args:
+        formatter (QueryFormatter): the formatter
+        value (any type): the value of the variable
+        spec (str): string literals separated by :
+        kwargs (dict): variables of the template
+
+    Returns:
+        tuple: output item
+    """
+    self = formatter
+    if callable(value):
+        value = value()
+
+    format_func = {
+        spec.startswith('include'): lambda: self.format_include_value(value, kwargs),
+        spec.startswith('repeat:'): lambda: self.format_repeat_value(value, spec, kwargs),
+        spec.startswith('in:'): lambda: self.format_in_value(value, spec, is_contained=True),
+        spec.startswith('!in:'): lambda: self.format_in_value(value, spec, is_contained=False),
+        spec.startswith('exists:'): lambda: self.format_exists_value(value, spec),
+        spec.startswith('!exists:'): lambda: self.format_not_exists_value(value, spec),
+        spec.startswith('eq:'): lambda: self.format_eq_value(value, spec),
+        spec.startswith('!eq:'): lambda: self.format_not_eq_value(value, spec),
+        spec.startswith('gt:'): lambda: self.format_gt_value(value, spec),
+        spec.startswith('lt:'): lambda: self.format_lt_value(value, spec),
+        spec.startswith('if:'): lambda: self.format_if_value(value, spec),
+        spec.startswith('!if:'): lambda: self.format_not_if_value(value, spec),
+        spec.startswith('tmpl'): lambda: self.format_tmpl_value(value),
+        spec.startswith('idf'): lambda: self.format_field_name(value)
+    }.get(True)
+
+    if format_func is None:
+        return self.format_default_value(value, spec)
+    return format_func()
+
+
+def bench_format_field(number=20000):
+    """ Measure the cost of one field with the legacy dispatch and with the directive registry.
+
+    Args:
+        number (int): number of calls in one measurement
+
+    Returns:
+        list: tuples of the directive name, the legacy and the registry time in microseconds
+    """
+    kwargs = {}
+    res_list = []
+    for name, value, spec in FIELD_CASES:
+        assert legacy_format_field(QF, value, spec, kwargs) == QF.format_field(value, spec, kwargs)
+        before = measure(lambda: legacy_format_field(QF, value, spec, kwargs), number)
+        after = measure(lambda: QF.format_field(value, spec, kwargs), number)
+        res_list.append((name, before, after))
+    return res_list
+
+
+def bench_escape_literal(size=50000, number=5):
+    """ Measure sqlizing of the large collections.
+
+    Args:
+        size (int): number of items in the collection
+        number (int): number of calls in one measurement
+
+    Returns:
+        list: tuples of the collection name and the time in microseconds
+    """
+    res_list = []
+    for name, value in (
+        ('int', list(range(size))),
+        ('str', [f"name'{i}" for i in range(size)]),
+        ('mixed', [i if i % 2 else str(i) for i in range(size)]),
+        ('nested', [(i, [i, None]) for i in range(size // 2)])
+    ):
+        res_list.append((name, measure(lambda: SqlEscaper.escape_literal(value), number)))
+    return res_list
+
+
+def bench_array(size=100000, number=5):
+    """ Measure the predicate of the large collection rendered as "IN" list and as the array literal.
+
+    Args:
+        size (int): number of items in the collection
+        number (int): number of calls in one measurement
+
+    Returns:
+        list: tuples of the rendering name, the time in microseconds and the length of the predicate
+    """
+    class ArrayEscaper(SqlEscaper):
+        array_threshold = 1000
+
+    value = list(range(size))
+    res_list = []
+    for name, escaper in (('in list', SqlEscaper), ('array', ArrayEscaper)):
+        predicate = escaper.get_collection_condition(value)
+        res_list.append((name, measure(lambda: escaper.get_collection_condition(value), number), len(predicate)))
+    return res_list
+
+
+def bench_result_cache(width=60, number=20000):
+    """ Measure the template formatted again with the same values without and with the result cache.
+
+    Args:
+        width (int): number of unrelated variables
+        number (int): number of calls in one measurement
+
+    Returns:
+        tuple: time without and with the cache in microseconds
+    """
+    tmpl = (
+        'SELECT * FROM {schema:idf}.t WHERE id IN ({ids}){name:if: AND name = \'{name}\'}'
+        '{kind:in:a,b: AND kind = \'{kind}\'}{rows:repeat: UNION ALL :SELECT {item}}'
+    )
+    kwargs = {f'var{i}': i for i in range(width)}
+    kwargs.update(schema='public', ids=list(range(20)), name='name', kind='a', rows=[1, 2, 3])
+    cached_qf = QueryFormatter(SqlEscaper(), result_cache=ResultCache())
+    return (
+        measure(lambda: QF.format(tmpl, **kwargs), number),
+        measure(lambda: cached_qf.format(tmpl, **kwargs), number)
+    )
+
+
+def bench_repeat(size=100000, width=60):
+    """ Measure the time and the peak memory of the large repeat with wide kwargs.
+
+    Args:
+        size (int): number of repeated items
+        width (int): number of template variables
+
+    Returns:
+        tuple: time in milliseconds and peak of the allocated memory in megabytes
+    """
+    tmpl = 'INSERT INTO t (id, name) VALUES {rows:repeat:, :({item[0]}, \'{item[1]}\'{flag:if:, TRUE})}'
+    kwargs = {f'var{i}': i for i in range(width)}
+    kwargs.update(rows=[(i, f'name{i}') for i in range(size)], flag=1)
+    QF.format(tmpl, **kwargs)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    QF.format(tmpl, **kwargs)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 2 ** 20
+
+
+def bench_values(size=100000, max_rows=1000):
+    """ Measure the bulk insert formatted by "repeat" and by "format_values".
+
+    Args:
+        size (int): number of rows
+        max_rows (int): maximum number of rows in one statement of "format_values"
+
+    Returns:
+        tuple: time of "repeat" and of "format_values" in milliseconds
+    """
+    rows = [(i, f"name'{i}", i % 3 == 0) for i in range(size)]
+    tmpl = 'INSERT INTO t (id, name, flag) VALUES {rows:repeat:, :({item[0]}, \'{item[1]}\', {item[2]})}'
+    started = time.perf_counter()
+    QF.format(tmpl, rows=rows)
+    repeat_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in QF.format_values('INSERT INTO t ({columns}) VALUES {values}', ('id', 'name', 'flag'), rows, max_rows):
+        pass
+    values_elapsed = time.perf_counter() - started
+    return repeat_elapsed * 1000, values_elapsed * 1000
+
+
+def comparisons_main():
+    """ Run the comparisons and print the results
+    """
+    print(f'{"format_field":<12}{"before, us":>12}{"after, us":>12}')
+    for name, before, after in bench_format_field():
+        print(f'{name:<12}{before:>12.3f}{after:>12.3f}')
+
+    print(f'\n{"escape_literal":<16}{"50k items, ms":>14}')
+    for name, elapsed in bench_escape_literal():
+        print(f'{name:<16}{elapsed / 1000:>14.3f}')
+
+    print(f'\n{"100k ids":<16}{"ms":>10}{"chars":>10}')
+    for name, elapsed, length in bench_array():
+        print(f'{name:<16}{elapsed / 1000:>10.3f}{length:>10}')
+
+    before, after = bench_result_cache()
+    print(f'\nsame values formatted again: {before:.1f} us, with the result cache {after:.1f} us')
+
+    elapsed, peak = bench_repeat()
+    print(f'\nrepeat of 100k items: {elapsed:.1f} ms, peak memory {peak:.1f} MB')
+
+    repeat_elapsed, values_elapsed = bench_values()
+    print(f'\nbulk insert of 100k rows: repeat {repeat_elapsed:.1f} ms, format_values {values_elapsed:.1f} ms')
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+""" BENCHMARK RUNNER: MEASURING, JSON RESULTS AND COMPARISON WITH THE BASELINE
+"""
+__author__ = 'kokarev.nv'
+
+from collections import namedtuple
+from datetime import datetime
+import fnmatch
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+
+# the benchmark case: the name, the flag of the large input and the function building the measured call
+Case = namedtuple('Case', ('name', 'heavy', 'setup'))
+
+# the compared metric of the case
+Comparison = namedtuple('Comparison', ('name', 'metric', 'baseline', 'current', 'ratio', 'regression'))
+
+# compared metrics and their minimal values, smaller values are noise
+COMPARED_METRICS = (('time_us', 0.0), ('peak_kb', 16.0))
+
+
+def measure(func, number, repeat=5):
+    """ Measure the best time of the function call.
+
+    Args:
+        func (callable): measured function without arguments
+        number (int): number of calls in one measurement
+        repeat (int): number of measurements
+
+    Returns:
+        float: time of one call in microseconds
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def measure_case(func, min_time=0.2, repeat=5):
+    """ Measure the throughput and the allocations of the call. The number of calls in one measurement grows until
+    the measurement takes "min_time".
+
+    Args:
+        func (callable): measured function without arguments
+        min_time (float): minimal time of one measurement in seconds
+        repeat (int): number of measurements
+
+    Returns:
+        dict: time of one call in microseconds, calls per second, number of calls in one measurement and the peak
+            of the memory allocated by one call in kilobytes
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+
+    best = min([elapsed] + timer.repeat(repeat=repeat - 1, number=number)) / number
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'time_us': round(best * 1e6, 3),
+        'ops_per_sec': round(1 / best, 1),
+        'number': number,
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+
+def run_benchmarks(cases, pattern=None, quick=False, echo=None):
+    """ Run the benchmark cases.
+
+    Args:
+        cases (iterable): benchmark cases
+        pattern (str): shell-style pattern of the case names, all cases by default
+        quick (bool): skip the cases with the large input and measure shorter
+        echo (callable): called with the name and the metrics of every measured case
+
+    Returns:
+        dict: environment of the run and the metrics of the cases by their names
+    """
+    results = {}
+    for case in cases:
+        if pattern is not None and not fnmatch.fnmatchcase(case.name, pattern):
+            continue
+        if quick and case.heavy:
+            continue
+        metrics = measure_case(case.setup(), min_time=0.02 if quick else 0.2, repeat=3 if quick else 5)
+        results[case.name] = metrics
+        if echo is not None:
+            echo(case.name, metrics)
+
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'quick': quick
+        },
+        'results': results
+    }
+
+
+def save_results(results, path):
+    """ Save the results of the run to the JSON file.
+
+    Args:
+        results (dict): results of the run
+        path (str): path of the file
+    """
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """ Load the results of the run from the JSON file.
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        dict: results of the run
+    """
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare_results(current, baseline, threshold=0.2):
+    """ Compare the metrics of the cases measured in both runs.
+
+    Args:
+        current (dict): results of the current run
+        baseline (dict): results of the baseline run
+        threshold (float): relative growth of the metric flagged as the regression
+
+    Returns:
+        list: comparisons of the metrics
+    """
+    res_list = []
+    baseline_results = baseline['results']
+    for name, metrics in current['results'].items():
+        baseline_metrics = baseline_results.get(name)
+        if baseline_metrics is None:
+            continue
+        for metric, min_value in COMPARED_METRICS:
+            before, after = baseline_metrics.get(metric), metrics.get(metric)
+            if before is None or after is None:
+                continue
+            ratio = after / before if before else float('inf') if after else 1.0
+            regression = ratio > 1 + threshold and max(before, after) > min_value
+            res_list.append(Comparison(name, metric, before, after, ratio, regression))
+    return res_list
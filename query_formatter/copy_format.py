@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+""" COPY FORMAT MODULE: ROWS ENCODED TO THE TEXT FORMAT OF "COPY ... FROM STDIN" AND DECODED BACK
+"""
+__author__ = 'kokarev.nv'
+
+from datetime import date, datetime, time
+import io
+import re
+from uuid import UUID
+
+# escapes of the characters of the text values, other characters are copied as they are
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\b': '\\b',
+    '\f': '\\f',
+    '\v': '\\v'
+})
+
+# escape sequences of the decoded text: the backslashed character, octal and hexadecimal codes
+COPY_ESCAPE_PATTERN = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', re.S)
+COPY_UNESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+
+def escape_copy_text(value):
+    """ Escape the string to the field of the COPY text format.
+
+    Args:
+        value (str): the string
+
+    Raises:
+        ValueError: returned the exception when the string contains the null character
+
+    Returns:
+        str: escaped text
+    """
+    # printable strings without backslashes are the most of the values, they are not translated
+    if value.isprintable() and '\\' not in value:
+        return value
+    if '\x00' in value:
+        raise ValueError(f'String "{value!r}" with the null character unsupported by COPY')
+    return value.translate(COPY_ESCAPES)
+
+
+class CopyEncoder:
+    """ Encode rows to the text format of PostgreSQL "COPY table FROM STDIN": fields are separated by tabs, rows end
+    with newlines and NULL is "\\N". Values of the same whitelisted types as "SqlEscaper.escape_literal" are
+    supported, except collections.
+
+    """
+    # encode functions of the whitelisted types, subclasses are encoded by the function of the nearest base
+    encode_funcs = {
+        type(None): lambda value: '\\N',
+        int: int.__repr__,
+        bool: lambda value: 't' if value else 'f',
+        date: date.isoformat,
+        datetime: str,
+        time: str,
+        UUID: str,
+        str: escape_copy_text
+    }
+
+    # size of the chunks yielded by "iter_encode"
+    chunk_size = 65536
+
+    @classmethod
+    def get_encode_func(cls, value_type):
+        """ Get the encode function of the type.
+
+        Args:
+            value_type (type): type of the value
+
+        Raises:
+            ValueError: returned the exception when the type is not in the whitelist
+
+        Returns:
+            callable: encode function
+        """
+        encode_func = cls.encode_funcs.get(value_type)
+        if encode_func is None:
+            for base_type in value_type.__mro__[1:]:
+                encode_func = cls.encode_funcs.get(base_type)
+                if encode_func is not None:
+                    break
+            else:
+                raise ValueError(f'Type "{value_type.__name__}" unsupported yet')
+        return encode_func
+
+    @classmethod
+    def encode_value(cls, value):
+        """ Encode the value to the field.
+
+        Args:
+            value (any type): the value
+
+        Returns:
+            str: encoded field
+        """
+        return cls.get_encode_func(type(value))(value)
+
+    @classmethod
+    def encode_row(cls, row):
+        """ Encode the row to the line.
+
+        Args:
+            row (sequence): values of the row
+
+        Returns:
+            str: encoded line with the newline
+        """
+        return '\t'.join([cls.encode_value(value) for value in row]) + '\n'
+
+    @classmethod
+    def iter_encode(cls, rows, columns=None):
+        """ Encode the rows lazily, the lines are joined into chunks of "chunk_size" characters.
+
+        Args:
+            rows (iterable): sequences of the column values
+            columns (int): number of the columns, the rows are checked by the first row if it is not passed
+
+        Raises:
+            ValueError: returned the exception when the row doesn't match the columns or has a value of the type
+                not in the whitelist
+
+        Yields:
+            str: chunk of the encoded lines
+        """
+        encode_funcs = cls.encode_funcs
+        get_encode_func = cls.get_encode_func
+        chunk_size = cls.chunk_size
+        chunk = []
+        size = 0
+        for row in rows:
+            if columns is None:
+                columns = len(row)
+            elif len(row) != columns:
+                raise ValueError(f'Row {row!r} has {len(row)} values instead of {columns}')
+
+            line = '\t'.join([
+                (encode_funcs.get(value.__class__) or get_encode_func(type(value)))(value) for value in row
+            ]) + '\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+
+        if chunk:
+            yield ''.join(chunk)
+
+    @classmethod
+    def open(cls, rows, columns=None):
+        """ Get the file-like object reading the encoded rows, as the source of "copy_expert" of the driver.
+
+        Args:
+            rows (iterable): sequences of the column values
+            columns (int): number of the columns
+
+        Returns:
+            CopyStream: readable stream of the encoded rows
+        """
+        return CopyStream(cls.iter_encode(rows, columns))
+
+
+class CopyStream(io.TextIOBase):
+    """ Readable text stream of the encoded chunks, the rows are encoded while the stream is read.
+
+    """
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def fill(self, size=None, stop=None):
+        """ Read the chunks to the buffer until it has "size" unread characters or the stop character.
+
+        Args:
+            size (int): number of unread characters, all chunks are read if it is None
+            stop (str): the stop character
+
+        Returns:
+            str: unread text of the buffer
+        """
+        unread = [self._buffer[self._position:]]
+        length = len(unread[0])
+        while (size is None or length < size) and (stop is None or stop not in unread[-1]):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            unread.append(chunk)
+            length += len(chunk)
+        self._buffer, self._position = ''.join(unread), 0
+        return self._buffer
+
+    def read(self, size=-1):
+        self._checkClosed()
+        if size is None or size < 0:
+            text = self.fill()
+            self._position = len(text)
+            return text
+        if len(self._buffer) - self._position < size:
+            self.fill(size)
+        start = self._position
+        self._position = min(start + size, len(self._buffer))
+        return self._buffer[start:self._position]
+
+    def readline(self, size=-1):
+        self._checkClosed()
+        if size is not None and size < 0:
+            size = None
+        end = self._buffer.find('\n', self._position)
+        if end < 0:
+            self.fill(size, '\n')
+            end = self._buffer.find('\n')
+        end = len(self._buffer) if end < 0 else end + 1
+        start = self._position
+        self._position = end if size is None else min(end, start + size)
+        return self._buffer[start:self._position]
+
+
+def decode_copy_field(field):
+    """ Decode the field of the COPY text format.
+
+    Args:
+        field (str): encoded field
+
+    Returns:
+        str: decoded text or None for NULL
+    """
+    if field == '\\N':
+        return None
+    if '\\' not in field:
+        return field
+    return COPY_ESCAPE_PATTERN.sub(
+        lambda match: (
+            chr(int(match.group(1), 8)) if match.group(1) else
+            chr(int(match.group(2), 16)) if match.group(2) else
+            COPY_UNESCAPES.get(match.group(3), match.group(3))
+        ),
+        field
+    )
+
+
+def decode_copy(chunks):
+    """ Decode the text of the COPY text format to the rows of texts, the lines may be split between the chunks.
+    The end marker "\\." stops decoding.
+
+    Args:
+        chunks (iterable): chunks of the encoded text, as the file object or "CopyEncoder.iter_encode"
+
+    Yields:
+        tuple: decoded texts of the row and None for NULL
+    """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            if line == '\\.':
+                return
+            yield tuple(map(decode_copy_field, line.split('\t')))
+    if rest and rest != '\\.':
+        yield tuple(map(decode_copy_field, rest.split('\t')))
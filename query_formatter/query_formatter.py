@@ -3,179 +3,3343 @@
 """
 __author__ = 'kokarev.nv'
 
-from datetime import datetime
+import asyncio
+from collections import ChainMap, OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time
+from functools import lru_cache
+import hashlib
+import inspect
+from itertools import islice
+from os import cpu_count
+import re
+import reprlib
 import string
+import _string
+import sys
+import threading
+from time import monotonic, perf_counter
+from uuid import UUID
+
+
+def cast_to_bool(value):
+    """ Converts the string "True" or "False" to bool.
+
+    Args:
+        value (str): variables value to the cast
+
+    Raises:
+        ValueError: returned the exception when "value" is not "True" or "False"
+
+    Returns:
+        bool: casted value of a variable
+    """
+    if value == 'True':
+        return True
+    if value == 'False':
+        return False
+    raise ValueError(f'Could not cast "{value}" to type "bool"')
+
+
+# cast functions of the whitelisted types
+CAST_TYPE_FUNCS = {
+    'str': lambda value: value,
+    'int': int,
+    'date': lambda value: datetime.strptime(value, '%Y-%m-%d'),
+    'datetime': lambda value: datetime.strptime(value, '%Y-%m-%d %H:%M:%S'),
+    'time': lambda value: datetime.strptime(value, '%H:%M:%S'),
+    'bool': cast_to_bool,
+    'NoneType': lambda value: None if value == 'None' else value
+}
 
 
 def cast_to_type(value, to_type):
     """ Converts the value to the specified type.
 
-    Args:
-        value (any type): variables value to the cast
-        to_type (str): name of cast operation
+    Args:
+        value (any type): variables value to the cast
+        to_type (str): name of cast operation
+
+    Raises:
+        ValueError: returned the exception when "to_type" is not in the whitelist
+
+    Returns:
+        any type: casted value of a variable
+    """
+    cast_type_func = CAST_TYPE_FUNCS.get(to_type)
+
+    # whitelist validation strategy
+    if cast_type_func is None:
+        raise ValueError(f'Could not cast "{value}" to type "{to_type}"')
+
+    return cast_type_func(value)
+
+
+# operands of the spec are casted once per type
+cast_spec_operand = lru_cache(maxsize=1024)(cast_to_type)
+
+
+def cast_options(options, to_type):
+    """ Converts the options of "in" directive to the specified type.
+
+    Args:
+        options (list): string options
+        to_type (str): name of cast operation
+
+    Returns:
+        frozenset: casted options or None when some option could not be casted
+    """
+    try:
+        return frozenset([cast_to_type(option, to_type) for option in options])
+    except (ValueError, TypeError):
+        return None
+
+
+@lru_cache(maxsize=1024)
+def cast_spec_options(options, to_type):
+    """ Split the options of "in" directive and convert them to the specified type.
+
+    Args:
+        options (str): options separated by commas
+        to_type (str): name of cast operation
+
+    Returns:
+        frozenset: casted options or None when some option could not be casted
+    """
+    return cast_options(options.split(','), to_type)
+
+
+def is_in_options(value, options):
+    """ Check the value is in the options of "in" directive casted to the type of the value.
+
+    Args:
+        value (any type): the value to check
+        options (str): options separated by commas
+
+    Returns:
+        bool: the value is in the options
+    """
+    to_type = type(value).__name__
+    casted_options = cast_spec_options(options, to_type)
+    if casted_options is None:
+        # some option could not be casted, the error is raised unless the value is found before it
+        return value in map(lambda x: cast_to_type(x, to_type), options.split(','))
+    return value in casted_options
+
+
+class SqlEscaper:
+    """ Isolate and sqlize the value before executing.
+
+    """
+    # sqlize functions of the whitelisted types, subclasses are sqlized by the function of the nearest base
+    escape_literal_funcs = {
+        type(None): lambda value: 'NULL',
+        int: int.__repr__,
+        bool: str,
+        date: lambda value: f"'{value}'::date",
+        datetime: lambda value: f"'{value}'::timestamp",
+        time: lambda value: f"'{value}'::time",
+        UUID: lambda value: f"'{value}'::uuid",
+        str: lambda value: str.replace(value, "'", "''")
+    }
+
+    # collections are sqlized as the flat list of the items
+    collection_types = (list, tuple, set)
+
+    # homogeneous collections larger than the threshold are compared by the array literal in "get_collection_condition",
+    # None switches arrays off
+    array_threshold = None
+
+    # array types of the item types: the type name and the function sqlizing the item inside the array literal
+    array_types = {
+        int: ('bigint', int.__repr__),
+        bool: ('boolean', str),
+        date: ('date', str),
+        datetime: ('timestamp', str),
+        time: ('time', str),
+        UUID: ('uuid', str),
+        str: ('text', lambda value: '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"')
+    }
+
+    @classmethod
+    def get_escape_func(cls, value_type):
+        """ Get the sqlize function of the type.
+
+        Args:
+            value_type (type): type of the value
+
+        Returns:
+            callable: sqlize function or None if the type is not in the whitelist or is a collection
+        """
+        escape_literal_func = cls.escape_literal_funcs.get(value_type)
+        if escape_literal_func is None:
+            for base_type in value_type.__mro__[1:]:
+                escape_literal_func = cls.escape_literal_funcs.get(base_type)
+                if escape_literal_func is not None:
+                    break
+        return escape_literal_func
+
+    @classmethod
+    def escape_literal(cls, value):
+        """ Isolate unsupported values by raising an exception. Sqlize the value with specified type.
+
+        Args:
+            value (any type): the value of the variable to sqlize
+
+        Raises:
+            ValueError: returned the exception when "type_name" is not in the whitelist
+
+        Returns:
+            str: sqlized value in the string
+        """
+        escape_literal_func = cls.get_escape_func(type(value))
+        if escape_literal_func is not None:
+            return escape_literal_func(value)
+
+        if isinstance(value, cls.collection_types):
+            return cls.escape_collection(value)
+
+        # numpy is not imported here, its arrays are passed only if the caller has imported it
+        numpy = sys.modules.get('numpy')
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            return cls.escape_ndarray(value, numpy)
+
+        raise ValueError(f'Type "{value}" unsupported yet')
+
+    @classmethod
+    def escape_collection(cls, value):
+        """ Sqlize items of the collection and nested collections separated by commas.
+
+        Args:
+            value (list, tuple or set): the collection to sqlize
+
+        Raises:
+            ValueError: returned the exception when the type of an item is not in the whitelist
+
+        Returns:
+            str: sqlized items in the string
+        """
+        # homogeneous collections are sqlized by one join unless the sqlize function of the items is redefined
+        item_types = set(map(type, value))
+        if len(item_types) == 1:
+            item_type = item_types.pop()
+            if item_type in (int, str) and (
+                cls.escape_literal_funcs.get(item_type) is SqlEscaper.escape_literal_funcs[item_type]
+            ):
+                if item_type is int:
+                    return ', '.join(map(int.__repr__, value))
+                return ', '.join(value).replace("'", "''")
+
+        # nested collections are flattened by the stack of iterators instead of the recursion
+        res_list = []
+        escape_funcs = cls.escape_literal_funcs
+        collection_types = cls.collection_types
+        stack = [iter(value)]
+        while stack:
+            for item in stack[-1]:
+                escape_literal_func = escape_funcs.get(type(item)) or cls.get_escape_func(type(item))
+                if escape_literal_func is not None:
+                    res_list.append(escape_literal_func(item))
+                elif not isinstance(item, collection_types):
+                    raise ValueError(f'Type "{item}" unsupported yet')
+                elif item:
+                    stack.append(iter(item))
+                    break
+                else:
+                    # empty nested collection is sqlized as the empty string
+                    res_list.append('')
+            else:
+                stack.pop()
+
+        return ', '.join(res_list)
+
+    @classmethod
+    def escape_ndarray(cls, value, numpy):
+        """ Sqlize items of the NumPy array as the list of them. 1-D arrays of integers, booleans, strings and dates
+        or datetimes of whole days, seconds, milliseconds and microseconds are converted by the vectorized operations
+        and one join, other arrays and items sqlized by redefined functions are sqlized as the list. Datetimes and
+        timedeltas of nanoseconds and finer units are converted to microseconds first.
+
+        Args:
+            value (numpy.ndarray): the array to sqlize
+            numpy (module): the imported numpy module
+
+        Raises:
+            ValueError: returned the exception when the type of an item is not in the whitelist or the datetimes and
+                timedeltas can't be converted to python ones without losing their precision
+
+        Returns:
+            str: sqlized items in the string
+        """
+        kind = value.dtype.kind
+        if kind in 'Mm':
+            unit = numpy.datetime_data(value.dtype)[0]
+            if unit in ('ns', 'ps', 'fs', 'as'):
+                # the items finer than microseconds are integers in the list, python datetimes hold microseconds
+                converted = value.astype(f'{kind}8[us]')
+                if not ((converted == value) | numpy.isnat(value)).all():
+                    raise ValueError(f'Type "{value.dtype}" unsupported yet, the items are finer than microseconds')
+                value = converted
+            elif kind == 'm' and unit in ('Y', 'M'):
+                # the timedeltas of years and months are integers in the list
+                raise ValueError(f'Type "{value.dtype}" unsupported yet')
+
+        if not value.size or value.ndim != 1 or kind not in 'iubUM':
+            return cls.escape_collection(value.tolist())
+
+        funcs = cls.escape_literal_funcs
+        default_funcs = SqlEscaper.escape_literal_funcs
+        if kind in 'iu' and funcs.get(int) is default_funcs[int]:
+            # the representation of the list of integers is the joined items
+            return repr(value.tolist())[1:-1]
+        if kind == 'b' and funcs.get(bool) is default_funcs[bool]:
+            return repr(value.tolist())[1:-1]
+        if kind == 'U' and funcs.get(str) is default_funcs[str]:
+            return ', '.join(value.tolist()).replace("'", "''")
+
+        # NaT and the items out of the range of python dates are not dates in the list
+        if kind == 'M' and not numpy.isnat(value).any() and (
+            numpy.datetime64('0001-01-01') <= value.min() and value.max() < numpy.datetime64('10000-01-01')
+        ):
+            unit = numpy.datetime_data(value.dtype)[0]
+            if unit == 'D' and funcs.get(date) is default_funcs[date]:
+                texts = numpy.datetime_as_string(value, unit='D')
+                return "'" + "'::date, '".join(texts.tolist()) + "'::date"
+            if unit in ('s', 'ms', 'us') and funcs.get(datetime) is default_funcs[datetime]:
+                value = value.astype('datetime64[us]')
+                # the microseconds are written if they are not zero as python datetimes do
+                texts = numpy.where(
+                    value.astype(numpy.int64) % 1000000 != 0,
+                    numpy.datetime_as_string(value, unit='us'),
+                    numpy.datetime_as_string(value, unit='s')
+                )
+                return ("'" + "'::timestamp, '".join(texts.tolist()) + "'::timestamp").replace('T', ' ')
+
+        return cls.escape_collection(value.tolist())
+
+    @classmethod
+    def get_value_func(cls, value_type):
+        """ Get the function sqlizing the value of the type to the complete literal, strings are quoted.
+
+        Args:
+            value_type (type): type of the value
+
+        Raises:
+            ValueError: returned the exception when the type is not in the whitelist or is a collection
+
+        Returns:
+            callable: sqlize function
+        """
+        escape_literal_func = cls.get_escape_func(value_type)
+        if escape_literal_func is None:
+            raise ValueError(f'Type "{value_type.__name__}" unsupported yet')
+        if issubclass(value_type, str):
+            return lambda value: f"'{escape_literal_func(value)}'"
+        return escape_literal_func
+
+    @classmethod
+    def escape_value(cls, value):
+        """ Sqlize the value to the complete literal, strings are quoted.
+
+        Args:
+            value (any type): the value to sqlize
+
+        Returns:
+            str: sqlized value
+        """
+        return cls.get_value_func(type(value))(value)
+
+    @classmethod
+    def get_row_funcs(cls, row):
+        """ Choose the sqlize function of every column by the types of the row values.
+
+        Args:
+            row (sequence): values of the row
+
+        Returns:
+            tuple: pairs of the type and the sqlize function of every column
+        """
+        return tuple((type(value), cls.get_value_func(type(value))) for value in row)
+
+    @classmethod
+    def escape_row(cls, row, row_funcs):
+        """ Sqlize the row to the parenthesized list of literals. Values of other types than the column type are
+        sqlized by their own type.
+
+        Args:
+            row (sequence): values of the row
+            row_funcs (tuple): pairs of the type and the sqlize function of every column
+
+        Returns:
+            str: sqlized row
+        """
+        return '(' + ', '.join([
+            func(value) if value.__class__ is value_type else cls.escape_value(value)
+            for (value_type, func), value in zip(row_funcs, row)
+        ]) + ')'
+
+    @classmethod
+    def get_condition(cls, value, condition):
+        """ Build the string with condition and sqlized value. Collections are sqlized as the list of the items
+        whatever "array_threshold" is, the array literal is built by "get_collection_condition".
+
+        Args:
+            value (any type): the value of the variable to sqlize
+            condition (str): sql expression, the part of predicate as example
+
+        Returns:
+            str: result sql expression
+        """
+        type_name = type(value).__name__
+        if type_name == 'NoneType':
+            res = 'IS NULL'
+        else:
+            res = cls.escape_literal(value)
+
+        return f'{condition} {res}'
+
+    @classmethod
+    def get_collection_condition(cls, value):
+        """ Build the predicate of the collection for the "cond:" directive: "IN" with the list of items or "= ANY"
+        with the array literal if the collection is larger than "array_threshold".
+
+        Args:
+            value (list, tuple or set): the collection to sqlize
+
+        Returns:
+            str: sql predicate without the left operand
+        """
+        if not value:
+            return 'IN (NULL)'
+        if cls.array_threshold is not None and len(value) > cls.array_threshold:
+            array = cls.escape_array(value)
+            if array is not None:
+                return f'= ANY({array})'
+
+        item_types = set(map(type, value))
+        escape_value_func = cls.get_value_func(item_types.pop()) if len(item_types) == 1 else cls.escape_value
+        return f'IN ({", ".join(map(escape_value_func, value))})'
+
+    @classmethod
+    def escape_array(cls, value):
+        """ Sqlize the homogeneous collection to the single typed array literal, as '{1,2,3}'::bigint[].
+
+        Args:
+            value (list, tuple or set): the collection to sqlize
+
+        Returns:
+            str: sqlized array or None if the items are of different or not supported types
+        """
+        item_types = set(map(type, value))
+        if len(item_types) != 1:
+            return None
+        array_type = cls.array_types.get(item_types.pop())
+        if array_type is None:
+            return None
+
+        type_name, escape_item_func = array_type
+        items = ','.join(map(escape_item_func, value)).replace("'", "''")
+        return f"'{{{items}}}'::{type_name}[]"
+
+
+class ParamEscaper(SqlEscaper):
+    """ Collect the values as bind parameters and sqlize them as placeholders. The escaper configures
+    "QueryFormatter.format_params", which collects the parameters of every query by the bound copy of the escaper.
+
+        Attrs:
+            paramstyle (str): style of placeholders: "format" for %s, "numeric" for $1, "named" for :p1
+            expand (bool): collections are sqlized as the placeholder per item or as the single array parameter
+            params (list or dict): collected parameters of the bound escaper, None if the escaper is not bound
+
+    """
+    paramstyles = ('format', 'numeric', 'named')
+
+    # placeholder of "format" paramstyle while formatting, percent signs of the text are doubled before replacing it
+    format_marker = '\x00'
+
+    def __init__(self, paramstyle='format', expand=True):
+        if paramstyle not in self.paramstyles:
+            raise ValueError(f'Paramstyle "{paramstyle}" unsupported yet')
+        self.paramstyle = paramstyle
+        self.expand = expand
+        self.params = None
+
+    def bind(self):
+        """ Get the copy of the escaper collecting the parameters of one query.
+
+        Returns:
+            ParamEscaper: bound escaper
+        """
+        escaper = type(self)(self.paramstyle, self.expand)
+        escaper.params = {} if self.paramstyle == 'named' else []
+        return escaper
+
+    def escape_literal(self, value):
+        """ Collect the value as the bind parameter.
+
+        Args:
+            value (any type): the value of the variable
+
+        Raises:
+            ValueError: returned the exception when the escaper is not bound
+
+        Returns:
+            str: placeholder of the parameter
+        """
+        if self.params is None:
+            raise ValueError('Parameters are collected by the bound escaper only, use "QueryFormatter.format_params"')
+
+        if not isinstance(value, self.collection_types):
+            return self.add_param(value)
+
+        if not self.expand:
+            return self.add_param(list(value))
+
+        # nested collections are flattened as the literals are
+        res_list = []
+        stack = [iter(value)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, self.collection_types):
+                    stack.append(iter(item))
+                    break
+                res_list.append(self.add_param(item))
+            else:
+                stack.pop()
+
+        return ', '.join(res_list)
+
+    def escape_value(self, value):
+        """ Collect the value as the bind parameter. """
+        return self.escape_literal(value)
+
+    def add_param(self, value):
+        """ Add the parameter.
+
+        Args:
+            value (any type): the value of the parameter
+
+        Returns:
+            str: placeholder of the parameter
+        """
+        params = self.params
+        if self.paramstyle == 'format':
+            params.append(value)
+            return self.format_marker
+        if self.paramstyle == 'numeric':
+            params.append(value)
+            return f'${len(params)}'
+
+        name = f'p{len(params) + 1}'
+        params[name] = value
+        return f':{name}'
+
+    def finalize(self, query):
+        """ Finalize the formatted text with placeholders.
+
+        Args:
+            query (str): formatted text
+
+        Returns:
+            str: the text for the database driver
+        """
+        if self.paramstyle == 'format':
+            return query.replace('%', '%%').replace(self.format_marker, '%s')
+        return query
+
+    def get_condition(self, value, condition):
+        """ Build the string with condition and the placeholder of the value.
+
+        Args:
+            value (any type): the value of the variable
+            condition (str): sql expression, the part of predicate as example
+
+        Returns:
+            str: result sql expression
+        """
+        if value is None:
+            return f'{condition} IS NULL'
+        return f'{condition} {self.escape_literal(value)}'
+
+    def get_collection_condition(self, value):
+        """ Build the predicate of the collection with the placeholders: "IN" with the placeholder per item or
+        "= ANY" with the single array parameter if the collection is not expanded.
+
+        Args:
+            value (list, tuple or set): the collection of the parameters
+
+        Returns:
+            str: sql predicate without the left operand
+        """
+        if not value:
+            return 'IN (NULL)'
+        if self.expand:
+            return f'IN ({self.escape_literal(value)})'
+        return f'= ANY({self.escape_literal(value)})'
+
+
+def child_scope(kwargs, scope):
+    """ Chain the variables of the nested scope to the template variables without copying them.
+
+    Args:
+        kwargs (mapping): variables of the template
+        scope (mapping): variables of the nested scope
+
+    Returns:
+        ChainMap: variables of the nested scope first and then the template variables
+    """
+    if isinstance(kwargs, ChainMap):
+        return kwargs.new_child(scope)
+    return ChainMap(scope, kwargs)
+
+
+class _MemoScope(ChainMap):
+    """ Variables of one rendering calling every callable value once. The value returned by the callable is used by
+    all fields referencing it, nested scopes of the rendering share the memo.
+
+        Attrs:
+            memo (dict): values returned by the callables by their ids
+
+    """
+    def __init__(self, *maps, memo=None):
+        super().__init__(*maps)
+        self.memo = {} if memo is None else memo
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if callable(value):
+            # the callable is referenced by the variables during the rendering, so its id is not reused
+            memo_key = id(value)
+            try:
+                value = self.memo[memo_key]
+            except KeyError:
+                value = self.memo[memo_key] = value()
+        return value
+
+    def new_child(self, m=None):
+        return self.__class__({} if m is None else m, *self.maps, memo=self.memo)
+
+
+class _TrackedScope(_MemoScope):
+    """ Variables of one rendering recording the names looked up by the fields, nested scopes of the rendering
+    share the record. Iterating the variables records "_MISSING" as all variables are read.
+
+        Attrs:
+            reads (set): names of the looked up variables
+
+    """
+    def __init__(self, *maps, memo=None, reads=None):
+        super().__init__(*maps, memo=memo)
+        self.reads = set() if reads is None else reads
+
+    def __getitem__(self, key):
+        self.reads.add(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.reads.add(key)
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self.reads.add(_MISSING)
+        return super().__iter__()
+
+    def new_child(self, m=None):
+        return self.__class__({} if m is None else m, *self.maps, memo=self.memo, reads=self.reads)
+
+
+class Template:
+    """ Compiled query template: a sequence of literal texts and field nodes.
+
+        Attrs:
+            source (str): text of the template
+            nodes (tuple): literal strings, field nodes and nested templates expanded in place, in order of appearance
+            error (Exception): deferred parsing error, raised when the template is rendered
+            scope (dict): variables bound to the template, they override the passed variables
+
+    """
+    __slots__ = ('source', 'nodes', 'error', 'scope', 'names', 'digest')
+
+    def __init__(self, source, nodes, error=None, scope=None):
+        self.source = source
+        self.nodes = nodes
+        self.error = error
+        self.scope = scope
+        # names of the variables collected by "template_names", False until they are collected
+        self.names = False
+        # digest of the nodes computed by "template_digest"
+        self.digest = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.source!r})'
+
+
+EMPTY_TEMPLATE = Template('', ())
+
+
+def template_names(template):
+    """ Collect the names of the variables referenced by the compiled template and its nested templates.
+
+    Args:
+        template (Template): compiled template
+
+    Returns:
+        frozenset: names of the variables or None if the template includes dynamic templates
+    """
+    if template.names is False:
+        template.names = collect_names(template)
+    return template.names
+
+
+def template_digest(template):
+    """ Get the digest of the compiled template computed from its nodes, the specialized templates of the same text
+    have different digests.
+
+    Args:
+        template (Template): compiled template
+
+    Returns:
+        bytes: the digest
+    """
+    if template.digest is None:
+        digest = hashlib.blake2b(digest_size=8)
+        stack = [iter(template.nodes)]
+        while stack:
+            for node in stack[-1]:
+                if node.__class__ is str:
+                    digest.update(b'\x00' + node.encode('utf-8', 'surrogatepass'))
+                elif node.__class__ is Template:
+                    stack.append(iter(node.nodes))
+                    break
+                else:
+                    digest.update(b'\x01' + node_text(node).encode('utf-8', 'surrogatepass'))
+            else:
+                stack.pop()
+        template.digest = digest.digest()
+    return template.digest
+
+
+def collect_names(template):
+    """ Collect the names of the variables referenced by the compiled template without the cache of "template_names".
+
+    Args:
+        template (Template): compiled template
+
+    Returns:
+        frozenset: names of the variables or None if the template includes dynamic templates
+    """
+    names = set()
+    stack = [template]
+    while stack:
+        for node in stack.pop().nodes:
+            if node.__class__ is str:
+                continue
+            if node.__class__ is Template:
+                stack.append(node)
+                continue
+            if node.__class__ in (_Include, _GenericField, _Directive):
+                return None
+            if not node.is_positional:
+                names.add(_string.formatter_field_name_split(node.field_name)[0])
+            body = getattr(node, 'body', None)
+            if body is not None:
+                stack.append(body)
+    return frozenset(names)
+
+
+class SqlMinifier:
+    """ Minifier of the literal texts of the SQL template. Runs of whitespace are collapsed to the single space and
+    comments are dropped, quoted strings, quoted identifiers and dollar-quoted strings are kept as they are. The state
+    is carried between the literal texts split by the fields, so the quoted field is not changed. The comment open at
+    the end of the literal text is kept because the field after it is commented out.
+
+        Attrs:
+            state (str): the token closing the open quote or comment, None outside them
+
+    """
+    # whitespace, comment starts and quote starts outside the quotes
+    code_pattern = re.compile(r"""\s+|--|/\*|(?<![\w$])[Ee]'|'|"|(?<![\w$])\$(?:[A-Za-z_]\w*)?\$""")
+    # the end of the string or the escaped character of the string with backslash escapes
+    escape_pattern = re.compile(r"\\.|'", re.DOTALL)
+    # the start and the end of the nested block comment
+    block_pattern = re.compile(r'/\*|\*/')
+    # the quote starting the literal text is the quote or the part of the identifier before it
+    quote_start_pattern = re.compile(r"\$|[Ee]'")
+
+    def __init__(self):
+        self.state = None
+        # the open string is the string with backslash escapes
+        self._escapes = False
+        # the depth of the open nested block comments
+        self._depth = 0
+
+    def feed(self, text, raw=False):
+        """ Minify the next literal text of the template.
+
+        Args:
+            text (str): literal text
+            raw (bool): the text follows the value of the field, which may end with the line comment, the leading
+                whitespace keeps its line break then
+
+        Returns:
+            str: minified text
+        """
+        parts = []
+        pos = 0
+        size = len(text)
+        space = False
+        leading = raw and self.state is None
+        while pos < size:
+            if self.state is not None:
+                # copy the quoted text or the comment split by the field up to its end
+                end = self.find_end(text, pos)
+                if end is None:
+                    parts.append(text[pos:])
+                    break
+                parts.append(text[pos:end])
+                pos = end
+                space = leading = False
+                continue
+
+            match = self.code_pattern.search(text, pos)
+            if match is None:
+                parts.append(text[pos:])
+                break
+            start, pos = match.span()
+            if start > match.pos:
+                parts.append(text[match.pos:start])
+                space = leading = False
+            token = match.group()
+
+            if token == '--':
+                end = text.find('\n', pos)
+                if end < 0:
+                    # the rest of the line is continued after the field
+                    self.state = '\n'
+                    parts.append(text[start:])
+                    break
+                token = ' '
+                pos = end + 1
+            elif token == '/*':
+                self.state = '*/'
+                self._depth = 1
+                end = self.find_end(text, pos)
+                if end is None:
+                    parts.append(text[start:])
+                    break
+                token = ' '
+                pos = end
+            elif token.isspace():
+                token = ' '
+            else:
+                self._escapes = token[0] in 'Ee'
+                self.state = token[-1] if token[-1] != '$' else token
+                parts.append(token)
+                space = leading = False
+                continue
+
+            if leading and '\n' in text[start:pos]:
+                # the line comment ending the value of the field before is closed by the line break
+                token = '\n'
+            # comments are separators of the tokens like the whitespace
+            if not space:
+                parts.append(token)
+                space = True
+            elif token == '\n':
+                parts[-1] = token
+        return ''.join(parts)
+
+    def find_end(self, text, pos):
+        """ Find the end of the open quote or comment and close it.
+
+        Args:
+            text (str): literal text
+            pos (int): start of the search
+
+        Returns:
+            int: the position after the closing token or None if it is not in the text
+        """
+        state = self.state
+        if state == '*/':
+            for match in self.block_pattern.finditer(text, pos):
+                self._depth += 1 if match.group() == '/*' else -1
+                if not self._depth:
+                    self.state = None
+                    return match.end()
+            return None
+
+        if state == "'" and self._escapes:
+            for match in self.escape_pattern.finditer(text, pos):
+                if match.group() == "'":
+                    self.state = None
+                    return match.end()
+            return None
+
+        end = text.find(state, pos)
+        if end < 0:
+            return None
+        self.state = None
+        return end + len(state)
+
+
+def ends_raw(nodes, raw=False):
+    """ Check the text rendered by the nodes may end with the value of the field. The value is the raw text, as the
+    nested template or the string out of the quotes, which may end with the line comment.
+
+    Args:
+        nodes (iterable): literal texts and field nodes of the template
+        raw (bool): the text rendered before the nodes may end with the value of the field
+
+    Returns:
+        bool: the rendered text may end with the value of the field
+    """
+    for node in nodes:
+        if node.__class__ is str:
+            raw = False
+        elif isinstance(node, (_Condition, _Repeat)):
+            # the skipped condition and the empty repeat leave the text before them
+            raw = raw or ends_raw(node.body.nodes)
+        else:
+            raw = True
+    return raw
+
+
+def minify_template(template, nested=False, raw=False):
+    """ Minify the literal texts of the compiled template and the nested templates of its conditions and repeats.
+    The whitespace at the edges of the condition body is dropped if the text around the condition has it already.
+
+    Args:
+        template (Template): compiled template
+        nested (bool): the template is the body of the field, it must not end inside the quote or the comment
+        raw (bool): the text rendered before the template may end with the value of the field
+
+    Returns:
+        Template: minified template or None if it can't be minified safely
+    """
+    if template.error is not None:
+        return template
+
+    minifier = SqlMinifier()
+    nodes = []
+    for node in template.nodes:
+        if node.__class__ is str:
+            if minifier.state is None and minifier.quote_start_pattern.match(node):
+                # the quote start depends on the rendered text before it
+                return None
+            node = minifier.feed(node, raw)
+            raw = False
+            if not node:
+                continue
+        elif isinstance(node, (_Condition, _Repeat)):
+            if minifier.state is not None:
+                # the body changes the quoting of the text after it
+                return None
+            # the repeated body without the separator follows the previous item
+            body_raw = raw or isinstance(node, _Repeat) and not node.separator and ends_raw(node.body.nodes)
+            body = minify_template(node.body, nested=True, raw=body_raw)
+            if body is None:
+                return None
+            raw = ends_raw((node,), raw)
+            node = copy.copy(node)
+            node.body = body
+        else:
+            raw = ends_raw((node,), raw)
+        nodes.append(node)
+
+    if nested:
+        return None if minifier.state is not None else Template(template.source, tuple(nodes))
+    return Template(template.source, tuple(strip_spaces(nodes, False, False)[0]))
+
+
+def strip_spaces(nodes, spaced, followed):
+    """ Drop the whitespace doubled by the minified texts around the conditions: the text after the space drops its
+    leading space and the condition body ending with the space drops it before the text starting with the space.
+    The body of the condition between the spaces ends with the space instead of the text after it.
+
+    Args:
+        nodes (list): literal texts and field nodes of the minified template
+        spaced (bool): the text rendered before the nodes ends with the space whether the conditions are taken or not
+        followed (bool): the text rendered after the nodes starts with the space
+
+    Returns:
+        tuple: the nodes and the flag that the text rendered with them ends with the space
+    """
+    result = []
+    for index, node in enumerate(nodes):
+        if node.__class__ is str:
+            if spaced:
+                node = node.lstrip(' ')
+            if index == len(nodes) - 1 and followed and not spaced:
+                node = node.rstrip(' ')
+            if node:
+                result.append(node)
+                spaced = node.endswith((' ', '\n'))
+            continue
+        if not isinstance(node, _Condition):
+            result.append(node)
+            spaced = False
+            continue
+
+        next_text = index + 1 < len(nodes) and nodes[index + 1].__class__ is str
+        next_followed = nodes[index + 1].startswith(' ') if next_text else index + 1 == len(nodes) and followed
+        # the body drops its trailing space before the text starting with the space unless the text drops it
+        body_nodes, body_spaced = strip_spaces(list(node.body.nodes), spaced, next_followed and not spaced)
+        if spaced and next_text and next_followed and body_nodes and not body_spaced:
+            # the space of the text after the condition is moved to the end of the body, the text drops it then
+            if body_nodes[-1].__class__ is str:
+                body_nodes[-1] += ' '
+            else:
+                body_nodes.append(' ')
+            body_spaced = True
+        node = copy.copy(node)
+        node.body = Template(node.body.source, tuple(body_nodes))
+        result.append(node)
+        # the skipped condition leaves the text before it
+        spaced = spaced and body_spaced
+    return result, spaced
+
+
+class _Field:
+    """ Field node of a compiled template. Formats the value by default. """
+    __slots__ = ('field_name', 'conversion', 'spec', 'is_positional', 'is_simple')
+
+    # formatting methods of the formatter the node evaluates without calling, the field is formatted by
+    # "format_field" if the formatter redefines any of them
+    bypassed = ()
+
+    def __init__(self, field_name, conversion, spec):
+        self.field_name = field_name
+        self.conversion = conversion
+        self.spec = spec
+        self.is_positional = field_name == '' or field_name.isdigit()
+        # the name of the variable without attributes and items
+        self.is_simple = not self.is_positional and '.' not in field_name and '[' not in field_name
+
+    @classmethod
+    def build(cls, formatter, field_name, conversion, spec):
+        """ Build the node, split the spec arguments and compile the nested templates.
+
+        Args:
+            formatter (QueryFormatter): the formatter compiling the template
+            field_name (str): name of the variable
+            conversion (str): conversion of the value, "r", "s", "a" or None
+            spec (str): string literals separated by :
+
+        Returns:
+            _Field: compiled node
+        """
+        return cls(field_name, conversion, spec)
+
+    def evaluate(self, formatter, value, kwargs):
+        """ Evaluate the field with the value.
+
+        Args:
+            formatter (QueryFormatter): the formatter rendering the template
+            value (any type): the value of the variable
+            kwargs (dict): variables of the template
+
+        Returns:
+            str or Template: formatted text or a nested template to expand
+        """
+        if callable(value):
+            value = value()
+        return formatter.format_default_value(value, self.spec)[0]
+
+    def stream(self, formatter, value, kwargs):
+        """ Evaluate the field with the value while streaming. The formatted text may be returned as the iterator
+        of chunks.
+
+        Args:
+            formatter (QueryFormatter): the formatter rendering the template
+            value (any type): the value of the variable
+            kwargs (dict): variables of the template
+
+        Returns:
+            str, Template or iterator: formatted text, a nested template to expand or chunks of formatted text
+        """
+        return self.evaluate(formatter, value, kwargs)
+
+
+class _GenericField(_Field):
+    """ Field node delegating to "format_field", used when it is redefined. """
+    __slots__ = ()
+
+    def evaluate(self, formatter, value, kwargs):
+        field_item, already_formatted = formatter.format_field(value, self.spec, kwargs)
+        return field_item if already_formatted else formatter.compile(field_item)
+
+
+class _Directive(_Field):
+    """ Field node of the registered custom directive. """
+    __slots__ = ('handler',)
+
+    def __init__(self, field_name, conversion, spec, handler):
+        super().__init__(field_name, conversion, spec)
+        self.handler = handler
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        field_item, already_formatted = self.handler(formatter, value, self.spec, kwargs)
+        return field_item if already_formatted else formatter.compile(field_item)
+
+
+class _Include(_Field):
+    __slots__ = ()
+    bypassed = ('format_include_value',)
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+
+        return formatter.render_item(*self.get_scope(formatter, value, kwargs))
+
+    def stream(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        template, kwargs = self.get_scope(formatter, value, kwargs)
+        return formatter.render_scope(template, kwargs, stream=True)
+
+    def get_scope(self, formatter, value, kwargs):
+        """ Get the included template and its variables. The template of the registry is included by the field name
+        if the variable is not passed.
+
+        Args:
+            formatter (QueryFormatter): the formatter rendering the template
+            value (str, Template or list): included template or the list of the template and its parameters
+            kwargs (dict): variables of the template
+
+        Returns:
+            tuple: compiled template and its variables
+        """
+        if isinstance(value, list):
+            value, value_param = value
+            kwargs = child_scope(kwargs, value_param)
+        if value is None and formatter.registry is not None and self.field_name in formatter.registry:
+            return formatter.get_template(self.field_name), kwargs
+        return formatter.compile(value or ''), kwargs
+
+
+class _Repeat(_Field):
+    __slots__ = ('separator', 'body')
+    bypassed = ('format_repeat_value',)
+
+    def __init__(self, field_name, conversion, spec, separator, body):
+        super().__init__(field_name, conversion, spec)
+        self.separator = separator
+        self.body = body
+
+    @classmethod
+    def build(cls, formatter, field_name, conversion, spec):
+        param_list = formatter.get_param_list(spec)
+        if len(param_list) < 3:
+            return _GenericField(field_name, conversion, spec)
+        return cls(field_name, conversion, spec, param_list[1], formatter.parse_template(param_list[2]))
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        if not value:
+            return EMPTY_TEMPLATE
+        return formatter.render_repeat(self.body, self.separator, value, kwargs)
+
+    def stream(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        if not value:
+            return EMPTY_TEMPLATE
+        return self.iter_items(formatter, value, kwargs)
+
+    def iter_items(self, formatter, value, kwargs):
+        """ Stream the chunks of the repeated items.
+
+        Args:
+            formatter (QueryFormatter): the formatter rendering the template
+            value (iterable): repeated items
+            kwargs (dict): variables of the template
+
+        Yields:
+            str: chunk of the formatted text
+        """
+        scope = {}
+        item_kwargs = child_scope(kwargs, scope)
+        body = self.body
+
+        if isinstance(value, dict):
+            for index, (key, item) in enumerate(value.items()):
+                if index:
+                    yield self.separator
+                scope['item'] = item
+                scope['key'] = key
+                yield from formatter.render_scope(body, item_kwargs, stream=True)
+        else:
+            for index, item in enumerate(value):
+                if index:
+                    yield self.separator
+                scope['item'] = item
+                yield from formatter.render_scope(body, item_kwargs, stream=True)
+
+
+class _Tmpl(_Field):
+    __slots__ = ()
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        return formatter.format_tmpl_value(value)[0]
+
+
+class _Idf(_Field):
+    __slots__ = ()
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        return formatter.format_field_name(value)[0]
+
+
+class _Cond(_Field):
+    __slots__ = ()
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        return formatter.format_cond_value(value, self.spec)[0]
+
+
+class _Copy(_Field):
+    __slots__ = ()
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        return formatter.format_copy_value(value, self.spec)[0]
+
+
+class _Condition(_Field):
+    """ Field node expanding the body when the condition is met. Operands casted to types are cached in the node.
+    """
+    __slots__ = ('operand', 'body', 'casted')
+
+    def __init__(self, field_name, conversion, spec, operand, body):
+        super().__init__(field_name, conversion, spec)
+        self.operand = operand
+        self.body = body
+        self.casted = {}
+
+    @classmethod
+    def build(cls, formatter, field_name, conversion, spec):
+        param_list = formatter.get_param_list(spec)
+        if len(param_list) < 3:
+            # malformed spec fails while rendering as before
+            return _GenericField(field_name, conversion, spec)
+        operand = cls.parse_operand(param_list[1])
+        return cls(field_name, conversion, spec, operand, formatter.parse_template(param_list[2]))
+
+    @staticmethod
+    def parse_operand(operand):
+        """ Parse the operand of the spec.
+
+        Args:
+            operand (str): the second element of the spec
+
+        Returns:
+            any type: parsed operand
+        """
+        return operand
+
+    def evaluate(self, formatter, value, kwargs):
+        if callable(value):
+            value = value()
+        return self.body if self.check(value) else EMPTY_TEMPLATE
+
+    def check(self, value):
+        """ Check the condition of the value.
+
+        Args:
+            value (any type): the value of the variable
+
+        Returns:
+            bool: the condition is met
+        """
+        raise NotImplementedError
+
+    def cast_operand(self, value):
+        """ Get the operand casted to the type of the value.
+
+        Args:
+            value (any type): the value of the variable
+
+        Returns:
+            any type: casted operand
+        """
+        to_type = type(value).__name__
+        try:
+            return self.casted[to_type]
+        except KeyError:
+            operand = self.casted[to_type] = cast_to_type(self.operand, to_type)
+            return operand
+
+
+class _If(_Condition):
+    __slots__ = ()
+    bypassed = ('format_if_value',)
+
+    @classmethod
+    def build(cls, formatter, field_name, conversion, spec):
+        return cls(field_name, conversion, spec, None, formatter.parse_template(spec.partition(':')[-1]))
+
+    def check(self, value):
+        return bool(value)
+
+
+class _NotIf(_If):
+    __slots__ = ()
+    bypassed = ('format_not_if_value',)
+
+    def check(self, value):
+        return not value
+
+
+class _In(_Condition):
+    __slots__ = ('options',)
+    bypassed = ('format_in_value',)
+
+    def __init__(self, field_name, conversion, spec, operand, body):
+        super().__init__(field_name, conversion, spec, operand, body)
+        self.options = frozenset(operand)
+
+    @staticmethod
+    def parse_operand(operand):
+        return operand.split(',')
+
+    def check(self, value):
+        if isinstance(value, list):
+            return self.check_list(value)
+        if type(value) is str:
+            return value in self.options
+        return value in self.operand
+
+    def check_list(self, value):
+        """ Check any item of the list is in the options casted to the type of the item.
+
+        Args:
+            value (list): the value of the variable
+
+        Returns:
+            bool: the condition is met
+        """
+        casted = self.casted
+        for item_value in value:
+            to_type = type(item_value).__name__
+            try:
+                options = casted[to_type]
+            except KeyError:
+                options = casted[to_type] = cast_options(self.operand, to_type)
+
+            if options is None:
+                # the options could not be casted, check them one by one as format_in_value does
+                if item_value in map(lambda x: cast_to_type(x, to_type), self.operand):
+                    return True
+            elif item_value in options:
+                return True
+        return False
+
+
+class _NotIn(_In):
+    __slots__ = ()
+    bypassed = ('format_in_value',)
+
+    def check(self, value):
+        return not super().check(value)
+
+
+class _Exists(_Condition):
+    __slots__ = ()
+    bypassed = ('format_exists_value', 'get_compared_value')
+
+    def check(self, value):
+        return type(value).__name__ in ('list', 'tuple') and self.operand in value
+
+
+class _NotExists(_Exists):
+    __slots__ = ()
+    bypassed = ('format_not_exists_value', 'get_compared_value')
+
+    def check(self, value):
+        return not super().check(value)
+
+
+class _Eq(_Condition):
+    __slots__ = ()
+    bypassed = ('format_eq_value', 'get_compared_value')
+
+    def check(self, value):
+        return value == self.cast_operand(value)
+
+
+class _NotEq(_Condition):
+    __slots__ = ()
+    bypassed = ('format_not_eq_value', 'get_compared_value')
+
+    def check(self, value):
+        return value != self.cast_operand(value)
+
+
+class _Gt(_Condition):
+    __slots__ = ()
+    bypassed = ('format_gt_value', 'get_compared_value')
+
+    def check(self, value):
+        return value is not None and value > self.cast_operand(value)
+
+
+class _Lt(_Condition):
+    __slots__ = ()
+    bypassed = ('format_lt_value', 'get_compared_value')
+
+    def check(self, value):
+        return value is not None and value < self.cast_operand(value)
+
+
+# node classes of the dumped templates by their names, nodes of custom directives are not dumped
+_DUMPED_NODES = {
+    node_class.__name__: node_class for node_class in (
+        _Field, _GenericField, _Include, _Repeat, _Tmpl, _Idf, _Cond, _Copy,
+        _If, _NotIf, _In, _NotIn, _Exists, _NotExists, _Eq, _NotEq, _Gt, _Lt
+    )
+}
+
+# deferred parsing errors of the dumped templates
+_DUMPED_ERRORS = {error_class.__name__: error_class for error_class in (ValueError, TypeError)}
+
+
+def dump_template(template):
+    """ Convert the compiled template to the nested tuples of builtin values, which are written by "marshal" much
+    faster than the template is parsed.
+
+    Args:
+        template (Template): compiled template
+
+    Raises:
+        TypeError: returned the exception when the template has the nodes of custom directives or bound variables
+
+    Returns:
+        tuple: the text, the nodes and the deferred error of the template
+    """
+    if template.scope is not None:
+        raise TypeError('Templates with bound variables are not dumped')
+    error = template.error
+    if error is not None:
+        if _DUMPED_ERRORS.get(error.__class__.__name__) is not error.__class__:
+            raise TypeError(f'Error "{error!r}" of the template is not dumped')
+        error = (error.__class__.__name__, error.args)
+
+    nodes = []
+    for node in template.nodes:
+        node_class = node.__class__
+        if node_class is str:
+            nodes.append(node)
+        elif node_class is Template:
+            nodes.append(('Template', dump_template(node)))
+        elif _DUMPED_NODES.get(node_class.__name__) is not node_class:
+            raise TypeError(f'Node "{node_class.__name__}" is not dumped')
+        elif isinstance(node, _Condition):
+            nodes.append((
+                node_class.__name__, node.field_name, node.conversion, node.spec, node.operand, dump_template(node.body)
+            ))
+        elif node_class is _Repeat:
+            nodes.append((
+                node_class.__name__, node.field_name, node.conversion, node.spec, node.separator,
+                dump_template(node.body)
+            ))
+        else:
+            nodes.append((node_class.__name__, node.field_name, node.conversion, node.spec))
+    return template.source, tuple(nodes), error
+
+
+def load_template(data):
+    """ Build the compiled template from the nested tuples of "dump_template".
+
+    Args:
+        data (tuple): the text, the nodes and the deferred error of the template
+
+    Returns:
+        Template: compiled template
+    """
+    source, dumped_nodes, error = data
+    if error is not None:
+        error = _DUMPED_ERRORS[error[0]](*error[1])
+
+    nodes = []
+    for node in dumped_nodes:
+        if node.__class__ is str:
+            nodes.append(node)
+        elif node[0] == 'Template':
+            nodes.append(load_template(node[1]))
+        elif len(node) == 6:
+            # the condition and the repeat with the nested template
+            nodes.append(_DUMPED_NODES[node[0]](*node[1:5], load_template(node[5])))
+        else:
+            nodes.append(_DUMPED_NODES[node[0]](*node[1:]))
+    return Template(source, tuple(nodes), error)
+
+
+# the formatter of the worker process
+_worker_formatter = None
+
+
+# the value of the variable not passed to the template
+_MISSING = object()
+
+# kinds of the frames of the evaluator: the nested template sharing the scope and the template with its own scope
+_NESTED_FRAME = 0
+_SCOPE_FRAME = 1
+# number of the chunks of the buffer of the evaluator flushed at once
+_FLUSH_CHUNKS = 1024
+
+ResultCacheInfo = namedtuple('ResultCacheInfo', ('hits', 'misses', 'bypasses', 'maxsize', 'currsize'))
+
+
+class ResultCache:
+    """ Cache of the formatted texts keyed by the compiled template and the values of the variables referenced by
+    the template, other variables don't affect the key. Values are frozen with their types, calls with callables,
+    other types of values or templates including the templates of the registry bypass the cache. The cache is
+    thread-safe and belongs to one formatter.
+
+        Attrs:
+            maxsize (int): maximum number of the cached texts, the least recently used ones are dropped
+            ttl (float): lifetime of the cached text in seconds, not limited by default
+            hits (int): number of the texts taken from the cache
+            misses (int): number of the texts formatted and cached
+            bypasses (int): number of the texts formatted bypassing the cache
+
+    """
+    # immutable types of the values frozen as they are, datetimes and times are frozen with their UTC offsets as
+    # the equal values of different offsets are sqlized differently
+    frozen_types = frozenset((type(None), bool, int, float, complex, str, bytes, date, UUID))
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.bypasses = 0
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.Lock()
+        # key: formatted text and the expiration time
+        self._entries = OrderedDict()
+        # template: sorted names of its variables or None if all variables are referenced
+        self._names = {}
+
+    def __getstate__(self):
+        """ Cached texts and the lock are not pickled. """
+        state = self.__dict__.copy()
+        for name in ('_lock', '_entries', '_names'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        """ Get the statistics of the cache.
+
+        Returns:
+            ResultCacheInfo: hits, misses, bypasses, maximum and current size
+        """
+        return ResultCacheInfo(self.hits, self.misses, self.bypasses, self.maxsize, len(self._entries))
+
+    def clear(self):
+        """ Drop all cached texts and reset the statistics. """
+        with self._lock:
+            self._entries.clear()
+            self._names.clear()
+            self.hits = self.misses = self.bypasses = 0
+
+    def make_key(self, template, args, kwargs, registry=None):
+        """ Build the key of the formatted text.
+
+        Args:
+            template (Template): compiled template
+            args (tuple): positional variables
+            kwargs (mapping): named variables
+            registry (TemplateRegistry): registry of the formatter
+
+        Returns:
+            tuple: the key or None if the text must bypass the cache
+        """
+        names = self._names.get(template, _MISSING)
+        if names is _MISSING:
+            names = template_names(template)
+            if names is not None:
+                names = tuple(sorted(names))
+            with self._lock:
+                if len(self._names) >= self.maxsize:
+                    self._names.clear()
+                self._names[template] = names
+
+        try:
+            if names is None:
+                if registry is not None:
+                    # the templates of the registry may be changed
+                    raise TypeError('Included templates of the registry are not cached')
+                items = tuple((name, self.freeze(value)) for name, value in sorted(kwargs.items()))
+            else:
+                frozen_types = self.frozen_types
+                items = []
+                for name in names:
+                    value = kwargs.get(name, _MISSING)
+                    # values of the immutable types are frozen in place
+                    value_type = value.__class__
+                    if value_type in frozen_types:
+                        items.append((name, value_type, value))
+                    else:
+                        items.append((name, self.freeze(value)))
+                items = tuple(items)
+            return template, tuple(map(self.freeze, args)), items
+        except TypeError:
+            with self._lock:
+                self.bypasses += 1
+            return None
+
+    def freeze(self, value):
+        """ Freeze the value with its type to the hashable key, collections are frozen with the order of items.
+
+        Args:
+            value (any type): the value of the variable
+
+        Raises:
+            TypeError: returned the exception when the value can't be cached
+
+        Returns:
+            tuple: frozen value
+        """
+        value_type = value.__class__
+        if value_type in self.frozen_types or value is _MISSING:
+            return value_type, value
+        if value_type is datetime or value_type is time:
+            return value_type, value, value.utcoffset()
+        if value_type in (list, tuple, set, frozenset):
+            item_types = set(map(type, value))
+            if len(item_types) == 1 and item_types <= self.frozen_types:
+                # the items of one type are tagged once
+                return value_type, item_types.pop(), tuple(value)
+            return value_type, tuple(map(self.freeze, value))
+        if value_type is dict:
+            return value_type, tuple((self.freeze(key), self.freeze(item)) for key, item in value.items())
+        if value_type is Template:
+            return value_type, value
+        raise TypeError(f'Type "{value_type.__name__}" is not cached')
+
+    def get(self, key):
+        """ Get the cached text.
+
+        Args:
+            key (tuple): the key of the text
+
+        Returns:
+            str: the cached text or None if the text is not cached or is expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                text, expires = entry
+                if expires is None or expires > monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return text
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def put(self, key, text):
+        """ Cache the text.
+
+        Args:
+            key (tuple): the key of the text
+            text (str): formatted text
+        """
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = text, expires
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class RenderStats:
+    """ Statistics of the rendering collected by the span of the formatter.
+
+        Attrs:
+            name (str): name of the span
+            elapsed (float): time of the span in seconds, set when the span is closed
+            formats (int): number of formatted templates
+            renders (int): number of rendered templates, nested templates and repeated items are counted too
+            max_depth (int): maximum depth of nested templates
+            escaped_values (int): number of the values sqlized by default, items of collections are counted
+            output_chars (int): number of characters of the formatted texts
+            directives (dict): number of fields and their time in seconds by the directive names, the time of
+                "include" and "repeat" includes their nested fields
+            fields (dict): number of fields and their time in seconds by the field names
+
+    """
+    def __init__(self, name=None):
+        self.name = name
+        self.elapsed = None
+        self.formats = self.renders = self.max_depth = self.escaped_values = self.output_chars = 0
+        self.directives = {}
+        self.fields = {}
+
+    def __repr__(self):
+        return (
+            f'{type(self).__name__}({self.name!r}, formats={self.formats}, renders={self.renders}, '
+            f'output_chars={self.output_chars})'
+        )
+
+    def add_field(self, directive, field_name, elapsed):
+        """ Add the time of the field.
+
+        Args:
+            directive (str): name of the directive of the field, "default" for the default formatting
+            field_name (str): name of the variable
+            elapsed (float): time of the field in seconds
+        """
+        for totals, key in ((self.directives, directive), (self.fields, field_name)):
+            total = totals.get(key)
+            if total is None:
+                totals[key] = [1, elapsed]
+            else:
+                total[0] += 1
+                total[1] += elapsed
+
+    def merge(self, stats):
+        """ Add the statistics of the nested span.
+
+        Args:
+            stats (RenderStats): statistics of the nested span
+        """
+        self.formats += stats.formats
+        self.renders += stats.renders
+        self.max_depth = max(self.max_depth, stats.max_depth)
+        self.escaped_values += stats.escaped_values
+        self.output_chars += stats.output_chars
+        for totals, nested_totals in ((self.directives, stats.directives), (self.fields, stats.fields)):
+            for key, (count, elapsed) in nested_totals.items():
+                total = totals.setdefault(key, [0, 0.0])
+                total[0] += count
+                total[1] += elapsed
+
+    def as_dict(self):
+        """ Get the statistics as the dict, as example for attributes of the tracing span.
+
+        Returns:
+            dict: the statistics
+        """
+        return {
+            'name': self.name,
+            'elapsed': self.elapsed,
+            'formats': self.formats,
+            'renders': self.renders,
+            'max_depth': self.max_depth,
+            'escaped_values': self.escaped_values,
+            'output_chars': self.output_chars,
+            'directives': {key: tuple(total) for key, total in self.directives.items()},
+            'fields': {key: tuple(total) for key, total in self.fields.items()}
+        }
+
+
+# limits of the value representation in the message of the field error
+_ERROR_REPR = reprlib.Repr()
+_ERROR_REPR.maxstring = _ERROR_REPR.maxother = 80
+# characters of the template line shown around the failed field
+_EXCERPT_WIDTH = 80
+
+
+class FieldError(ValueError):
+    """ Error during processing the field of the template. The message with the position of the field, the excerpt
+    of the template around it and the truncated value is formatted only when the error is rendered.
+
+        Attrs:
+            field_name (str): name of the variable
+            value (any type): the value of the variable
+            template (Template): compiled template of the field
+            node (_Field): field node or None if it is unknown
+
+    """
+    def __init__(self, field_name, value, template, node=None):
+        super().__init__(field_name)
+        self.field_name = field_name
+        self.value = value
+        self.template = template
+        self.node = node
+        self._message = None
+
+    def __str__(self):
+        if self._message is None:
+            self._message = self.format_message()
+        return self._message
+
+    def __reduce__(self):
+        # the value may be not picklable, the errors of the worker processes keep its text
+        return type(self), (self.field_name, self.value_text(), self.template, self.node)
+
+    def value_text(self):
+        """ Get the truncated text of the value.
+
+        Returns:
+            str: the text
+        """
+        value = self.value
+        if isinstance(value, (list, tuple, set, frozenset, dict, deque)):
+            return _ERROR_REPR.repr(value)
+        text = str(value)
+        if len(text) > _ERROR_REPR.maxstring:
+            text = text[:_ERROR_REPR.maxstring - 3] + '...'
+        return text
+
+    def find_position(self):
+        """ Find the position of the field in the template text. The field is the same occurrence of its text as the
+        node is of the nodes with the same text.
+
+        Returns:
+            tuple: offset of the field and the length of its text or None if the field is not found
+        """
+        node, nodes = self.node, self.template.nodes
+        if node is None or node.__class__ is str or node not in nodes:
+            return None
+        field_text = node_text(node)
+        occurrence = sum(
+            1 for item in islice(nodes, nodes.index(node))
+            if item.__class__ is not str and item.__class__ is not Template and node_text(item) == field_text
+        )
+        source, offset = self.template.source, -1
+        while True:
+            offset = source.find(field_text, offset + 1)
+            if offset < 0:
+                return None
+            # the text inside the escaped braces is not the field
+            if offset and source[offset - 1] == '{':
+                continue
+            if not occurrence:
+                return offset, len(field_text)
+            occurrence -= 1
+
+    def format_message(self):
+        """ Format the message of the error.
+
+        Returns:
+            str: the message
+        """
+        message = f'Error during processing variable "{self.field_name}" with value "{self.value_text()}"'
+        source = self.template.source
+        position = self.find_position()
+        if position is None:
+            excerpt = source[:_EXCERPT_WIDTH] + ('...' if len(source) > _EXCERPT_WIDTH else '')
+            return f'{message} in template:\n{excerpt}'
+
+        offset, length = position
+        line_start = source.rfind('\n', 0, offset) + 1
+        line_end = source.find('\n', offset)
+        if line_end < 0:
+            line_end = len(source)
+        line, column = source.count('\n', 0, offset) + 1, offset - line_start + 1
+
+        # the window of the line around the field
+        start = max(line_start, offset - (_EXCERPT_WIDTH - min(length, _EXCERPT_WIDTH)) // 2)
+        end = min(line_end, start + _EXCERPT_WIDTH)
+        prefix = '...' if start > line_start else ''
+        suffix = '...' if end < line_end else ''
+        excerpt = prefix + source[start:end] + suffix
+        marker = ' ' * (len(prefix) + offset - start) + '^' * max(1, min(length, end - offset))
+        return f'{message} at line {line}, column {column} of template:\n{excerpt}\n{marker}'
+
+
+def node_text(node):
+    """ Get the text of the field node as it is written in the template.
+
+    Args:
+        node (_Field): field node
+
+    Returns:
+        str: the text of the field
+    """
+    conversion = '' if node.conversion is None else f'!{node.conversion}'
+    spec = f':{node.spec}' if node.spec else ''
+    return f'{{{node.field_name}{conversion}{spec}}}'
+
+
+class RenderSession:
+    """ Stateful rendering of one template: the formatted text of every top-level segment is kept with the names of
+    the variables the segment has read, included templates and repeated items count as read by their segment.
+    "update" re-renders only the segments reading the changed variables and splices them into the kept text.
+    Passed values are compared with the rendered ones frozen as the keys of "ResultCache", values of other types
+    are always changed. The session is not thread-safe and bypasses the result cache.
+
+        Attrs:
+            formatter (QueryFormatter): the formatter rendering the segments
+            template (Template): compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables of the last rendering
+            text (str): formatted text of the last rendering
+            rendered (int): number of the segments rendered by the last rendering
+
+    """
+    # values are frozen with their types as the keys of the result cache
+    frozen_types = ResultCache.frozen_types
+    freeze = ResultCache.freeze
+
+    def __init__(self, formatter, format_string, args=(), kwargs=None):
+        self.formatter = formatter
+        self.template = template = formatter.compile(format_string)
+        self.args = args
+        self.kwargs = {}
+        self.text = ''
+        self.rendered = 0
+        # segments of the top-level fields are the templates of one node, the source is kept for the field errors
+        if template.error is not None:
+            self._segments = [template]
+        else:
+            self._segments = [
+                node if node.__class__ is str else Template(template.source, (node,)) for node in template.nodes
+            ]
+        count = len(self._segments)
+        self._texts = [segment if segment.__class__ is str else '' for segment in self._segments]
+        self._reads = [None] * count
+        self._used_args = [()] * count
+        # indexes of automatic field numbering before and after the segments
+        self._indexes = [(0, 0)] * count
+        # frozen values of the rendered variables, values of other types are "_MISSING"
+        self._frozen = {}
+        self._render(dict(kwargs or {}), None)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.template!r}, rendered={self.rendered})'
+
+    def freeze_value(self, value):
+        """ Freeze the value to compare it with the passed one.
+
+        Args:
+            value (any type): the value of the variable
+
+        Returns:
+            tuple: frozen value or "_MISSING" if the value can't be frozen
+        """
+        try:
+            return self.freeze(value)
+        except TypeError:
+            return _MISSING
+
+    def update(self, **changed):
+        """ Render the template with the changed variables re-rendering only the segments reading them. The session
+        keeps its state if the rendering fails.
+
+        Args:
+            changed (dict): named variables to change
+
+        Returns:
+            str: formatted text
+        """
+        frozen = self._frozen
+        names = set()
+        for name, value in changed.items():
+            value = self.freeze_value(value)
+            if value is _MISSING or frozen.get(name, _MISSING) != value:
+                names.add(name)
+        if not names:
+            self.rendered = 0
+            return self.text
+        return self._render(dict(self.kwargs, **changed), names)
+
+    def _render(self, kwargs, names):
+        """ Render the segments reading the changed variables and join the text.
+
+        Args:
+            kwargs (dict): named variables
+            names (set): names of the changed variables, all segments are rendered if it is None
+
+        Returns:
+            str: formatted text
+        """
+        formatter = self.formatter
+        scope = self.template.scope
+        texts = self._texts.copy()
+        reads = self._reads.copy()
+        used_args = self._used_args.copy()
+        indexes = self._indexes.copy()
+        # the values returned by the callables are shared by the segments of the rendering
+        memo = {}
+        rendered = 0
+        auto_arg_index = 0
+        for position, segment in enumerate(self._segments):
+            if segment.__class__ is str:
+                continue
+            segment_reads = reads[position]
+            start_index = indexes[position][0]
+            # the numbering is disabled by False, it is not the index 0
+            if (
+                names is not None and start_index == auto_arg_index and
+                start_index.__class__ is auto_arg_index.__class__ and
+                _MISSING not in segment_reads and names.isdisjoint(segment_reads)
+            ):
+                auto_arg_index = indexes[position][1]
+                continue
+
+            segment_kwargs = _TrackedScope(kwargs, memo=memo)
+            if scope is not None:
+                segment_kwargs = child_scope(segment_kwargs, scope)
+            segment_used_args = set()
+            texts[position], end_index = formatter._vformat(
+                segment, self.args, segment_kwargs, segment_used_args, formatter.recursion_depth, auto_arg_index
+            )
+            reads[position] = segment_kwargs.reads
+            used_args[position] = segment_used_args
+            indexes[position] = auto_arg_index, end_index
+            auto_arg_index = end_index
+            rendered += 1
+
+        formatter.check_unused_args(set().union(*used_args), self.args, kwargs)
+        text = ''.join(texts)
+        self._texts, self._reads, self._used_args, self._indexes = texts, reads, used_args, indexes
+        if names is None:
+            self._frozen = {name: self.freeze_value(value) for name, value in kwargs.items()}
+        else:
+            self._frozen.update((name, self.freeze_value(kwargs[name])) for name in names)
+        self.kwargs = kwargs
+        self.text = text
+        self.rendered = rendered
+        if formatter._span_count:
+            formatter.add_output(len(text))
+        return text
+
+
+class _PlanMissing(Exception):
+    """ The worker process has not received the compiled template yet. """
+
+
+# compiled templates of the parallel worker process by their plan ids, the least recently used are dropped above
+# the cache size of the worker formatter
+_worker_plans = OrderedDict()
+
+
+def _init_parallel_worker(formatter):
+    """ Initialize the worker process of the parallel formatter.
+
+    Args:
+        formatter (QueryFormatter): the formatter of the tasks, the parallel one renders serially in the worker process
+    """
+    global _worker_formatter
+    if isinstance(formatter, ParallelQueryFormatter):
+        formatter.parallel_threshold = None
+    _worker_formatter = formatter
+    _worker_plans.clear()
+
+
+def _get_worker_plan(plan):
+    """ Get the compiled template of the worker process by the plan id, the template is sent with the first tasks
+    of the plan only.
+
+    Args:
+        plan (tuple): the plan id, the template of "ParallelQueryFormatter.get_plan_data" or None and the ids of
+            the plans dropped by the parent process
+
+    Raises:
+        _PlanMissing: returned the exception when the template is required
+
+    Returns:
+        Template: compiled template
+    """
+    plan_id, data, dropped = plan
+    for dropped_id in dropped:
+        _worker_plans.pop(dropped_id, None)
+    template = _worker_plans.get(plan_id)
+    if template is not None:
+        _worker_plans.move_to_end(plan_id)
+        return template
+
+    if data is None:
+        raise _PlanMissing(plan_id)
+    if data.__class__ is not Template:
+        dumped, scope = data
+        data = load_template(dumped)
+        data.scope = scope
+    template = _worker_plans[plan_id] = data
+    if len(_worker_plans) > max(_worker_formatter.cache_size, 1):
+        _worker_plans.popitem(last=False)
+    return template
+
+
+def _format_batch_in_worker(plan, kwargs_chunk):
+    """ Format the template of the plan with every set of variables of the chunk.
+
+    Args:
+        plan (tuple): the plan id and the template or None
+        kwargs_chunk (list): dicts of named variables
+
+    Returns:
+        list: formatted texts
+    """
+    template = _get_worker_plan(plan)
+    return [_worker_formatter.vformat(template, (), kwargs) for kwargs in kwargs_chunk]
+
+
+def _repeat_in_worker(plan, separator, items, kwargs):
+    """ Render the repeated items of the chunk.
+
+    Args:
+        plan (tuple): the plan id and the template of the item or None
+        separator (str): separator of the items
+        items (list or dict): repeated items
+        kwargs (dict): named variables of the template
+
+    Returns:
+        str: rendered items
+    """
+    return _worker_formatter.render_repeat(_get_worker_plan(plan), separator, items, kwargs)
+
+
+class QueryFormatter(string.Formatter):
+    """ Format query string pattern by string literals as conditions. Child of the string.Formatter.
+
+    The formatter is thread-safe: one instance may be shared by threads formatting concurrently. Compiled templates
+    are cached under the lock, operands casted by the nodes are cached idempotently and every "format_params" call
+    collects its parameters separately. "register_directive" and attributes of the formatter are configuration,
+    they must not be changed while other threads format.
+
+        Attrs:
+            vformat, _vformat, get_field, format_field: have been redefined
+            others: new methods
+
+    """
+    # spec prefixes of the directives: the formatting function and the node class of the compiled template
+    directives = {
+        'include': (lambda self, value, spec, kwargs: self.format_include_value(value, kwargs), _Include),
+        'repeat:': (lambda self, value, spec, kwargs: self.format_repeat_value(value, spec, kwargs), _Repeat),
+        'in:': (lambda self, value, spec, kwargs: self.format_in_value(value, spec, is_contained=True), _In),
+        '!in:': (lambda self, value, spec, kwargs: self.format_in_value(value, spec, is_contained=False), _NotIn),
+        'exists:': (lambda self, value, spec, kwargs: self.format_exists_value(value, spec), _Exists),
+        '!exists:': (lambda self, value, spec, kwargs: self.format_not_exists_value(value, spec), _NotExists),
+        'eq:': (lambda self, value, spec, kwargs: self.format_eq_value(value, spec), _Eq),
+        '!eq:': (lambda self, value, spec, kwargs: self.format_not_eq_value(value, spec), _NotEq),
+        'gt:': (lambda self, value, spec, kwargs: self.format_gt_value(value, spec), _Gt),
+        'lt:': (lambda self, value, spec, kwargs: self.format_lt_value(value, spec), _Lt),
+        'if:': (lambda self, value, spec, kwargs: self.format_if_value(value, spec), _If),
+        '!if:': (lambda self, value, spec, kwargs: self.format_not_if_value(value, spec), _NotIf),
+        'tmpl': (lambda self, value, spec, kwargs: self.format_tmpl_value(value), _Tmpl),
+        'idf': (lambda self, value, spec, kwargs: self.format_field_name(value), _Idf),
+        'cond:': (lambda self, value, spec, kwargs: self.format_cond_value(value, spec), _Cond),
+        'copy:': (lambda self, value, spec, kwargs: self.format_copy_value(value, spec), _Copy)
+    }
+
+    # size of the chunks yielded by "iter_format"
+    chunk_size = 65536
+
+    # callbacks called with the statistics of every closed span
+    span_hooks = ()
+
+    # collapse the whitespace and drop the comments of the compiled templates
+    minify = False
+
+    # maximum depth of the nested templates of one scope
+    recursion_depth = 10
+
+    # hash of the structure of the rendering fed by the copy of the formatter of "format_fingerprint"
+    shape = None
+
+    def __init__(
+        self, escape_class=None, cache_size=256, registry=None, result_cache=None, minify=None, recursion_depth=None
+    ):
+        self.escape_class = escape_class
+        self.cache_size = cache_size
+        self.registry = registry
+        self.result_cache = result_cache
+        if minify is not None:
+            self.minify = minify
+        if recursion_depth is not None:
+            self.recursion_depth = recursion_depth
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._bare_prefixes = tuple(prefix for prefix in self.directives if not prefix.endswith(':'))
+        self._init_spans()
+        super(QueryFormatter, self).__init__()
+
+    def _init_spans(self):
+        # spans of every thread and the number of open spans of all threads
+        self._spans = threading.local()
+        self._span_lock = threading.Lock()
+        self._span_count = 0
+
+    def __getstate__(self):
+        """ Compiled templates, spans and locks are not pickled to be shared with other processes. """
+        state = self.__dict__.copy()
+        for name in ('_cache', '_cache_lock', '_spans', '_span_lock', '_span_count'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._init_spans()
+
+    def add_span_hook(self, hook):
+        """ Add the callback called with the statistics of every closed span, as example to forward them to
+        the tracing.
+
+        Args:
+            hook (callable): hook(stats) called with RenderStats
+        """
+        self.span_hooks = self.span_hooks + (hook,)
+
+    @contextmanager
+    def span(self, name=None):
+        """ Collect the statistics of the rendering in the current thread while the span is open. The statistics of
+        the nested span are added to the outer one. The rendering is not instrumented while there are no open spans.
+
+        Args:
+            name (str): name of the span
+
+        Yields:
+            RenderStats: statistics of the span
+        """
+        stats = RenderStats(name)
+        stack = self._spans.__dict__.setdefault('stack', [])
+        stack.append(stats)
+        with self._span_lock:
+            self._span_count += 1
+        started = perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.elapsed = perf_counter() - started
+            stack.pop()
+            with self._span_lock:
+                self._span_count -= 1
+            if stack:
+                stack[-1].merge(stats)
+            for hook in self.span_hooks:
+                hook(stats)
+
+    def get_span_stats(self):
+        """ Get the statistics of the innermost open span of the current thread.
+
+        Returns:
+            RenderStats: statistics of the span or None if there are no open spans in the thread
+        """
+        stack = getattr(self._spans, 'stack', None)
+        return stack[-1] if stack else None
+
+    def add_output(self, size):
+        """ Add the formatted text to the statistics of the open span.
+
+        Args:
+            size (int): number of characters of the text
+        """
+        stats = self.get_span_stats()
+        if stats is not None:
+            stats.formats += 1
+            stats.output_chars += size
+
+    def register_directive(self, prefix, handler):
+        """ Register the custom directive of the format spec for this formatter.
+
+        Args:
+            prefix (str): spec prefix of the directive, as example "between:". Prefix without the colon at the end
+                matches any spec starting with it as "tmpl" or "idf" do
+            handler (callable): formatting function handler(formatter, value, spec, kwargs) returning the tuple of
+                the text and the flag whether the text is already formatted. Not formatted text is expanded as
+                the template
+
+        Raises:
+            ValueError: returned the exception when the prefix is empty
+        """
+        if not prefix or not isinstance(prefix, str):
+            raise ValueError(f'Invalid directive prefix "{prefix}"')
+
+        self.directives = dict(self.directives, **{prefix: (handler, _Directive)})
+        self._bare_prefixes = tuple(prefix for prefix in self.directives if not prefix.endswith(':'))
+        # compiled templates refer to the previous directives
+        self.clear_cache()
+
+    def get_directive(self, spec):
+        """ Find the directive of the spec by its prefix.
+
+        Args:
+            spec (str): string literals separated by :
+
+        Returns:
+            tuple: the formatting function and the node class or None for the default formatting
+        """
+        prefix, colon, _ = spec.partition(':')
+        directive = self.directives.get(prefix + colon)
+        if directive is None and spec:
+            for prefix in self._bare_prefixes:
+                if spec.startswith(prefix):
+                    return self.directives[prefix]
+        return directive
+
+    def compile(self, format_string):
+        """ Compile the template to the reusable plan. Plans are kept in the LRU cache keyed by template text.
+
+        Args:
+            format_string (str or Template): template text or already compiled template
+
+        Returns:
+            Template: compiled template
+        """
+        if isinstance(format_string, Template):
+            return format_string
+
+        with self._cache_lock:
+            template = self._cache.get(format_string)
+            if template is not None:
+                self._cache.move_to_end(format_string)
+                return template
+
+        template = self.compile_body(format_string)
+        if template.error is not None:
+            raise template.error
+
+        with self._cache_lock:
+            self._cache[format_string] = template
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return template
+
+    def get_template(self, name):
+        """ Get the compiled template of the registry by its name.
+
+        Args:
+            name (str): name of the template
+
+        Raises:
+            ValueError: returned the exception when the formatter has no registry or the template is not found
+
+        Returns:
+            Template: compiled template
+        """
+        if self.registry is None:
+            raise ValueError(f'Template "{name}" not found, the formatter has no registry')
+        return self.compile(self.registry.get(name))
+
+    def clear_cache(self):
+        """ Drop all compiled templates from the cache. """
+        with self._cache_lock:
+            self._cache.clear()
+
+    def add_templates(self, templates):
+        """ Put the templates compiled before to the cache, as the templates of the precompiled cache file. The size
+        of the cache grows to keep all of them.
+
+        Args:
+            templates (dict): compiled templates by their texts
+        """
+        with self._cache_lock:
+            self._cache.update(templates)
+            self.cache_size = max(self.cache_size, len(self._cache))
+
+    def compile_body(self, format_string):
+        """ Compile the template bypassing the cache, the template is minified in the minify mode. Parsing errors are
+        deferred until the template is rendered.
+
+        Args:
+            format_string (str): template text
+
+        Returns:
+            Template: compiled template
+        """
+        template = self.parse_template(format_string)
+        if self.minify:
+            # the template which can't be minified safely is kept as it is
+            template = minify_template(template) or template
+        return template
+
+    def parse_template(self, format_string):
+        """ Parse the template to the compiled template without minifying.
+
+        Args:
+            format_string (str): template text
+
+        Returns:
+            Template: compiled template
+        """
+        nodes = []
+        try:
+            for literal_text, field_name, format_spec, transform in self.parse(format_string):
+                if literal_text:
+                    # merge literal text split by escaped braces
+                    if nodes and nodes[-1].__class__ is str:
+                        nodes[-1] += literal_text
+                    else:
+                        nodes.append(literal_text)
+
+                if field_name is not None:
+                    nodes.append(self.compile_field(field_name, transform, format_spec))
+        except (ValueError, TypeError) as ex:
+            return Template(format_string, (), ex)
+
+        return Template(format_string, tuple(nodes))
+
+    def compile_field(self, field_name, conversion, spec):
+        """ Compile the field to the node by the directive of the spec.
+
+        Args:
+            field_name (str): name of the variable
+            conversion (str): conversion of the value
+            spec (str): string literals separated by :
+
+        Returns:
+            _Field: compiled node
+        """
+        formatter_class = type(self)
+        if formatter_class.format_field is not QueryFormatter.format_field:
+            return _GenericField(field_name, conversion, spec)
+
+        directive = self.get_directive(spec)
+        if directive is None:
+            return _Field(field_name, conversion, spec)
+
+        handler, node_class = directive
+        if node_class is _Directive:
+            return _Directive(field_name, conversion, spec, handler)
+        if any(
+            getattr(formatter_class, name) is not getattr(QueryFormatter, name) for name in node_class.bypassed
+        ):
+            # the redefined formatting method is called by "format_field"
+            return _GenericField(field_name, conversion, spec)
+        return node_class.build(self, field_name, conversion, spec)
+
+    def vformat(self, format_string, args, kwargs):
+        """ Redifined and num recursion depth increased to 10. The template is compiled once and cached. """
+        template = self.compile(format_string)
+        result_cache = self.result_cache
+        key = None if result_cache is None else result_cache.make_key(template, args, kwargs, self.registry)
+        if key is None:
+            result = self.render_text(template, self.memo_scope(template, kwargs), args)
+        else:
+            result = result_cache.get(key)
+            if result is None:
+                result = self.render_text(template, kwargs, args)
+                result_cache.put(key, result)
+
+        if self._span_count:
+            self.add_output(len(result))
+        return result
 
-    Raises:
-        ValueError: returned the exception when "to_type" is not in the whitelist
+    @staticmethod
+    def memo_scope(template, kwargs):
+        """ Get the variables of the rendering calling the callable values once. The variables are wrapped only if
+        the template references callables.
 
-    Returns:
-        any type: casted value of a variable
-    """
-    cast_type_func = {
-        to_type == 'str': lambda: value,
-        to_type == 'int': lambda: int(value),
-        to_type == 'date': lambda: datetime.strptime(value, '%Y-%m-%d') ,
-        to_type == 'datetime': lambda: datetime.strptime(value, '%Y-%m-%d %H:%M:%S'),
-        to_type == 'time': lambda: datetime.strptime(value, '%H:%M:%S'),
-        to_type == 'bool' and value == 'True': lambda: True,
-        to_type == 'bool' and value == 'False': lambda: False,
-        to_type == 'NoneType': lambda: None if value == 'None' else value
-    }.get(True)
+        Args:
+            template (Template): compiled template
+            kwargs (mapping): named variables
 
-    # whitelist validation strategy
-    if cast_type_func is None:
-        raise ValueError(f'Could not cast "{value}" to type "{to_type}"')
+        Returns:
+            mapping: named variables
+        """
+        names = template_names(template)
+        values = kwargs.values() if names is None else map(kwargs.get, names)
+        if any(map(callable, values)):
+            return _MemoScope(kwargs)
+        return kwargs
+
+    async def format_async(self, format_string, *args, **kwargs):
+        """ Format the template resolving the callable and awaitable variables concurrently. The variables referenced
+        by the branches taken with the values known so far are resolved together by "asyncio.gather", the rounds are
+        repeated while the resolved values open new branches. Variables of the branches not taken are never called
+        or awaited. Callables of the scopes of repeated items and dynamic templates are called while rendering.
 
-    return cast_type_func()
+        Args:
+            format_string (str or Template): template text or compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables, coroutine functions, other callables and awaitables are resolved
 
+        Returns:
+            str: formatted text
+        """
+        template = self.compile(format_string)
+        resolved = {}
+        scope = ChainMap(resolved, kwargs)
+        while True:
+            names = []
+            self.find_pending(template, scope, scope, names, self.recursion_depth)
+            if not names:
+                break
+            values = await asyncio.gather(*(self.resolve_async(kwargs[name]) for name in names))
+            resolved.update(zip(names, values))
+        return self.vformat(template, args, scope)
 
-class SqlEscaper:
-    """ Isolate and sqlize the value before executing.
+    @staticmethod
+    async def resolve_async(value):
+        """ Call the callable value and await the awaitable result.
 
-    """
-    @classmethod
-    def escape_literal(cls, value):
-        """ Isolate unsupported values by raising an exception. Sqlize the value with specified type.
+        Args:
+            value (any type): the value of the variable
+
+        Returns:
+            any type: resolved value
+        """
+        if callable(value):
+            value = value()
+        if inspect.isawaitable(value):
+            value = await value
+        return value
+
+    def find_pending(self, template, kwargs, root_kwargs, names, recursion_depth):
+        """ Find the callable and awaitable variables referenced by the branches of the template taken with
+        the values known so far. Conditions with the pending values are not expanded.
 
         Args:
-            value (any type): the value of the variable to sqlize
+            template (Template): compiled template
+            kwargs (mapping): named variables of the scope
+            root_kwargs (mapping): named variables of the template, only they are resolved
+            names (list): names of the found variables, appended in order of appearance
+            recursion_depth (int): remaining depth of nested templates
+        """
+        if recursion_depth < 0 or template.error is not None:
+            return
+        if template.scope is not None:
+            kwargs = child_scope(kwargs, template.scope)
+
+        for node in template.nodes:
+            if node.__class__ is str:
+                continue
+            if node.__class__ is Template:
+                self.find_pending(node, kwargs, root_kwargs, names, recursion_depth - 1)
+                continue
+            if node.is_positional:
+                continue
+
+            name = _string.formatter_field_name_split(node.field_name)[0]
+            value = kwargs.get(name)
+            if callable(value) or inspect.isawaitable(value):
+                if name not in names and value is root_kwargs.get(name):
+                    names.append(name)
+                continue
+
+            node_class = node.__class__
+            if isinstance(node, _Condition):
+                try:
+                    value = self.get_field(node.field_name, (), kwargs)[0]
+                    body = node.evaluate(self, self.convert_field(value, node.conversion), kwargs)
+                except Exception:
+                    # the field fails while rendering
+                    continue
+                self.find_pending(body, kwargs, root_kwargs, names, recursion_depth - 1)
+            elif node_class is _Include:
+                try:
+                    value = self.get_field(node.field_name, (), kwargs)[0]
+                    included, scope = node.get_scope(self, value, kwargs)
+                except Exception:
+                    continue
+                self.find_pending(included, scope, root_kwargs, names, recursion_depth - 1)
+            elif node_class is _Repeat and isinstance(value, (list, tuple, dict)):
+                body_names = template_names(node.body)
+                if body_names is not None and not any(
+                    callable(root_kwargs.get(body_name)) or inspect.isawaitable(root_kwargs.get(body_name))
+                    for body_name in body_names - {'item', 'key'}
+                ):
+                    continue
+                # the branches of the body depend on the items, iterators are not consumed before rendering
+                scope = {}
+                item_kwargs = child_scope(kwargs, scope)
+                if isinstance(value, dict):
+                    for key, item in value.items():
+                        scope['item'] = item
+                        scope['key'] = key
+                        self.find_pending(node.body, item_kwargs, root_kwargs, names, recursion_depth - 1)
+                else:
+                    for item in value:
+                        scope['item'] = item
+                        self.find_pending(node.body, item_kwargs, root_kwargs, names, recursion_depth - 1)
+
+    def specialize(self, format_string, **static_kwargs):
+        """ Evaluate the fields of the template depending on the static variables only and drop the branches not
+        taken. Rendering the residual template with other variables gives the same text as the whole template does
+        with all variables. Static variables are bound to the residual template and override the passed ones.
+        Callable values, custom directives and the fields failing to evaluate are left to the rendering.
+
+        Args:
+            format_string (str or Template): template text or compiled template
+            static_kwargs (dict): static named variables
+
+        Returns:
+            Template: residual compiled template
+        """
+        template = self.compile(format_string)
+        if template.scope is not None:
+            static_kwargs = dict(static_kwargs, **template.scope)
+
+        residual = self.specialize_template(template, static_kwargs, self.recursion_depth)
+        names = template_names(residual)
+        if names is None or not names.isdisjoint(static_kwargs):
+            residual.scope = static_kwargs
+        return residual
+
+    def specialize_template(self, template, static_kwargs, recursion_depth):
+        """ Specialize the nodes of the compiled template.
+
+        Args:
+            template (Template): compiled template
+            static_kwargs (dict): static named variables
+            recursion_depth (int): remaining depth of nested templates
+
+        Returns:
+            Template: residual compiled template
+        """
+        nodes = []
+        for node in template.nodes:
+            if node.__class__ is not str and node.__class__ is not Template:
+                node = self.specialize_node(node, static_kwargs, recursion_depth)
+            if node.__class__ is Template and node.scope is None and all(
+                item.__class__ is str for item in node.nodes
+            ):
+                # the branch of the literal text only is inlined
+                node = ''.join(node.nodes)
+            if node.__class__ is str:
+                if not node:
+                    continue
+                if nodes and nodes[-1].__class__ is str:
+                    nodes[-1] += node
+                    continue
+            nodes.append(node)
+        return Template(template.source, tuple(nodes))
+
+    def specialize_node(self, node, static_kwargs, recursion_depth):
+        """ Specialize the field node: evaluate it if the value is static, specialize the nested template of
+        the condition otherwise.
+
+        Args:
+            node (_Field): field node
+            static_kwargs (dict): static named variables
+            recursion_depth (int): remaining depth of the template of the node
+
+        Returns:
+            str, Template or _Field: literal text, residual nested template or the node to render
+        """
+        node_class = node.__class__
+        if node.is_positional or node_class is _GenericField or node_class is _Directive:
+            return node
+        # nested templates exceeding the depth fail while rendering
+        nested_depth = recursion_depth - 1
+
+        if _string.formatter_field_name_split(node.field_name)[0] not in static_kwargs:
+            if not isinstance(node, _Condition) or node.body.error is not None or nested_depth < 0:
+                return node
+            residual = copy.copy(node)
+            residual.body = self.specialize_template(node.body, static_kwargs, nested_depth)
+            return residual
+
+        value = self.get_field(node.field_name, (), static_kwargs)[0]
+        if callable(value):
+            return node
+        if node_class is _Include or node_class is _Repeat:
+            # the included text is static if all its variables are static
+            try:
+                body = node.body if node_class is _Repeat else node.get_scope(self, value, static_kwargs)[0]
+            except Exception:
+                return node
+            names = template_names(body)
+            if names is None or any(
+                name not in static_kwargs or callable(static_kwargs[name])
+                for name in (names - {'item', 'key'} if node_class is _Repeat else names)
+            ):
+                return node
+
+        try:
+            field_item = node.evaluate(self, self.convert_field(value, node.conversion), static_kwargs)
+        except Exception:
+            return node
+
+        if field_item.__class__ is Template:
+            if field_item.error is not None or nested_depth < 0:
+                return node
+            return self.specialize_template(field_item, static_kwargs, nested_depth)
+        return field_item
+
+    def format_params(self, format_string, *args, **kwargs):
+        """ Format the template with the values as bind parameters instead of inlined literals. Directives are
+        formatted as usual. Placeholders are configured by "ParamEscaper" of the formatter, the default one is
+        used by other formatters.
+
+        Args:
+            format_string (str or Template): template text or compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables
+
+        Returns:
+            tuple: formatted text with placeholders and the list (dict for "named" paramstyle) of parameters
+        """
+        escaper = self.escape_class if isinstance(self.escape_class, ParamEscaper) else ParamEscaper()
+        escaper = escaper.bind()
+
+        # the copy of the formatter shares compiled templates
+        formatter = object.__new__(type(self))
+        formatter.__dict__ = dict(self.__dict__, escape_class=escaper, result_cache=None)
+        return escaper.finalize(formatter.vformat(format_string, args, kwargs)), escaper.params
+
+    def format_fingerprint(self, format_string, *args, **kwargs):
+        """ Format the template with the fingerprint of the query shape. The fingerprint is computed while rendering
+        from the compiled templates, the branches taken by the conditions, the numbers of the repeated items and
+        the included templates, identifiers and template values, literal values don't change it. Repeats are
+        rendered in place and the result cache is not used.
+
+        Args:
+            format_string (str or Template): template text or compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables
+
+        Returns:
+            tuple: formatted text and the fingerprint of 16 hexadecimal digits
+        """
+        template = self.compile(format_string)
+        shape = hashlib.blake2b(template_digest(template), digest_size=8)
+
+        # the copy of the formatter shares compiled templates
+        formatter = object.__new__(type(self))
+        formatter.__dict__ = dict(self.__dict__, shape=shape, result_cache=None)
+        return formatter.vformat(template, args, kwargs), shape.hexdigest()
+
+    def update_shape(self, shape, node, value, field_item):
+        """ Feed the structure of the evaluated field to the hash of the shape.
+
+        Args:
+            shape (hashlib.blake2b): hash of the shape
+            node (_Field): field node
+            value (any type): the value of the variable
+            field_item (str, Template, tuple or iterator): evaluated field
+        """
+        node_class = node.__class__
+        if isinstance(node, _Condition):
+            shape.update(b'0' if field_item is EMPTY_TEMPLATE else b'1')
+        elif node_class is _Repeat:
+            # the items of the repeat are fed by their fields
+            shape.update(b'r%d;' % len(value) if hasattr(value, '__len__') else b'r;')
+        elif node_class is _Include:
+            if field_item.__class__ is not tuple:
+                field_item = node.get_scope(self, value, {})
+            shape.update(b'i' + template_digest(field_item[0]))
+        elif node_class is _Cond:
+            escape_class = self.escape_class or SqlEscaper
+            if value is None:
+                shape.update(b'cn')
+            elif not isinstance(value, escape_class.collection_types):
+                shape.update(b'cv')
+            else:
+                threshold = escape_class.array_threshold
+                shape.update(b'ca' if threshold is not None and len(value) > threshold else b'cl')
+        elif node_class in (_Tmpl, _Idf, _Copy):
+            shape.update(b't' + hashlib.blake2b(field_item.encode('utf-8', 'surrogatepass'), digest_size=8).digest())
+        elif field_item.__class__ is Template:
+            # the template of the registered directive
+            shape.update(b'd' + template_digest(field_item))
+
+    def format_values(self, format_string, columns, rows, max_rows=1000, max_bytes=None, **kwargs):
+        """ Format the bulk statement with the rows split into chunks, as "INSERT INTO t ({columns}) VALUES {values}".
+        The template is formatted once, the "{values}" field is replaced with the rows of the chunk and the
+        "{columns}" field with the quoted column names. Values are sqlized as literals by the functions chosen
+        once from the types of the first row.
+
+        Args:
+            format_string (str or Template): template of the statement
+            columns (sequence): names of the columns
+            rows (iterable): sequences of the column values
+            max_rows (int): maximum number of rows in one statement
+            max_bytes (int): maximum size of one statement in UTF-8 bytes, not limited by default
+            kwargs (dict): named variables of the template
 
         Raises:
-            ValueError: returned the exception when "type_name" is not in the whitelist
+            ValueError: returned the exception when the row doesn't match the columns or doesn't fit "max_bytes" or
+                the escaper of the formatter collects bind parameters
+
+        Yields:
+            str: formatted statement for every chunk of the rows
+        """
+        escape_class = self.escape_class or SqlEscaper
+        if isinstance(escape_class, ParamEscaper):
+            raise ValueError('Rows of the bulk statement are sqlized as literals, "ParamEscaper" is not supported')
+        marker = '\x00'
+        columns_text = ', '.join(self.format_field_name(column)[0] for column in columns)
+
+        def substitute(template):
+            # the fields of the columns and the rows are substituted in the template and its nested templates
+            nodes = []
+            for node in template.nodes:
+                if node.__class__ is Template:
+                    node = substitute(node)
+                elif node.__class__ is not str and node.field_name in ('columns', 'values') and not node.spec:
+                    node = columns_text if node.field_name == 'columns' else marker
+                nodes.append(node)
+            return Template(template.source, tuple(nodes), template.error, template.scope)
+
+        template = substitute(self.compile(format_string))
+        prefix, found, suffix = self.vformat(template, (), kwargs).partition(marker)
+        if not found or marker in suffix:
+            raise ValueError('Template of the bulk statement must contain the "{values}" field once')
+
+        base_size = len((prefix + suffix).encode())
+        if max_bytes is not None and base_size >= max_bytes:
+            raise ValueError(f'Template of the bulk statement exceeds {max_bytes} bytes')
+
+        row_funcs = None
+        chunk = []
+        size = base_size
+        for row in rows:
+            if len(row) != len(columns):
+                raise ValueError(f'Row {row!r} has {len(row)} values instead of {len(columns)}')
+            if row_funcs is None:
+                row_funcs = escape_class.get_row_funcs(row)
+
+            row_text = escape_class.escape_row(row, row_funcs)
+            if max_bytes is not None:
+                row_size = len(row_text) if row_text.isascii() else len(row_text.encode())
+                if base_size + row_size > max_bytes:
+                    raise ValueError(f'Row {row!r} exceeds {max_bytes} bytes of the statement')
+                if chunk and size + 2 + row_size > max_bytes:
+                    yield prefix + ', '.join(chunk) + suffix
+                    chunk = []
+                    size = base_size
+                size += row_size + 2 if chunk else row_size
+
+            chunk.append(row_text)
+            if len(chunk) >= max_rows:
+                yield prefix + ', '.join(chunk) + suffix
+                chunk = []
+                size = base_size
+
+        if chunk:
+            yield prefix + ', '.join(chunk) + suffix
+
+    def format_many(self, format_string, kwargs_list, chunksize=None, max_workers=None):
+        """ Format the template with every set of variables. The template is compiled once for the whole batch and
+        the sets are formatted lazily.
+
+        Args:
+            format_string (str or Template): template text or compiled template
+            kwargs_list (iterable): dicts of named variables
+            chunksize (int): the batch is formatted by the pool of "ParallelQueryFormatter" in chunks of this size if
+                it is specified, the number of running chunks is limited. The formatter, the template and
+                the variables must be picklable then
+            max_workers (int): number of processes of the pool, number of CPUs by default
+
+        Yields:
+            str: formatted text for every set of variables in the same order
+        """
+        if chunksize is None:
+            template = self.compile(format_string)
+            for kwargs in kwargs_list:
+                yield self.vformat(template, (), kwargs)
+            return
+
+        template = self.compile(format_string)
+        # the chunks are rendered by this formatter in the workers of the temporary pool
+        with ParallelQueryFormatter(max_workers=max_workers, chunksize=chunksize, parallel_threshold=None) as pool:
+            pool.worker_formatter = self
+            yield from pool.format_many(template, kwargs_list)
+
+    def iter_format(self, format_string, *args, **kwargs):
+        """ Format the template to the iterator of chunks without building the whole text in memory. Small chunks
+        are joined up to "chunk_size" characters.
+
+        Args:
+            format_string (str or Template): template text or compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables
+
+        Yields:
+            str: chunk of the formatted text
+        """
+        chunk_size = self.chunk_size
+        buffer = []
+        buffer_size = 0
+        size = 0
+        template = self.compile(format_string)
+        for chunk in self.render_scope(template, self.memo_scope(template, kwargs), args, stream=True):
+            buffer.append(chunk)
+            buffer_size += len(chunk)
+            if buffer_size >= chunk_size:
+                yield ''.join(buffer)
+                size += buffer_size
+                buffer = []
+                buffer_size = 0
+
+        if buffer:
+            yield ''.join(buffer)
+            size += buffer_size
+        if self._span_count:
+            self.add_output(size)
+
+    def format_to(self, sink, format_string, *args, **kwargs):
+        """ Format the template writing the chunks of the text to the sink.
+
+        Args:
+            sink (file-like): text file, io.StringIO or any object with the "write" method
+            format_string (str or Template): template text or compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables
 
         Returns:
-            str: sqlized value in the string
+            int: number of written characters
         """
-        type_name = type(value).__name__
-        escape_literal_func = {
-            type_name == 'NoneType': lambda: 'NULL',
-            type_name in ('int', 'bool'): lambda: str(value),
-            type_name == 'date': lambda: f"'{value}'::date",
-            type_name == 'datetime': lambda: f"'{value}'::timestamp",
-            type_name == 'time': lambda: f"'{value}'::time",
-            type_name == 'UUID': lambda: f"'{value}'::uuid",
-            type_name == 'str': lambda: value.replace("'", "''"),
-            type_name in ('list', 'tuple', 'set'): lambda: ', '.join([cls.escape_literal(item) for item in value])
-        }.get(True)
+        write = sink.write
+        size = 0
+        for chunk in self.iter_format(format_string, *args, **kwargs):
+            write(chunk)
+            size += len(chunk)
+        return size
 
-        if escape_literal_func is None:
-            raise ValueError(f'Type "{value}" unsupported yet')
+    def render_session(self, format_string, *args, **kwargs):
+        """ Start the rendering session of the template, "update" of the session re-renders only the top-level
+        segments reading the changed variables.
+
+        Args:
+            format_string (str or Template): template text or compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables
 
-        return escape_literal_func()
+        Returns:
+            RenderSession: the session with the formatted text
+        """
+        return RenderSession(self, format_string, args, kwargs)
 
-    @classmethod
-    def get_condition(cls, value, condition):
-        """ Build the string with condition and sqlized value.
+    def render_item(self, template, kwargs):
+        """ Render the compiled template of the included or repeated item.
 
         Args:
-            value (any type): the value of the variable to sqlize
-            condition (str): sql expression, the part of predicate as example
+            template (Template): compiled template
+            kwargs (mapping): named variables of the item scope
 
         Returns:
-            str: result sql expression
+            str: rendered item
         """
-        type_name = type(value).__name__
-        if type_name == 'NoneType':
-            res = 'IS NULL'
+        return self.render_text(template, kwargs)
+
+    def is_inline_repeat(self, value):
+        """ Check that the repeated items are evaluated in place with the template. Formatters rendering the repeats
+        by "render_repeat" in other ways redefine it.
+
+        Args:
+            value (iterable): repeated items
+
+        Returns:
+            bool: the items are evaluated in place
+        """
+        return True
+
+    def render_repeat(self, body, separator, value, kwargs):
+        """ Render the compiled template of the repeated item for every item.
+
+        Args:
+            body (Template): compiled template of the item
+            separator (str): separator of the items
+            value (iterable): repeated items, items of the dict are repeated with their keys
+            kwargs (mapping): named variables of the template
+
+        Returns:
+            str: rendered items
+        """
+        # the scope of the item is reused by every iteration instead of copying kwargs
+        scope = {}
+        item_kwargs = child_scope(kwargs, scope)
+        res_list = []
+
+        if isinstance(value, dict):
+            for key, item in value.items():
+                scope['item'] = item
+                scope['key'] = key
+                res_list.append(self.render_item(body, item_kwargs))
         else:
-            res = cls.escape_literal(value)
+            for item in value:
+                scope['item'] = item
+                res_list.append(self.render_item(body, item_kwargs))
 
-        return f'{condition} {res}'
+        return separator.join(res_list)
 
+    def render_scope(self, template, kwargs, args=(), stream=False):
+        """ Render the compiled template to the chunks as the separate "vformat" call does.
 
-class QueryFormatter(string.Formatter):
-    """ Format query string pattern by string literals as conditions. Child of the string.Formatter.
+        Args:
+            template (Template): compiled template
+            kwargs (mapping): named variables
+            args (tuple): positional variables
+            stream (bool): included and repeated templates are streamed by chunks instead of joining every item
 
-        Attrs:
-            vformat, _vformat, get_field, format_field: have been redefined
-            others: new methods
+        Yields:
+            str: chunk of the formatted text
+        """
+        if template.scope is not None:
+            kwargs = child_scope(kwargs, template.scope)
+        used_args = set()
+        yield from self._render(template, args, kwargs, used_args, self.recursion_depth, stream)
+        self.check_unused_args(used_args, args, kwargs)
 
-    """
-    def __init__(self, escape_class=None):
-        self.escape_class = escape_class
-        super(QueryFormatter, self).__init__()
+    def render_text(self, template, kwargs, args=()):
+        """ Render the compiled template to the text as the separate "vformat" call does.
 
-    def vformat(self, format_string, args, kwargs):
-        """ Redifined and num recursion depth increased to 10. """
+        Args:
+            template (Template): compiled template
+            kwargs (mapping): named variables
+            args (tuple): positional variables
+
+        Returns:
+            str: formatted text
+        """
+        if template.scope is not None:
+            kwargs = child_scope(kwargs, template.scope)
         used_args = set()
-        result, _ = self._vformat(format_string, args, kwargs, used_args, 10)
+        out = []
+        text = self.join_evaluation(
+            self._evaluate(template, args, kwargs, used_args, self.recursion_depth, out, False), out
+        )[0]
         self.check_unused_args(used_args, args, kwargs)
-        return result
+        return text
+
+    @staticmethod
+    def join_evaluation(evaluation, out):
+        """ Run the evaluation to the end, the flushed buffer is joined to the parts of the text.
+
+        Args:
+            evaluation (generator): the evaluation of the template
+            out (list): the buffer of the evaluation
+
+        Returns:
+            tuple: formatted text and index of automatic field numbering
+        """
+        parts = []
+        while True:
+            try:
+                next(evaluation)
+            except StopIteration as stop:
+                parts.append(''.join(out))
+                return ''.join(parts), stop.value
+            parts.append(''.join(out))
+            out.clear()
 
     def _vformat(self, format_string, args, kwargs, used_args, recursion_depth, auto_arg_index=0):
         """ Redifined with exception handling during variable processing. Also, the method is prettier. """
-        if recursion_depth < 0:
-            raise ValueError('Max string recursion exceeded')
+        out = []
+        return self.join_evaluation(self._evaluate(
+            self.compile(format_string), args, kwargs, used_args, recursion_depth, out, False, auto_arg_index
+        ), out)
 
-        result = []
-        for literal_text, field_name, format_spec, transform in self.parse(format_string):
+    def _render(self, template, args, kwargs, used_args, recursion_depth, stream, auto_arg_index=0):
+        """ Render the compiled template to the chunks of the text.
 
-            # add the literal text
-            if literal_text:
-                result.append(literal_text)
+        Args:
+            template (Template): compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables
+            used_args (set): names of used variables
+            recursion_depth (int): remaining depth of nested templates
+            stream (bool): included and repeated templates are streamed by chunks
+            auto_arg_index (int or bool): index of automatic field numbering
 
-            #  skip iteration if aint no value of a field
-            if field_name is None:
-                continue
+        Yields:
+            str: chunk of the formatted text
 
-            # handle arg indexing when empty field_names are given.
-            if (
-                field_name == '' and auto_arg_index is False or
-                field_name.isdigit() and auto_arg_index
-            ):
-                raise ValueError(
-                    'cannot switch from manual field '
-                    'specification to automatic field '
-                    'numbering'
-                )
+        Returns:
+            int or bool: index of automatic field numbering
+        """
+        out = []
+        evaluation = self._evaluate(template, args, kwargs, used_args, recursion_depth, out, stream, auto_arg_index)
+        while True:
+            try:
+                next(evaluation)
+            except StopIteration as stop:
+                yield from out
+                return stop.value
+            yield from out
+            out.clear()
+
+    def _evaluate(self, template, args, kwargs, used_args, recursion_depth, out, stream, auto_arg_index=0):
+        """ Evaluate the compiled template appending the chunks of the text to the shared buffer. Nested templates,
+        included templates and repeated items are evaluated on the explicit stack of frames instead of recursive
+        calls. Included templates and repeated items get their own scopes as the separate "render_scope" calls do.
 
-            if field_name == '':
-                field_name = str(auto_arg_index)
-                auto_arg_index += 1
-            elif field_name.isdigit():
-                # disable auto incrementing of arg is digit
-                # used later on, then an exception will be raised
-                auto_arg_index = False
+        Args:
+            template (Template): compiled template
+            args (tuple): positional variables
+            kwargs (dict): named variables
+            used_args (set): names of used variables
+            recursion_depth (int): remaining depth of nested templates
+            out (list): the buffer of the chunks of the text
+            stream (bool): included and repeated templates are streamed by chunks
+            auto_arg_index (int or bool): index of automatic field numbering
 
-            # find the object by the field_name reference
-            # define the used argument or not
-            obj, arg_used = self.get_field(field_name, args, kwargs)
-            used_args.add(arg_used)
+        Raises:
+            ValueError: returned the exception when the nesting is too deep or the field fails
 
-            # do the object converting by the transform value
-            obj = self.convert_field(obj, transform)
+        Yields:
+            None: the buffer is ready to be flushed
 
-            try:
-                format_spec, already_formatted = self.format_field(obj, format_spec, kwargs)
-            except Exception as ex:
-                raise ValueError(
-                    f'Error during processing variable "{field_name}" with value "{obj}" in template:\n{format_string}'
-                ) from ex
-
-            if not already_formatted:
-                # expand the format specification if this is a collection
-                format_spec, auto_arg_index = self._vformat(
-                    format_spec,
-                    args,
-                    kwargs,
-                    used_args,
-                    recursion_depth-1,
-                    auto_arg_index=auto_arg_index
-                )
+        Returns:
+            int or bool: index of automatic field numbering
+        """
+        append = out.append
+        max_depth = self.recursion_depth
+        # included templates reset the depth, their nesting is limited as the recursion of the calls
+        max_frames = sys.getrecursionlimit()
+        escape_literal = None if self.escape_class is None else self.escape_class.escape_literal
+        formatter_class = self.__class__
+        # the values of simple names are taken and the default fields are formatted in place unless it is redefined
+        plain_fields = (
+            formatter_class.get_field is QueryFormatter.get_field and
+            formatter_class.get_value is string.Formatter.get_value and
+            formatter_class.convert_field is string.Formatter.convert_field
+        )
+        plain_defaults = formatter_class.format_default_value is QueryFormatter.format_default_value
+        # the rendering is instrumented while the span is open
+        stats = self._span_count and self.get_span_stats()
+        shape = self.shape
+
+        # frames of the parents: kind, nodes, template, depth, owner field, args, kwargs, used_args and
+        # auto_arg_index; the frame of repeated items is the list: kind, items, body, separator, owner field, scope,
+        # variables of the items, flag of the dict and flag of the started items
+        stack = []
+        kind = _NESTED_FRAME
+        # the field of the parent template expanded by the frame, the exceptions are wrapped by it
+        owner = None
+        nodes = None
+        try:
+            while True:
+                if nodes is None:
+                    # start the template of the frame
+                    if recursion_depth < 0 or len(stack) > max_frames:
+                        raise ValueError('Max string recursion exceeded')
+                    if template.error is not None:
+                        # the parsing error of the nested template
+                        raise template.error.__class__(*template.error.args)
+                    if stats:
+                        stats.renders += 1
+                        stats.max_depth = max(stats.max_depth, max_depth - recursion_depth)
+                    nodes = iter(template.nodes)
+
+                for node in nodes:
+                    node_class = node.__class__
+
+                    # add the literal text
+                    if node_class is str:
+                        append(node)
+                        continue
+
+                    if node_class is Template:
+                        # expand the nested template of the specialized branch
+                        stack.append((kind, nodes, template, recursion_depth, owner, args, kwargs, used_args, 0))
+                        kind, template, recursion_depth, owner, nodes = (
+                            _NESTED_FRAME, node, recursion_depth - 1, None, None
+                        )
+                        break
+
+                    field_name = node.field_name
+                    if node.is_positional:
+                        # handle arg indexing when empty field_names are given.
+                        if (
+                            field_name == '' and auto_arg_index is False or
+                            field_name.isdigit() and auto_arg_index
+                        ):
+                            raise ValueError(
+                                'cannot switch from manual field '
+                                'specification to automatic field '
+                                'numbering'
+                            )
+
+                        if field_name == '':
+                            field_name = str(auto_arg_index)
+                            auto_arg_index += 1
+                        else:
+                            # disable auto incrementing of arg is digit
+                            # used later on, then an exception will be raised
+                            auto_arg_index = False
+
+                    # find the object by the field_name reference
+                    # define the used argument or not
+                    if plain_fields and node.is_simple:
+                        try:
+                            obj = kwargs[field_name]
+                        except KeyError:
+                            obj = None
+                        used_args.add(field_name)
+                        if node.conversion is not None:
+                            obj = self.convert_field(obj, node.conversion)
+                    else:
+                        obj, arg_used = self.get_field(field_name, args, kwargs)
+                        used_args.add(arg_used)
+
+                        # do the object converting by the transform value
+                        obj = self.convert_field(obj, node.conversion)
+
+                    try:
+                        if stats:
+                            field_item = self.evaluate_traced(node, obj, kwargs, stream, stats)
+                        elif node_class is _Field and plain_defaults and not node.spec:
+                            # the default formatting in place
+                            if callable(obj):
+                                obj = obj()
+                            field_item = obj if escape_literal is None else escape_literal(obj)
+                            append(field_item if field_item.__class__ is str else format(field_item, ''))
+                            continue
+                        elif node_class is _Include:
+                            if callable(obj):
+                                obj = obj()
+                            field_item = node.get_scope(self, obj, kwargs)
+                        elif node_class is _Repeat:
+                            if callable(obj):
+                                obj = obj()
+                            if not obj:
+                                if shape is not None:
+                                    self.update_shape(shape, node, obj, EMPTY_TEMPLATE)
+                                continue
+                            if not stream and not self.is_inline_repeat(obj):
+                                field_item = node.evaluate(self, obj, kwargs)
+                            else:
+                                field_item = iter(obj.items() if isinstance(obj, dict) else obj)
+                        else:
+                            field_item = node.stream(self, obj, kwargs) if stream else node.evaluate(self, obj, kwargs)
+                    except Exception as ex:
+                        raise self.field_error(field_name, obj, template, node) from ex
+
+                    if shape is not None:
+                        self.update_shape(shape, node, obj, field_item)
+                    if field_item.__class__ is str:
+                        append(field_item)
+                    elif field_item.__class__ is Template:
+                        # expand the nested template
+                        stack.append((kind, nodes, template, recursion_depth, owner, args, kwargs, used_args, 0))
+                        kind, template, recursion_depth, owner, nodes = (
+                            _NESTED_FRAME, field_item, recursion_depth - 1, None, None
+                        )
+                        break
+                    elif node_class is _Include and not stats:
+                        # evaluate the included template in its scope
+                        included, include_kwargs = field_item
+                        stack.append((
+                            kind, nodes, template, recursion_depth, owner, args, kwargs, used_args, auto_arg_index
+                        ))
+                        kind, owner, nodes = _SCOPE_FRAME, (field_name, obj, template, node), None
+                        template, recursion_depth = included, max_depth
+                        args, used_args, auto_arg_index = (), set(), 0
+                        if included.scope is not None:
+                            include_kwargs = child_scope(include_kwargs, included.scope)
+                        kwargs = include_kwargs
+                        break
+                    elif node_class is _Repeat and not stats:
+                        # the frame of the items evaluates the body for every item in the scope of the item
+                        stack.append((
+                            kind, nodes, template, recursion_depth, owner, args, kwargs, used_args, auto_arg_index
+                        ))
+                        scope = {}
+                        stack.append([
+                            None, field_item, node.body, node.separator, (field_name, obj, template, node), scope,
+                            child_scope(kwargs, scope), isinstance(obj, dict), False
+                        ])
+                        # the empty frame is finished at once and the first item is started
+                        kind, owner, nodes = _NESTED_FRAME, None, iter(())
+                        break
+                    else:
+                        # the chunks of the streamed item
+                        try:
+                            for chunk in field_item:
+                                append(chunk)
+                                if len(out) >= _FLUSH_CHUNKS:
+                                    yield
+                        except Exception as ex:
+                            raise self.field_error(field_name, obj, template, node) from ex
+                else:
+                    # the template of the frame is finished
+                    if kind is _SCOPE_FRAME:
+                        self.check_unused_args(used_args, args, kwargs)
+                    if len(out) >= _FLUSH_CHUNKS:
+                        yield
+                    finished_kind = kind
+
+                    while stack:
+                        frame = stack[-1]
+                        if frame.__class__ is list:
+                            # start the next repeated item or finish the items
+                            item = next(frame[1], _MISSING)
+                            if item is _MISSING:
+                                stack.pop()
+                                finished_kind = _SCOPE_FRAME
+                                continue
+                            if frame[8]:
+                                append(frame[3])
+                            frame[8] = True
+                            scope = frame[5]
+                            if frame[7]:
+                                scope['key'], scope['item'] = item
+                            else:
+                                scope['item'] = item
+                            template = frame[2]
+                            kind, owner, nodes, recursion_depth = _SCOPE_FRAME, None, None, max_depth
+                            args, used_args, auto_arg_index = (), set(), 0
+                            kwargs = frame[6] if template.scope is None else child_scope(frame[6], template.scope)
+                            break
+
+                        stack.pop()
+                        kind, nodes, template, recursion_depth, owner, args, kwargs, used_args, parent_index = frame
+                        if finished_kind is not _NESTED_FRAME:
+                            # the parent scope continues its own field numbering
+                            auto_arg_index = parent_index
+                        break
+                    else:
+                        return auto_arg_index
+        except Exception as ex:
+            # the fields expanded by the frames wrap the exception from the innermost one as the recursive calls do
+            owners = [owner] + [frame[4] for frame in reversed(stack)]
+            error = ex
+            for field in owners:
+                if field is not None:
+                    wrapped = self.field_error(*field)
+                    wrapped.__cause__ = error
+                    wrapped.__suppress_context__ = True
+                    error = wrapped
+            if error is ex:
+                raise
+            raise error
+
+    def evaluate_traced(self, node, value, kwargs, stream, stats):
+        """ Evaluate the field node adding its time to the statistics of the span.
+
+        Args:
+            node (_Field): field node
+            value (any type): the value of the variable
+            kwargs (mapping): named variables
+            stream (bool): the field is evaluated while streaming
+            stats (RenderStats): statistics of the span
+
+        Returns:
+            str, Template or iterator: evaluated field
+        """
+        started = perf_counter()
+        try:
+            return node.stream(self, value, kwargs) if stream else node.evaluate(self, value, kwargs)
+        finally:
+            elapsed = perf_counter() - started
+            if node.__class__ is _Field:
+                stats.escaped_values += len(value) if isinstance(value, (list, tuple, set)) else 1
+            stats.add_field(node.spec.partition(':')[0] or 'default', node.field_name, elapsed)
+
+    @staticmethod
+    def field_error(field_name, value, template, node=None):
+        """ Build the exception of the failed field, its message is formatted when it is rendered.
 
-            # append it to the result
-            result.append(format_spec)
+        Args:
+            field_name (str): name of the variable
+            value (any type): the value of the variable
+            template (Template): compiled template
+            node (_Field): field node
 
-        return ''.join(result), auto_arg_index
+        Returns:
+            FieldError: the exception to raise
+        """
+        return FieldError(field_name, value, template, node)
 
     def get_field(self, field_name, args, kwargs):
         """ Redifined with exception handling while getting a field item. """
@@ -191,27 +3355,11 @@ class QueryFormatter(string.Formatter):
         if callable(value):
             value = value()
 
-        format_func = {
-            spec.startswith('include'): lambda: self.format_include_value(value, kwargs),
-            spec.startswith('repeat:'): lambda: self.format_repeat_value(value, spec, kwargs),
-            spec.startswith('in:'): lambda: self.format_in_value(value, spec, is_contained=True),
-            spec.startswith('!in:'): lambda: self.format_in_value(value, spec, is_contained=False),
-            spec.startswith('exists:'): lambda: self.format_exists_value(value, spec),
-            spec.startswith('!exists:'): lambda: self.format_not_exists_value(value, spec),
-            spec.startswith('eq:'): lambda: self.format_eq_value(value, spec),
-            spec.startswith('!eq:'): lambda: self.format_not_eq_value(value, spec),
-            spec.startswith('gt:'): lambda: self.format_gt_value(value, spec),
-            spec.startswith('lt:'): lambda: self.format_lt_value(value, spec),
-            spec.startswith('if:'): lambda: self.format_if_value(value, spec),
-            spec.startswith('!if:'): lambda: self.format_not_if_value(value, spec),
-            spec.startswith('tmpl'): lambda: self.format_tmpl_value(value),
-            spec.startswith('idf'): lambda: self.format_field_name(value)
-        }.get(True)
-
-        if format_func is None:
+        directive = self.get_directive(spec)
+        if directive is None:
             field_item = self.format_default_value(value, spec)
         else:
-            field_item = format_func()
+            field_item = directive[0](self, value, spec, kwargs)
 
         return field_item
 
@@ -266,10 +3414,10 @@ class QueryFormatter(string.Formatter):
         param_dict = kwargs
         if isinstance(value, list):
             value, value_param = value
-            param_dict = dict(kwargs, **value_param)
+            param_dict = child_scope(kwargs, value_param)
 
         # there is no need to analyze the result of the internal format
-        return self.format(value or '', **param_dict), True
+        return self.vformat(value or '', (), param_dict), True
 
     def format_repeat_value(self, value, spec, kwargs):
         """ Format the field value with repeated value.
@@ -285,16 +3433,17 @@ class QueryFormatter(string.Formatter):
             return '', False
 
         param_list = self.get_param_list(spec)
+        template = self.compile(param_list[2])
         res_list = []
 
         if isinstance(value, dict):
             for key, item in value.items():
-                param_dict = dict(kwargs, **{'item':item, 'key':key})
-                res_list.append(self.format(param_list[2], **param_dict))
+                param_dict = child_scope(kwargs, {'item': item, 'key': key})
+                res_list.append(self.vformat(template, (), param_dict))
         else:
             for item in value:
-                param_dict = dict(kwargs, **{'item':item})
-                res_list.append(self.format(param_list[2], **param_dict))
+                param_dict = child_scope(kwargs, {'item': item})
+                res_list.append(self.vformat(template, (), param_dict))
 
         # there is no need to analyze the result of the internal format
         return param_list[1].join(res_list), True
@@ -322,9 +3471,7 @@ class QueryFormatter(string.Formatter):
 
         if isinstance(value, list):
             item = item_value if any(
-                item_value in map(
-                    lambda x: cast_to_type(x, type(item_value).__name__), item_list
-                ) for item_value in value
+                is_in_options(list_value, param_list[1]) for list_value in value
             ) else def_value, False
         else:
             item = item_value if value in item_list else def_value, False
@@ -370,7 +3517,7 @@ class QueryFormatter(string.Formatter):
             tuple: output item
         """
         param_list = self.get_param_list(spec)
-        value_cond = value == cast_to_type(param_list[1], type(value).__name__)
+        value_cond = value == cast_spec_operand(param_list[1], type(value).__name__)
         return self.get_compared_value(param_list, value_cond)
 
     def format_not_eq_value(self, value, spec):
@@ -384,7 +3531,7 @@ class QueryFormatter(string.Formatter):
             tuple: output item
         """
         param_list = self.get_param_list(spec)
-        value_cond = value != cast_to_type(param_list[1], type(value).__name__)
+        value_cond = value != cast_spec_operand(param_list[1], type(value).__name__)
         return self.get_compared_value(param_list, value_cond)
 
     def format_gt_value(self, value, spec):
@@ -398,7 +3545,7 @@ class QueryFormatter(string.Formatter):
             tuple: output item
         """
         param_list = self.get_param_list(spec)
-        value_cond = value is not None and value > cast_to_type(param_list[1], type(value).__name__)
+        value_cond = value is not None and value > cast_spec_operand(param_list[1], type(value).__name__)
         return self.get_compared_value(param_list, value_cond)
 
     def format_lt_value(self, value, spec):
@@ -412,7 +3559,7 @@ class QueryFormatter(string.Formatter):
             tuple: output item
         """
         param_list = self.get_param_list(spec)
-        value_cond = value is not None and value < cast_to_type(param_list[1], type(value).__name__)
+        value_cond = value is not None and value < cast_spec_operand(param_list[1], type(value).__name__)
         return self.get_compared_value(param_list, value_cond)
 
     @staticmethod
@@ -441,6 +3588,42 @@ class QueryFormatter(string.Formatter):
         """
         return spec.partition(':')[-1] if not value else '', False
 
+    def format_cond_value(self, value, spec):
+        """ Format the field value as the predicate of the sql expression from the spec: "IS NULL" for None,
+        "IN" or "= ANY" for collections and "=" otherwise.
+
+        Args:
+            value (any type): the value of the variable
+            spec (str): string literals separated by :
+
+        Returns:
+            tuple: output item
+        """
+        escape_class = self.escape_class or SqlEscaper
+        condition = spec.partition(':')[-1]
+        if value is None:
+            return f'{condition} IS NULL', True
+        if isinstance(value, escape_class.collection_types):
+            return f'{condition} {escape_class.get_collection_condition(value)}', True
+        return f'{condition} = {escape_class.escape_value(value)}', True
+
+    def format_copy_value(self, value, spec):
+        """ Format the field value as the statement "COPY table (columns) FROM STDIN" of the table from the spec, the
+        rows for it are encoded by "CopyEncoder".
+
+        Args:
+            value (sequence): names of the columns, the statement without columns if it is empty
+            spec (str): string literals separated by :
+
+        Returns:
+            tuple: output item
+        """
+        table = spec.partition(':')[-1]
+        if not value:
+            return f'COPY {table} FROM STDIN', True
+        columns_text = ', '.join(self.format_field_name(column)[0] for column in value)
+        return f'COPY {table} ({columns_text}) FROM STDIN', True
+
     def format_tmpl_value(self, value):
         """ Format the field value if the value is a template. Format query with trimmed quotes.
 
@@ -463,3 +3646,245 @@ class QueryFormatter(string.Formatter):
         """
         ans = super(QueryFormatter, self).format_field(value, '')
         return f'"{ans}"', True
+
+
+class ParallelQueryFormatter(QueryFormatter):
+    """ Query formatter rendering batches and large repeated items on the pool of processes. The output is the same
+    and in the same order as the serial formatter produces. Templates are sent to the workers once and then are
+    referenced by plan ids. The formatter, its escaper, registered directives and the variables must be picklable.
+
+        Attrs:
+            max_workers (int): number of processes of the pool, number of CPUs by default
+            chunksize (int): number of the sets of variables or repeated items in one task of the pool
+            parallel_threshold (int): repeats of this number of items or more are rendered on the pool, None switches
+                parallel repeats off
+            worker_formatter (QueryFormatter): the formatter rendering the tasks in the worker processes, the parallel
+                formatter itself by default
+
+    """
+    chunksize = 100
+    parallel_threshold = 10000
+    worker_formatter = None
+
+    def __init__(
+        self, escape_class=None, cache_size=256, registry=None, result_cache=None, minify=None, recursion_depth=None,
+        max_workers=None, chunksize=None, parallel_threshold=None
+    ):
+        super().__init__(escape_class, cache_size, registry, result_cache, minify, recursion_depth)
+        self.max_workers = max_workers
+        if chunksize is not None:
+            self.chunksize = chunksize
+        if parallel_threshold is not None:
+            self.parallel_threshold = parallel_threshold
+        self._init_pool()
+
+    def _init_pool(self):
+        self._executor = None
+        self._pool_lock = threading.Lock()
+        self._plans = OrderedDict()
+        self._plan_sent = {}
+        self._next_plan_id = 0
+        # the ids of the dropped plans by the numbers of the tasks they were sent with
+        self._dropped = {}
+
+    def __getstate__(self):
+        """ The pool and the plan ids are not pickled. """
+        state = super().__getstate__()
+        for name in ('_executor', '_pool_lock', '_plans', '_plan_sent', '_next_plan_id', '_dropped'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._init_pool()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    @property
+    def executor(self):
+        """ ProcessPoolExecutor: the pool of processes, it is started by the first parallel task. """
+        with self._pool_lock:
+            if self._executor is None:
+                worker_formatter = self if self.worker_formatter is None else self.worker_formatter
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, initializer=_init_parallel_worker, initargs=(worker_formatter,)
+                )
+            return self._executor
+
+    def shutdown(self, wait=True):
+        """ Stop the pool of processes. The pool is started again by the next parallel task.
+
+        Args:
+            wait (bool): wait for the running tasks
+        """
+        with self._pool_lock:
+            executor, self._executor = self._executor, None
+            self._plans.clear()
+            self._plan_sent.clear()
+            self._dropped.clear()
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def get_plan(self, template):
+        """ Get the reference to the template for the task of the pool. Plans are kept by the compiled templates
+        until the pool is stopped, the least recently used are dropped above the cache size like the compiled
+        templates. The template is attached to the first tasks of the plan and the ids of the dropped plans to the
+        next tasks until every worker could receive them, the workers drop their templates too.
+
+        Args:
+            template (Template): compiled template
+
+        Returns:
+            tuple: the plan id, the template of "get_plan_data" or None and the ids of the dropped plans
+        """
+        workers = self.max_workers or cpu_count() or 1
+        with self._pool_lock:
+            plan = self._plans.get(template)
+            if plan is None:
+                plan = self._plans[template] = self._next_plan_id, self.get_plan_data(template)
+                self._next_plan_id += 1
+                if len(self._plans) > max(self.cache_size, 1):
+                    _, (dropped_id, _) = self._plans.popitem(last=False)
+                    self._plan_sent.pop(dropped_id, None)
+                    self._dropped[dropped_id] = 0
+            else:
+                self._plans.move_to_end(template)
+
+            dropped = tuple(self._dropped)
+            for dropped_id in dropped:
+                self._dropped[dropped_id] += 1
+                if self._dropped[dropped_id] >= workers:
+                    del self._dropped[dropped_id]
+
+            plan_id, data = plan
+            sent = self._plan_sent.get(plan_id, 0)
+            if sent >= workers:
+                return plan_id, None, dropped
+            self._plan_sent[plan_id] = sent + 1
+        return plan_id, data, dropped
+
+    @staticmethod
+    def get_plan_data(template):
+        """ Get the template sent to the workers: the nodes are sent dumped, as the templates specialized or loaded
+        from the cache file are not compiled from their texts again.
+
+        Args:
+            template (Template): compiled template
+
+        Returns:
+            tuple or Template: the dumped template and its bound variables, the template of custom directives is
+                pickled as is
+        """
+        try:
+            return dump_template(Template(template.source, template.nodes, template.error)), template.scope
+        except TypeError:
+            return template
+
+    def map_tasks(self, func, template, tasks):
+        """ Run the tasks of the template on the pool keeping their order. The number of running tasks is limited
+        to consume the tasks lazily.
+
+        Args:
+            func (callable): module function of the worker called with the plan and the arguments of the task
+            template (Template): compiled template of the tasks
+            tasks (iterable): tuples of the arguments of the task
+
+        Yields:
+            any type: results of the tasks in order
+        """
+        executor = self.executor
+        limit = 2 * (self.max_workers or cpu_count() or 1)
+        pending = deque()
+        for args in tasks:
+            pending.append((args, executor.submit(func, self.get_plan(template), *args)))
+            if len(pending) >= limit:
+                yield self.get_task_result(func, template, *pending.popleft())
+
+        while pending:
+            yield self.get_task_result(func, template, *pending.popleft())
+
+    def get_task_result(self, func, template, args, future):
+        """ Get the result of the task, the task is repeated with the template text if the worker has not received
+        the template yet.
+
+        Args:
+            func (callable): module function of the worker
+            template (Template): compiled template of the task
+            args (tuple): arguments of the task
+            future (Future): the running task
+
+        Returns:
+            any type: result of the task
+        """
+        try:
+            return future.result()
+        except _PlanMissing:
+            plan_id, _, dropped = self.get_plan(template)
+            return self.executor.submit(func, (plan_id, self.get_plan_data(template), dropped), *args).result()
+
+    def format_many(self, format_string, kwargs_list, chunksize=None, max_workers=None):
+        """ Format the template with every set of variables on the pool of processes.
+
+        Args:
+            format_string (str or Template): template text or compiled template
+            kwargs_list (iterable): dicts of named variables
+            chunksize (int): number of the sets of variables in one task, "chunksize" of the formatter by default
+            max_workers (int): not used, the pool of the formatter has "max_workers" processes
+
+        Yields:
+            str: formatted text for every set of variables in the same order
+        """
+        template = self.compile(format_string)
+        chunks = iter_chunks(kwargs_list, chunksize or self.chunksize)
+        for res_list in self.map_tasks(_format_batch_in_worker, template, ((chunk,) for chunk in chunks)):
+            yield from res_list
+
+    def is_inline_repeat(self, value):
+        """ Repeats of less than "parallel_threshold" items, repeats of the fingerprinted query and repeats of
+        the query with bind parameters are evaluated in place, the workers would fill the copies of the hash and
+        of the bound escaper. """
+        threshold = self.parallel_threshold
+        escaper = self.escape_class
+        return (
+            threshold is None or self.shape is not None or not isinstance(value, (list, tuple, dict)) or
+            len(value) < threshold or isinstance(escaper, ParamEscaper) and escaper.params is not None
+        )
+
+    def render_repeat(self, body, separator, value, kwargs):
+        """ Render the repeated items on the pool of processes if there are at least "parallel_threshold" items. """
+        if self.is_inline_repeat(value):
+            return super().render_repeat(body, separator, value, kwargs)
+
+        # only the variables referenced by the item are sent as the plain dict
+        names = template_names(body)
+        if names is None:
+            kwargs = dict(kwargs)
+        else:
+            kwargs = {name: kwargs[name] for name in names - {'item', 'key'} if name in kwargs}
+        if isinstance(value, dict):
+            chunks = (dict(chunk) for chunk in iter_chunks(value.items(), self.chunksize))
+        else:
+            chunks = iter_chunks(value, self.chunksize)
+        tasks = ((separator, chunk, kwargs) for chunk in chunks)
+        return separator.join(self.map_tasks(_repeat_in_worker, body, tasks))
+
+
+def iter_chunks(iterable, size):
+    """ Split the iterable into the lists of the size.
+
+    Args:
+        iterable (iterable): the items
+        size (int): number of items in the chunk
+
+    Yields:
+        list: chunk of items
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+""" TEMPLATE CACHE MODULE: TEMPLATES OF THE REGISTRY PRECOMPILED TO ONE CACHE FILE
+"""
+__author__ = 'kokarev.nv'
+
+from collections import namedtuple
+from contextlib import contextmanager
+import gc
+import hashlib
+import marshal
+import mmap
+import os
+import sys
+import tempfile
+
+from .query_formatter import dump_template, load_template
+
+# version of the cache file format, files of other versions or written by other versions of Python are compiled again
+CACHE_VERSION = 2
+CACHE_MAGIC = b'QFCACHE\n'
+
+# files of this size or larger are read via mmap
+MMAP_THRESHOLD = 1 << 20
+
+TemplateCacheInfo = namedtuple('TemplateCacheInfo', ('loaded', 'compiled', 'saved'))
+
+# the content of the cache file of the other formatter or version
+EMPTY_CACHE = {'templates': {}, 'files': {}}
+
+
+def source_digest(source):
+    """ Get the content hash of the template text.
+
+    Args:
+        source (str): text of the template
+
+    Returns:
+        str: hexadecimal hash
+    """
+    return hashlib.blake2b(source.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+
+def formatter_signature(formatter):
+    """ Get the signature of the formatter configuration the compiled templates depend on: the class, the minify
+    mode and the directives.
+
+    Args:
+        formatter (QueryFormatter): the formatter
+
+    Returns:
+        tuple: the signature
+    """
+    formatter_class = type(formatter)
+    directives = tuple(sorted(
+        (prefix, node_class.__qualname__, getattr(handler, '__qualname__', type(handler).__qualname__))
+        for prefix, (handler, node_class) in formatter.directives.items()
+    ))
+    return (
+        formatter_class.__module__, formatter_class.__qualname__, formatter_class.format_field.__qualname__,
+        bool(formatter.minify), directives
+    )
+
+
+def unmarshal_cache(data):
+    """ Unmarshal the content of the cache file.
+
+    Args:
+        data (bytes or mmap): the content of the file
+
+    Returns:
+        dict: the versions, the signature of the formatter and the templates or None if the file is not the cache
+    """
+    if data[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        return None
+    with memoryview(data) as view:
+        try:
+            content = marshal.loads(view[len(CACHE_MAGIC):])
+        except (ValueError, EOFError, TypeError):
+            return None
+    return content if isinstance(content, dict) else None
+
+
+def read_cache(path, formatter):
+    """ Read the cache file with one read or via mmap for large files.
+
+    Args:
+        path (str): path of the cache file
+        formatter (QueryFormatter): the formatter using the templates
+
+    Returns:
+        dict: dumped templates by the hashes of their texts and the modification times, the hashes and the included
+            names of the template files by the template names, empty if the file is not found or is outdated
+    """
+    try:
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    content = unmarshal_cache(buffer)
+            else:
+                content = unmarshal_cache(file.read())
+    except FileNotFoundError:
+        return EMPTY_CACHE
+
+    if content is None or content.get('version') != (CACHE_VERSION, tuple(sys.version_info[:2])):
+        return EMPTY_CACHE
+    if content.get('signature') != formatter_signature(formatter):
+        return EMPTY_CACHE
+    return content
+
+
+def write_cache(path, formatter, templates, registry):
+    """ Write the cache file atomically, the workers reading it concurrently get the old or the new file. Templates
+    with the nodes of custom directives are not written and are compiled when they are loaded. The modification times
+    and the includes of all template files are written with the templates, the unchanged files are not parsed again.
+
+    Args:
+        path (str): path of the cache file
+        formatter (QueryFormatter): the formatter compiled the templates
+        templates (dict): compiled templates by the hashes of their texts
+        registry (TemplateRegistry): registry of the templates
+
+    Returns:
+        int: number of the written templates
+    """
+    dumped = {}
+    for key, template in templates.items():
+        try:
+            dumped[key] = dump_template(template)
+        except TypeError:
+            continue
+
+    files = {}
+    for name in registry:
+        mtime, source, includes = registry.get_info(name)
+        files[name] = (mtime, source_digest(source), includes)
+
+    content = {
+        'version': (CACHE_VERSION, tuple(sys.version_info[:2])),
+        'signature': formatter_signature(formatter),
+        'templates': dumped,
+        'files': files
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_path = tempfile.mkstemp(prefix='.qfcache', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(CACHE_MAGIC)
+            marshal.dump(content, file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return len(dumped)
+
+
+@contextmanager
+def paused_gc():
+    """ Pause the garbage collection while the templates are built, the nodes are not cyclic and the collections
+    triggered by the allocations of many nodes take the most of the time.
+
+    Yields:
+        None: the collection is paused
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def load_templates(formatter, path, registry=None, update=True):
+    """ Load the compiled templates of the registry from the cache file to the cache of the formatter. Templates are
+    found by the hashes of their texts, changed and new templates are compiled and the cache file is written again.
+    The registry is loaded again, the files not modified since the cache file was written are not read and parsed,
+    the registry created without loading is loaded once then. The cache file must be trusted, it is unmarshalled.
+
+    Args:
+        formatter (QueryFormatter): the formatter using the templates
+        path (str): path of the cache file
+        registry (TemplateRegistry): registry of the templates, the registry of the formatter by default
+        update (bool): write the cache file again if some templates are compiled or removed
+
+    Raises:
+        ValueError: returned the exception when there is no registry
+
+    Returns:
+        TemplateCacheInfo: numbers of the loaded and compiled templates and the flag of the written file
+    """
+    registry = registry if registry is not None else formatter.registry
+    if registry is None:
+        raise ValueError('Templates are loaded to the formatter with the registry only')
+
+    with paused_gc():
+        content = read_cache(path, formatter)
+        cached = content['templates']
+        files = content['files']
+        # the templates of the cached files, their texts are not read from the files
+        known = {}
+        known_templates = {}
+        for name, (mtime, key, includes) in files.items():
+            dumped = cached.get(key)
+            template = known_templates.get(key)
+            if template is None and dumped is not None:
+                template = known_templates[key] = load_template(dumped)
+            known[name] = (mtime, None if template is None else template.source, includes)
+        registry.load(known)
+
+        templates = {}
+        sources = {}
+        loaded = compiled = 0
+        # the templates are written again if some templates are changed, added or removed
+        stale = not files.keys() <= set(registry)
+        for name in registry:
+            mtime, source, _ = registry.get_info(name)
+            file = files.get(name)
+            if file is not None and file[0] == mtime and file[1] in cached:
+                key = file[1]
+            else:
+                key = source_digest(source)
+                # the modification time of the file is written again
+                stale = stale or key in cached
+            template = known_templates.get(key)
+            if template is None and key in cached:
+                template = load_template(cached[key])
+            if template is not None:
+                loaded += 1
+            else:
+                template = formatter.compile_body(source)
+                if template.error is not None:
+                    # the malformed template fails when it is formatted
+                    continue
+                compiled += 1
+                try:
+                    dump_template(template)
+                    stale = True
+                except TypeError:
+                    # the template of custom directives is compiled every time
+                    pass
+            templates[key] = template
+            sources[source] = template
+
+    formatter.add_templates(sources)
+    saved = update and (stale or not cached.keys() <= templates.keys())
+    if saved:
+        write_cache(path, formatter, templates, registry)
+    return TemplateCacheInfo(loaded, compiled, saved)
+
+
+def precompile_templates(formatter, path, registry=None):
+    """ Compile all templates of the registry to the cache file.
+
+    Args:
+        formatter (QueryFormatter): the formatter compiling the templates
+        path (str): path of the cache file
+        registry (TemplateRegistry): registry of the templates, the registry of the formatter by default
+
+    Raises:
+        ValueError: returned the exception when there is no registry
+
+    Returns:
+        int: number of the written templates
+    """
+    registry = registry if registry is not None else formatter.registry
+    if registry is None:
+        raise ValueError('Templates are precompiled from the registry only')
+
+    templates = {}
+    for name in registry:
+        source = registry.get(name)
+        template = formatter.compile_body(source)
+        if template.error is None:
+            templates[source_digest(source)] = template
+    return write_cache(path, formatter, templates, registry)
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+""" TEMPLATE REGISTRY MODULE
+"""
+__author__ = 'kokarev.nv'
+
+import mmap
+import os
+import string
+import threading
+from time import monotonic
+
+
+class TemplateRegistry:
+    """ Registry of the templates loaded from the files of the directory. The template is named by its path relative
+    to the directory without the suffix, separated by dots: "reports/daily.sql" is "reports.daily". The formatter with
+    the registry resolves "{name:include}" by the name if the variable is not passed. Changed files are reloaded
+    by their modification time checked once per "check_interval", the directory is scanned again for the name not
+    found with the same interval. Includes of the templates by names must not form cycles. The registry created
+    without loading is loaded by "load" or by "load_templates" from the precompiled cache file.
+
+        Attrs:
+            directory (str): directory of the templates
+            suffix (str): suffix of the template files
+            encoding (str): encoding of the template files
+            mmap_threshold (int): files of this size or larger are read via mmap
+            check_interval (float): seconds between the checks of the modification time of one file and between
+                the scans of the directory for the new files, 0 checks on every access
+
+    """
+    mmap_threshold = 1 << 20
+    check_interval = 1.0
+
+    def __init__(
+        self, directory, suffix='.sql', encoding='utf-8', mmap_threshold=None, autoload=True, check_interval=None
+    ):
+        self.directory = directory
+        self.suffix = suffix
+        self.encoding = encoding
+        if mmap_threshold is not None:
+            self.mmap_threshold = mmap_threshold
+        if check_interval is not None:
+            self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # name: path, modification time and text of the template
+        self._entries = {}
+        # name: names of the included templates
+        self._includes = {}
+        # name: the time the modification time of the file was checked
+        self._checked = {}
+        # the time the directory was scanned, None before the first scan
+        self._scanned = None
+        if autoload:
+            self.load()
+
+    def __getstate__(self):
+        """ The lock is not pickled. """
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        if name in self._entries:
+            return True
+        return self.rescan() and name in self._entries
+
+    def __iter__(self):
+        return iter(sorted(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, known=None):
+        """ Load all templates of the directory again. The known templates of the unchanged files are not read, the
+        includes of them are not searched if the names of the templates are not changed too.
+
+        Args:
+            known (dict): modification times, texts or None and names of the included templates by the template
+                names, as they are kept in the precompiled cache file
+
+        Raises:
+            ValueError: returned the exception when the templates include each other in the cycle
+        """
+        known = known or {}
+        entries = {}
+        # name: names of the included templates of the unchanged file
+        unchanged = {}
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if not file_name.endswith(self.suffix):
+                    continue
+                path = os.path.join(root, file_name)
+                rel_path = os.path.relpath(path, self.directory)[:-len(self.suffix)]
+                name = rel_path.replace(os.sep, '.')
+                entry = known.get(name)
+                if entry is not None and os.stat(path).st_mtime_ns == entry[0]:
+                    # the text of the template which is not cached is read
+                    entries[name] = (path, entry[0], entry[1]) if entry[1] is not None else self.read(path)
+                    unchanged[name] = entry[2]
+                else:
+                    entries[name] = self.read(path)
+
+        if len(unchanged) == len(entries) == len(known):
+            # the graph of the includes was checked when the known templates were loaded
+            includes = unchanged
+        else:
+            # the includes by the added or removed names are found again
+            if entries.keys() != known.keys():
+                unchanged = {}
+            includes = {
+                name: unchanged[name] if name in unchanged else self.find_includes(source, entries)
+                for name, (_, _, source) in entries.items()
+            }
+            self.check_cycles(includes)
+        now = monotonic()
+        with self._lock:
+            self._entries = entries
+            self._includes = includes
+            self._checked = dict.fromkeys(entries, now)
+            self._scanned = now
+
+    def rescan(self):
+        """ Scan the directory again for the added and removed templates if it was not scanned for "check_interval",
+        the unchanged files are not read again.
+
+        Raises:
+            ValueError: returned the exception when the templates include each other in the cycle
+
+        Returns:
+            bool: the directory is scanned
+        """
+        if self._scanned is not None and monotonic() - self._scanned < self.check_interval:
+            return False
+        self.load({
+            name: (mtime, source, self._includes.get(name, frozenset()))
+            for name, (_, mtime, source) in self._entries.items()
+        })
+        return True
+
+    def read(self, path):
+        """ Read the template file.
+
+        Args:
+            path (str): path of the file
+
+        Returns:
+            tuple: path, modification time and text of the template
+        """
+        with open(path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            if stat.st_size and stat.st_size >= self.mmap_threshold:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    source = str(buffer, self.encoding)
+            else:
+                source = file.read().decode(self.encoding)
+        return path, stat.st_mtime_ns, source
+
+    def get(self, name):
+        """ Get the text of the template, the changed file is reloaded. The directory is scanned again for the name
+        not found.
+
+        Args:
+            name (str): name of the template
+
+        Raises:
+            ValueError: returned the exception when the template is not found or the changed template forms
+                the cycle of includes
+
+        Returns:
+            str: text of the template
+        """
+        entry = self._entries.get(name)
+        if entry is None and self.rescan():
+            entry = self._entries.get(name)
+        if entry is None:
+            raise ValueError(f'Template "{name}" not found')
+
+        path, mtime, source = entry
+        now = monotonic()
+        if now - self._checked.get(name, now - self.check_interval) < self.check_interval:
+            return source
+        try:
+            changed = os.stat(path).st_mtime_ns != mtime
+        except OSError:
+            raise ValueError(f'Template "{name}" not found') from None
+        self._checked[name] = now
+        if not changed:
+            return source
+
+        with self._lock:
+            entry = self.read(path)
+            entries = dict(self._entries, **{name: entry})
+            includes = dict(self._includes, **{name: self.find_includes(entry[2], entries)})
+            self.check_cycles(includes)
+            self._entries = entries
+            self._includes = includes
+        return entry[2]
+
+    def get_info(self, name):
+        """ Get the modification time, the text and the names of the included templates of the loaded template
+        without checking the file.
+
+        Args:
+            name (str): name of the template
+
+        Returns:
+            tuple: modification time, text and names of the included templates
+        """
+        _, mtime, source = self._entries[name]
+        return mtime, source, self.get_includes(name)
+
+    def get_includes(self, name):
+        """ Get the names of the templates included by the template by their names.
+
+        Args:
+            name (str): name of the template
+
+        Returns:
+            frozenset: names of the included templates
+        """
+        return self._includes.get(name, frozenset())
+
+    @staticmethod
+    def find_includes(source, names):
+        """ Find the names of the templates included by the template, nested templates of the specs are searched too.
+
+        Args:
+            source (str): text of the template
+            names (container): names of the templates
+
+        Returns:
+            frozenset: names of the included templates
+        """
+        includes = set()
+        parse = string.Formatter().parse
+        stack = [source]
+        while stack:
+            try:
+                for _, field_name, spec, _ in parse(stack.pop()):
+                    if field_name is None:
+                        continue
+                    if spec.startswith('include') and field_name in names:
+                        includes.add(field_name)
+                    if spec:
+                        stack.append(spec)
+            except ValueError:
+                # the malformed template fails when it is formatted
+                continue
+        return frozenset(includes)
+
+    @staticmethod
+    def check_cycles(includes):
+        """ Check that the templates don't include each other in the cycle.
+
+        Args:
+            includes (dict): names of the included templates by the template names
+
+        Raises:
+            ValueError: returned the exception with the cycle of the template names
+        """
+        done = set()
+        for start in includes:
+            if start in done:
+                continue
+            # the path of the depth-first search with the iterators of the included names
+            path = [start]
+            stack = [iter(sorted(includes.get(start, ())))]
+            while stack:
+                for name in stack[-1]:
+                    if name in path:
+                        cycle = path[path.index(name):] + [name]
+                        raise ValueError(f'Cycle of included templates: {" -> ".join(cycle)}')
+                    if name not in done:
+                        path.append(name)
+                        stack.append(iter(sorted(includes.get(name, ()))))
+                        break
+                else:
+                    done.add(path.pop())
+                    stack.pop()
@@ -3,11 +3,29 @@
 """
 __author__ = 'kokarev.nv'
 
+from collections import ChainMap, namedtuple
+import asyncio
+import contextlib
+import io
+import os
+import pickle
+import tempfile
+import threading
 import uuid
-from datetime import datetime, date
+from datetime import datetime, date, time, timedelta, timezone
 import unittest
+from unittest import mock
 
-from . import cast_to_type, SqlEscaper, QueryFormatter
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import (
+    cast_to_type, SqlEscaper, ParamEscaper, Template, ResultCache, FieldError, QueryFormatter, ParallelQueryFormatter,
+    TemplateRegistry, CopyEncoder, decode_copy, load_templates, precompile_templates
+)
+from .__main__ import main as tools_main
 
 QF = QueryFormatter(SqlEscaper())
 
@@ -65,6 +83,9 @@ class TestQueryFormatterMethods(unittest.TestCase):
             )
         ):
             self.assertEqual(SqlEscaper.get_condition(value, condition), ans)
+        # collections are sqlized as the list of items, the predicates are built by the "cond:" directive only
+        self.assertEqual(SqlEscaper.get_condition([1, 2], 'id'), 'id 1, 2')
+        self.assertEqual(SqlEscaper.get_condition(['a'], 'name ='), 'name = a')
 
     def test_format_field(self):
         # in
@@ -184,3 +205,811 @@ class TestQueryFormatterMethods(unittest.TestCase):
             WHERE_BLOCK(some_query=TRUE, some_query=TRUE)
         """
         self.assertEqual(QF.format(tmpl, **kwargs), ans)
+
+    def test_compile(self):
+        tmpl = 'SELECT * FROM Contractor WHERE TRUE{client_id:if: AND "Id" = {client_id}}{names:in:a,b: AND FALSE}'
+        template = QF.compile(tmpl)
+        self.assertIsInstance(template, Template)
+        self.assertIs(QF.compile(tmpl), template)
+        self.assertIs(QF.compile(template), template)
+        for kwargs in ({'client_id': 7, 'names': 'a'}, {'client_id': None, 'names': 'c'}):
+            self.assertEqual(QF.format(template, **kwargs), QF.format(tmpl, **kwargs))
+        self.assertEqual(
+            QF.format(template, client_id=7, names='a'),
+            'SELECT * FROM Contractor WHERE TRUE AND "Id" = 7 AND FALSE'
+        )
+        # the least recently used template is evicted
+        qf = QueryFormatter(SqlEscaper(), cache_size=2)
+        first = qf.compile('{a}')
+        qf.compile('{b}')
+        qf.compile('{a}')
+        qf.compile('{c}')
+        self.assertIs(qf.compile('{a}'), first)
+        self.assertNotIn('{b}', qf._cache)
+        # parsing error of the branch is raised only when the branch is taken
+        self.assertEqual(qf.format('{a:if:x {b!}}', a=None), '')
+        self.assertRaises(ValueError, qf.format, '{a:if:x {b!}}', a=1)
+
+        # the redefined formatting methods of the directives are called by the compiled templates
+        class StrictFormatter(QueryFormatter):
+            @staticmethod
+            def format_if_value(value, spec):
+                return spec.partition(':')[-1] if value is not None else '', False
+
+            def format_eq_value(self, value, spec):
+                return super().format_eq_value(str(value), spec)
+
+        qf = StrictFormatter(SqlEscaper())
+        self.assertEqual(qf.format('{a:if:x}{b:if:y}{c:eq:1:z}', a=0, b=None, c=1), 'xz')
+
+    def test_register_directive(self):
+        def format_between_value(formatter, value, spec, kwargs):
+            _, bounds, body = formatter.get_param_list(spec)
+            low, high = map(int, bounds.split(','))
+            return body if value is not None and low <= value <= high else '', False
+
+        qf = QueryFormatter(SqlEscaper())
+        qf.register_directive('between:', format_between_value)
+        tmpl = 'SELECT * FROM Contractor WHERE TRUE{age:between:18,65: AND "Age" = {age}}'
+        self.assertEqual(qf.format(tmpl, age=30), 'SELECT * FROM Contractor WHERE TRUE AND "Age" = 30')
+        self.assertEqual(qf.format(tmpl, age=70), 'SELECT * FROM Contractor WHERE TRUE')
+        self.assertEqual(qf.format_field(20, 'between:18,65:TRUE', None), ('TRUE', False))
+        # other formatters are not affected
+        self.assertRaises(ValueError, QF.format_field, 20, 'between:18,65:TRUE', None)
+        self.assertRaises(ValueError, qf.register_directive, '', format_between_value)
+
+    def test_escape_literal_types(self):
+        class Name(str):
+            pass
+
+        Point = namedtuple('Point', 'x y')
+        for value, ans in (
+            (Name("o'k"), "o''k"),
+            (Point(1, 2), '1, 2'),
+            (datetime(2021, 1, 2, 3, 4, 5), "'2021-01-02 03:04:05'::timestamp"),
+            ([1, [], 2], '1, , 2'),
+            ([[[[[[1]]]]], (2, [3, ("'",)])], "1, 2, 3, ''"),
+            (list(range(5)), '0, 1, 2, 3, 4'),
+            (["a'", "b", "'c'"], "a'', b, ''c''"),
+            ([True, 0, None, 'x'], 'True, 0, NULL, x')
+        ):
+            self.assertEqual(SqlEscaper.escape_literal(value), ans)
+
+        for value in (1.5, [1, 2.5], frozenset((1,)), [[{'a': 1}]]):
+            self.assertRaises(ValueError, SqlEscaper.escape_literal, value)
+
+        # the redefined functions sqlize the items of the collections too
+        class QuotingEscaper(SqlEscaper):
+            escape_literal_funcs = {
+                **SqlEscaper.escape_literal_funcs, str: lambda value: "'" + value.replace("'", "''") + "'"
+            }
+
+        self.assertEqual(QuotingEscaper.escape_literal('a'), "'a'")
+        self.assertEqual(QuotingEscaper.escape_literal(['a', "b'"]), "'a', 'b'''")
+        self.assertEqual(QuotingEscaper.escape_literal([1, 2]), '1, 2')
+
+    def test_operand_folding(self):
+        qf = QueryFormatter(SqlEscaper())
+        tmpl = '{num:eq:10: AND EQ}{ids:in:1,2,x: AND IN}{ids:!in:3,4: AND NOT IN}{flag:lt:True: AND LT}'
+        template = qf.compile(tmpl)
+        kwargs = {'num': 10, 'ids': ['x', 5], 'flag': False}
+        ans = ' AND EQ AND IN AND NOT IN AND LT'
+        self.assertEqual(qf.format(tmpl, **kwargs), ans)
+        self.assertEqual(qf.format(tmpl, **kwargs), ans)
+        eq_node, in_node, not_in_node, lt_node = template.nodes
+        # operands are casted once per type of the value
+        self.assertEqual(eq_node.casted, {'int': 10})
+        self.assertEqual(lt_node.casted, {'bool': True})
+        self.assertEqual(in_node.casted, {'str': frozenset(('1', '2', 'x'))})
+        self.assertEqual(not_in_node.casted, {'int': frozenset((3, 4)), 'str': frozenset(('3', '4'))})
+        self.assertEqual(qf.format(tmpl, num=11, ids=[2], flag=None), ' AND IN AND NOT IN')
+        self.assertEqual(in_node.casted['int'], None)
+        # uncastable option raises the error when it is reached
+        self.assertRaises(ValueError, qf.format, tmpl, ids=[3])
+
+    def test_repeat_scope(self):
+        scopes = []
+
+        def format_scope_value(formatter, value, spec, kwargs):
+            scopes.append(kwargs)
+            return f'{kwargs["item"]}{kwargs["key"]}{kwargs["suffix"]}', True
+
+        qf = QueryFormatter(SqlEscaper())
+        qf.register_directive('scope', format_scope_value)
+        tmpl = '{groups:repeat: UNION :{item:repeat:, :{item:scope}}}'
+        kwargs = {'groups': {'a': [1, 2], 'b': [3]}, 'suffix': ';'}
+        self.assertEqual(qf.format(tmpl, **kwargs), '1a;, 2a; UNION 3b;')
+        # the item scope is chained to the template variables instead of copying them
+        self.assertTrue(all(isinstance(scope, ChainMap) for scope in scopes))
+        self.assertEqual(len(scopes[0].maps), 3)
+        self.assertIs(scopes[0].maps[-1], scopes[-1].maps[-1])
+        # include parameters are chained too
+        tmpl = '{sub:include}'
+        self.assertEqual(qf.format(tmpl, sub=['{a}{b}', {'b': 2}], a=1, b=3), '12')
+
+    def test_iter_format(self):
+        tmpl = "INSERT INTO Contractor VALUES {rows:repeat:, :({item[0]}, '{item[1]}'{sub:include})}{tail:if:;}"
+        kwargs = {'rows': [(i, f"name'{i}") for i in range(1000)], 'sub': ['{extra:if:, TRUE}', {'extra': 1}], 'tail': 1}
+        ans = QF.format(tmpl, **kwargs)
+        qf = QueryFormatter(SqlEscaper())
+        qf.chunk_size = 100
+        chunks = list(qf.iter_format(tmpl, **kwargs))
+        self.assertEqual(''.join(chunks), ans)
+        self.assertTrue(all(len(chunk) < 200 for chunk in chunks))
+        sink = io.StringIO()
+        self.assertEqual(QF.format_to(sink, tmpl, **kwargs), len(ans))
+        self.assertEqual(sink.getvalue(), ans)
+        # errors of the streamed items are raised as while formatting
+        kwargs['rows'].append((1.5, ''))
+        with self.assertRaises(ValueError) as error:
+            list(QF.iter_format(tmpl, **kwargs))
+        self.assertIn('Error during processing variable "rows"', str(error.exception))
+
+    def test_format_many(self):
+        tmpl = 'SELECT * FROM Contractor WHERE "Id" = {client_id}{names:in:a,b: AND "Name" IN ({names})}'
+        kwargs_list = [{'client_id': i, 'names': ['a', 'c'] if i % 2 else ['c']} for i in range(10)]
+        ans = [QF.format(tmpl, **kwargs) for kwargs in kwargs_list]
+        # the sets of variables are formatted lazily
+        consumed = []
+        res_iter = QF.format_many(tmpl, (consumed.append(kwargs) or kwargs for kwargs in kwargs_list))
+        self.assertEqual(next(res_iter), ans[0])
+        self.assertEqual(len(consumed), 1)
+        self.assertEqual([ans[0]] + list(res_iter), ans)
+        self.assertEqual(list(QF.format_many(tmpl, kwargs_list, chunksize=3, max_workers=2)), ans)
+        # the pool takes a limited number of chunks ahead
+        consumed.clear()
+        res_iter = QF.format_many(
+            tmpl, (consumed.append(kwargs) or kwargs for kwargs in kwargs_list * 10), chunksize=3, max_workers=2
+        )
+        self.assertEqual(next(res_iter), ans[0])
+        self.assertLessEqual(len(consumed), 15)
+        self.assertEqual([ans[0]] + list(res_iter), ans * 10)
+        # the formatter is picklable without its compiled templates
+        qf = pickle.loads(pickle.dumps(QF))
+        self.assertEqual(qf.format(tmpl, **kwargs_list[1]), ans[1])
+
+    def test_format_params(self):
+        tmpl = """SELECT * FROM Contractor WHERE "Name" LIKE 'a%' AND "Id" IN ({ids}){name:if: AND "Name" = {name}}{kind:eq:person: AND "Kind" = {kind}}"""
+        kwargs = {'ids': [1, (2, 3)], 'name': "o'k", 'kind': 'company'}
+        for paramstyle, expand, ans, params in (
+            (
+                'format',
+                True,
+                """SELECT * FROM Contractor WHERE "Name" LIKE 'a%%' AND "Id" IN (%s, %s, %s) AND "Name" = %s""",
+                [1, 2, 3, "o'k"]
+            ), (
+                'numeric',
+                True,
+                """SELECT * FROM Contractor WHERE "Name" LIKE 'a%' AND "Id" IN ($1, $2, $3) AND "Name" = $4""",
+                [1, 2, 3, "o'k"]
+            ), (
+                'named',
+                False,
+                """SELECT * FROM Contractor WHERE "Name" LIKE 'a%' AND "Id" IN (:p1) AND "Name" = :p2""",
+                {'p1': [1, (2, 3)], 'p2': "o'k"}
+            )
+        ):
+            qf = QueryFormatter(ParamEscaper(paramstyle, expand))
+            self.assertEqual(qf.format_params(tmpl, **kwargs), (ans, params))
+        # the shared escaper doesn't collect parameters
+        self.assertRaises(ValueError, qf.format, tmpl, **kwargs)
+        self.assertRaises(ValueError, ParamEscaper, 'qmark')
+        self.assertEqual(
+            QF.format_params('{a} {b}', a=None, b=1),
+            ('%s %s', [None, 1])
+        )
+
+    def test_format_values(self):
+        tmpl = 'INSERT INTO {table:idf} ({columns}) VALUES {values} ON CONFLICT DO NOTHING'
+        rows = [(1, "o'k", None), (None, 'b', 2), (3, 'c', datetime(2020, 1, 1))]
+        self.assertEqual(
+            list(QF.format_values(tmpl, ['id', 'name', 'value'], rows, max_rows=2, table='Person')),
+            [
+                """INSERT INTO "Person" ("id", "name", "value") VALUES (1, 'o''k', NULL), (NULL, 'b', 2) ON CONFLICT DO NOTHING""",
+                """INSERT INTO "Person" ("id", "name", "value") VALUES (3, 'c', '2020-01-01 00:00:00'::timestamp) ON CONFLICT DO NOTHING"""
+            ]
+        )
+        queries = list(QF.format_values('INSERT INTO t VALUES {values}', ['id'], ([i] for i in range(10)), max_bytes=30))
+        self.assertEqual(len(queries), 5)
+        self.assertTrue(all(len(query) <= 30 for query in queries))
+        self.assertEqual(list(QF.format_values(tmpl, ['id'], [])), [])
+        # bad rows and templates
+        for format_string, rows, max_bytes in (
+            ('INSERT INTO t VALUES {values}', [(1, 2)], None),
+            ('INSERT INTO t VALUES {values}', [([1, 2],)], None),
+            ('INSERT INTO t VALUES {values}', [('a' * 100,)], 50),
+            ('INSERT INTO t VALUES {values}', [(1,)], 10),
+            ('INSERT INTO t VALUES ({columns})', [(1,)], None),
+        ):
+            with self.assertRaises(ValueError):
+                list(QF.format_values(format_string, ['id'], rows, max_bytes=max_bytes))
+        # the fields of the residual template are substituted in its nested templates too
+        residual = QF.specialize(
+            'INSERT INTO {table:idf}{flag:if: ({columns})} VALUES {values}{ret:if: RETURNING {ret}}', flag=1
+        )
+        self.assertEqual(
+            list(QF.format_values(residual, ['id'], [(1,), (2,)], table='t', ret='id')),
+            ['INSERT INTO "t" ("id") VALUES (1), (2) RETURNING id']
+        )
+        # the rows are not collected as bind parameters
+        with self.assertRaises(ValueError):
+            list(QueryFormatter(ParamEscaper()).format_values('INSERT INTO t VALUES {values}', ['id'], [(1,)]))
+
+    def test_array_condition(self):
+        class ArrayEscaper(SqlEscaper):
+            array_threshold = 2
+
+        tmpl = 'SELECT * FROM Contractor WHERE {ids:cond:contr."Id"}'
+        qf = QueryFormatter(ArrayEscaper())
+        for value, ans in (
+            ([1, 2], 'contr."Id" IN (1, 2)'),
+            ([1, 2, 3], """contr."Id" = ANY('{1,2,3}'::bigint[])"""),
+            (['a"b', 'c\\d', "e'f"], """contr."Id" = ANY('{"a\\"b","c\\\\d","e''f"}'::text[])"""),
+            ([uuid.UUID(int=1)] * 3, f"""contr."Id" = ANY('{{{','.join([str(uuid.UUID(int=1))] * 3)}}}'::uuid[])"""),
+            ([1, 'a', None], """contr."Id" IN (1, 'a', NULL)"""),
+            ([], 'contr."Id" IN (NULL)'),
+            (None, 'contr."Id" IS NULL'),
+            ("o'k", """contr."Id" = 'o''k'"""),
+        ):
+            self.assertEqual(qf.format(tmpl, ids=value), f'SELECT * FROM Contractor WHERE {ans}')
+        # arrays are off by default
+        self.assertEqual(QF.format(tmpl, ids=[1, 2, 3]), 'SELECT * FROM Contractor WHERE contr."Id" IN (1, 2, 3)')
+        self.assertEqual(ArrayEscaper.escape_array([date(2020, 1, 1)]), "'{2020-01-01}'::date[]")
+        self.assertIsNone(ArrayEscaper.escape_array([1, 'a']))
+        self.assertEqual(
+            QueryFormatter(ParamEscaper(expand=False)).format_params(tmpl, ids=[1, 2]),
+            ('SELECT * FROM Contractor WHERE contr."Id" = ANY(%s)', [[1, 2]])
+        )
+
+    def test_thread_safety(self):
+        tmpl_list = [
+            f'SELECT {i} FROM Contractor WHERE "Id" = {{id}}{{names:in:a,b: AND "Name" IN ({{names}})}}'
+            '{rows:repeat:, :({item}{id:gt:5: + {id}})}'
+            for i in range(8)
+        ]
+        kwargs_list = [{'id': i, 'names': ['a', str(i)], 'rows': list(range(i))} for i in range(16)]
+        ans = {
+            (i, j): QF.format(tmpl, **kwargs)
+            for i, tmpl in enumerate(tmpl_list) for j, kwargs in enumerate(kwargs_list)
+        }
+        # the small cache is evicted by other threads all the time
+        qf = QueryFormatter(ParamEscaper(), cache_size=3)
+        params_ans = {key: qf.format_params(tmpl_list[key[0]], **kwargs_list[key[1]]) for key in ans}
+        shared_qf = QueryFormatter(SqlEscaper(), cache_size=3)
+        errors = []
+
+        def format_all(offset):
+            try:
+                for n in range(300):
+                    key = ((n + offset) % len(tmpl_list), (n * 7 + offset) % len(kwargs_list))
+                    tmpl, kwargs = tmpl_list[key[0]], kwargs_list[key[1]]
+                    if shared_qf.format(tmpl, **kwargs) != ans[key]:
+                        errors.append(key)
+                    if qf.format_params(tmpl, **kwargs) != params_ans[key]:
+                        errors.append(key)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=format_all, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(shared_qf._cache), 3)
+
+    def test_parallel_query_formatter(self):
+        tmpl = "INSERT INTO t VALUES {rows:repeat:, :({item[0]}, '{item[1]}'{flag:if:, TRUE}{item[0]:in:5,7: + 1})}"
+        rows = [(i, f"name'{i}") for i in range(500)]
+        mapping = {f'key{i}': i for i in range(100)}
+        kwargs_list = [{'id': i, 'flag': i % 2} for i in range(50)]
+        batch_tmpl = 'SELECT {id}{flag:if: AND flag}'
+        with ParallelQueryFormatter(SqlEscaper(), max_workers=2, chunksize=7, parallel_threshold=10) as qf:
+            for _ in range(2):
+                self.assertEqual(qf.format(tmpl, rows=rows, flag=1), QF.format(tmpl, rows=rows, flag=1))
+            self.assertEqual(
+                qf.format('{m:repeat:,:{key}={item}}', m=mapping),
+                QF.format('{m:repeat:,:{key}={item}}', m=mapping)
+            )
+            self.assertEqual(
+                list(qf.format_many(batch_tmpl, iter(kwargs_list))),
+                [QF.format(batch_tmpl, **kwargs) for kwargs in kwargs_list]
+            )
+            # the parameters of the large repeats are collected by the bound escaper
+            self.assertEqual(
+                qf.format_params('V {rows:repeat:,:({item})}', rows=list(range(12))),
+                ('V ' + ','.join(['(%s)'] * 12), list(range(12)))
+            )
+            # the specialized template is sent with its nodes and bound variables instead of its text
+            residual = QF.specialize(batch_tmpl + '{extra:if: AND {extra}}', extra='x')
+            self.assertEqual(
+                list(qf.format_many(residual, kwargs_list[:10])),
+                [QF.format(residual, **kwargs) for kwargs in kwargs_list[:10]]
+            )
+            self.assertEqual(next(qf.format_many(residual, [{'id': 0, 'flag': 1}])), "SELECT 0 AND flag AND x")
+            # errors of the workers are raised as the serial ones
+            with self.assertRaises(ValueError):
+                qf.format('{rows:repeat:,:{item!}}', rows=list(range(20)))
+        # the pool is started again after the shutdown
+        self.assertEqual(
+            list(qf.format_many(batch_tmpl, kwargs_list[:3])),
+            [QF.format(batch_tmpl, **kwargs) for kwargs in kwargs_list[:3]]
+        )
+        qf.shutdown()
+
+        # the plans are dropped above the cache size in the parent and in the workers
+        with ParallelQueryFormatter(SqlEscaper(), cache_size=2, max_workers=2, chunksize=2) as qf:
+            for tmpl in [f'{batch_tmpl} LIMIT {limit}' for limit in range(5)] * 2:
+                expected = [QF.format(tmpl, **kwargs) for kwargs in kwargs_list[:6]]
+                self.assertEqual(list(qf.format_many(tmpl, kwargs_list[:6])), expected)
+            self.assertEqual(len(qf._plans), 2)
+            self.assertEqual([plan_id for plan_id, _ in qf._plans.values()], [8, 9])
+            self.assertEqual(qf.get_plan(qf.compile(batch_tmpl))[2], (8,))
+
+    def test_template_registry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'filters'))
+            for path, text in (
+                ('person.sql', 'SELECT * FROM Person WHERE TRUE{name:if:{filters.name:include}}'),
+                ('filters/name.sql', ' AND "Name" = \'{name}\''),
+                ('readme.txt', '{person:include}')
+            ):
+                with open(os.path.join(directory, path), 'w') as file:
+                    file.write(text)
+
+            registry = TemplateRegistry(directory, mmap_threshold=32)
+            self.assertEqual(list(registry), ['filters.name', 'person'])
+            self.assertEqual(registry.get_includes('person'), frozenset(['filters.name']))
+            qf = QueryFormatter(SqlEscaper(), registry=registry)
+            template = qf.get_template('person')
+            self.assertIs(qf.get_template('person'), template)
+            self.assertEqual(qf.format(template, name="o'k"), 'SELECT * FROM Person WHERE TRUE AND "Name" = \'o\'\'k\'')
+            # the included template is resolved by the name only if the variable is not passed
+            self.assertEqual(qf.format('{person:include}', person='SELECT 1'), 'SELECT 1')
+            self.assertEqual(qf.format('{person:include}'), 'SELECT * FROM Person WHERE TRUE')
+            self.assertRaises(ValueError, qf.get_template, 'unknown')
+            self.assertRaises(ValueError, QF.get_template, 'person')
+
+            # the changed file is reloaded when it is checked again
+            path = os.path.join(directory, 'filters', 'name.sql')
+            with open(path, 'w') as file:
+                file.write(' AND "Name" LIKE \'{name}%\'')
+            os.utime(path, ns=(0, 0))
+            with mock.patch('os.stat', side_effect=AssertionError):
+                self.assertEqual(qf.format(template, name='a'), 'SELECT * FROM Person WHERE TRUE AND "Name" = \'a\'')
+            registry.check_interval = 0
+            self.assertEqual(qf.format(template, name='a'), 'SELECT * FROM Person WHERE TRUE AND "Name" LIKE \'a%\'')
+            # the file added after the loading is found by the name
+            with open(os.path.join(directory, 'filters', 'kind.sql'), 'w') as file:
+                file.write(' AND "Kind" = {kind}')
+            self.assertEqual(qf.format('{filters.kind:include}', kind=1), ' AND "Kind" = 1')
+            self.assertEqual(list(registry), ['filters.kind', 'filters.name', 'person'])
+
+            # cycles are rejected when the templates are loaded
+            with open(path, 'w') as file:
+                file.write('{x:if:{person:include}}')
+            os.utime(path, ns=(1, 1))
+            with self.assertRaisesRegex(ValueError, 'Cycle of included templates'):
+                registry.get('filters.name')
+            with self.assertRaisesRegex(ValueError, 'Cycle'):
+                TemplateRegistry(directory)
+
+    def test_specialize(self):
+        tmpl = (
+            'SELECT * FROM {schema:idf}.Contractor WHERE "Id" = {id}{flag:if: AND "Kind" = {kind}{strict:!if: OR TRUE}}'
+            '{mode:eq:full: AND "Full"{id:gt:3: AND "Big"}}{sub:include}{rows:repeat:, :({item}, {id})}'
+        )
+        static_kwargs = {'schema': 'public', 'flag': 1, 'strict': True, 'mode': 'short', 'kind': 'person'}
+        residual = QF.specialize(tmpl, **static_kwargs)
+        # the static fields are evaluated and the dead branches are dropped
+        self.assertEqual(residual.nodes[0], 'SELECT * FROM "public".Contractor WHERE "Id" = ')
+        self.assertEqual([node for node in residual.nodes if node.__class__ is str][1], " AND \"Kind\" = person")
+        for dynamic_kwargs in (
+            {'id': 1},
+            {'id': 5, 'sub': ' AND {kind:eq:person:"Person"}', 'rows': [1, 2]},
+            {'id': 'x', 'kind': 'ignored'},
+        ):
+            self.assertEqual(
+                QF.format(residual, **dynamic_kwargs),
+                QF.format(tmpl, **dict(dynamic_kwargs, **static_kwargs))
+            )
+        # callables are called while rendering
+        calls = []
+        residual = QF.specialize('{a} {fn}', a=1, fn=lambda: calls.append(1) or len(calls))
+        self.assertEqual([QF.format(residual), QF.format(residual)], ['1 1', '1 2'])
+        # the nested templates exceed the depth as before
+        deep_tmpl = '{a:if:' * 11 + 'deep' + '}' * 11
+        residual = QF.specialize(deep_tmpl, a=True)
+        self.assertRaises(ValueError, QF.format, deep_tmpl, a=True)
+        self.assertRaises(ValueError, QF.format, residual)
+
+    def test_result_cache(self):
+        result_cache = ResultCache(maxsize=2)
+        qf = QueryFormatter(SqlEscaper(), result_cache=result_cache)
+        tmpl = 'SELECT * FROM Contractor WHERE "Id" = {id}{flag:if: AND {names:exists:a: "Name" IN ({names})}}'
+        ans = QF.format(tmpl, id=1, flag=True, names=['a'])
+        self.assertEqual(qf.format(tmpl, id=1, flag=True, names=['a'], other=1), ans)
+        # unrelated variables don't affect the key
+        self.assertEqual(qf.format(tmpl, id=1, flag=True, names=['a'], other=2), ans)
+        self.assertEqual(result_cache.info(), (1, 1, 0, 2, 1))
+        # values are compared with their types
+        for kwargs in ({'id': True}, {'id': '1'}, {'id': 1, 'names': ('a',)}, {'id': 1, 'names': ['a', 'b']}):
+            kwargs = dict({'flag': True, 'names': ['a']}, **kwargs)
+            self.assertEqual(qf.format(tmpl, **kwargs), QF.format(tmpl, **kwargs))
+        self.assertEqual(result_cache.info(), (1, 5, 0, 2, 2))
+        # equal times of different UTC offsets are sqlized differently
+        plus_one = timezone(timedelta(hours=1))
+        for value in (
+            time(12, tzinfo=timezone.utc), time(13, tzinfo=plus_one),
+            datetime(2020, 1, 1, 12, tzinfo=timezone.utc), datetime(2020, 1, 1, 13, tzinfo=plus_one)
+        ):
+            self.assertEqual(qf.format('{value}', value=value), QF.format('{value}', value=value))
+        # callables and other objects bypass the cache
+        calls = []
+        for _ in range(2):
+            qf.format(tmpl, id=lambda: calls.append(1) or len(calls))
+            self.assertRaises(ValueError, qf.format, tmpl, id=object())
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(result_cache.bypasses, 4)
+        # parameters are collected by every call
+        self.assertEqual(qf.format_params(tmpl, id=3), QF.format_params(tmpl, id=3))
+        self.assertEqual(qf.format_params(tmpl, id=3), ('SELECT * FROM Contractor WHERE "Id" = %s', [3]))
+        # expired texts are formatted again
+        result_cache = ResultCache(ttl=0)
+        qf = QueryFormatter(SqlEscaper(), result_cache=result_cache)
+        qf.format(tmpl, id=1)
+        qf.format(tmpl, id=1)
+        self.assertEqual(result_cache.info().hits, 0)
+        result_cache.clear()
+        self.assertEqual(result_cache.info(), (0, 0, 0, 1024, 0))
+
+    def test_render_stats(self):
+        qf = QueryFormatter(SqlEscaper())
+        closed = []
+        qf.add_span_hook(closed.append)
+        tmpl = 'SELECT * FROM Contractor WHERE "Id" IN ({ids}){flag:if: AND {name:include}}'
+        kwargs = {'ids': [1, 2, 3], 'flag': True, 'name': ['"Name" = \'{value}\'', {'value': 'x'}]}
+        # the rendering without spans is not instrumented
+        self.assertIsNone(qf.get_span_stats())
+        ans = qf.format(tmpl, **kwargs)
+        with qf.span('outer') as outer:
+            with qf.span('inner') as inner:
+                self.assertIs(qf.get_span_stats(), inner)
+                self.assertEqual(qf.format(tmpl, **kwargs), ans)
+            self.assertEqual(''.join(qf.iter_format(tmpl, **kwargs)), ans)
+        self.assertEqual(closed, [inner, outer])
+        self.assertEqual((inner.formats, inner.output_chars, inner.escaped_values), (1, len(ans), 4))
+        self.assertEqual((inner.renders, inner.max_depth), (3, 1))
+        self.assertEqual(
+            {key: count for key, (count, _) in inner.directives.items()}, {'default': 2, 'if': 1, 'include': 1}
+        )
+        self.assertEqual({key: count for key, (count, _) in inner.fields.items()}, {'ids': 1, 'flag': 1, 'name': 1, 'value': 1})
+        self.assertEqual((outer.formats, outer.output_chars, outer.renders), (2, 2 * len(ans), 6))
+        self.assertEqual(outer.as_dict()['fields']['ids'][0], 2)
+        self.assertIsNotNone(outer.elapsed)
+        self.assertIsNone(qf.get_span_stats())
+        # spans are not pickled
+        self.assertEqual(pickle.loads(pickle.dumps(qf)).format(tmpl, **kwargs), ans)
+
+    def test_minify(self):
+        qf = QueryFormatter(SqlEscaper(), minify=True)
+        tmpl = """
+            -- contractors
+            SELECT *   /* all /* nested */ columns */
+            FROM Contractor
+            WHERE "Short  Name" = 'a  -- b' AND "Note" = $$  /* c */  $$
+            {flag:if:
+                AND "Name" = '{name}'   -- by name
+            }
+            {ids:if:
+                AND "Id" IN ({ids})
+            }
+            ORDER BY "Id" -- {name}
+            LIMIT 10
+        """
+        head = ' SELECT * FROM Contractor WHERE "Short  Name" = \'a  -- b\' AND "Note" = $$  /* c */  $$ '
+        tail = 'ORDER BY "Id" -- x  y\n LIMIT 10 '
+        self.assertEqual(
+            qf.format(tmpl, flag=True, ids=[1, 2], name='x  y'),
+            head + 'AND "Name" = \'x  y\' AND "Id" IN (1, 2) ' + tail
+        )
+        self.assertEqual(qf.format(tmpl, flag=False, ids=[], name='x  y'), head + tail)
+        self.assertEqual(qf.format(tmpl, flag=True, ids=[], name='x  y'), head + 'AND "Name" = \'x  y\' ' + tail)
+        # the whitespace and comments of the quoted field and its condition are kept
+        self.assertEqual(qf.format("SELECT '  {a}  /* {a:if:x  y} */ '", a=1), "SELECT '  1  /* x  y */ '")
+        self.assertEqual(qf.format("SELECT E'\\'  {a}  '", a=1), "SELECT E'\\'  1  '")
+        # the quote start after the field depends on the value, the template is not minified
+        self.assertEqual(qf.format('SELECT {a}$$  $$', a=1), 'SELECT 1$$  $$')
+        # the condition keeps the whitespace before it for the text after it, the nested conditions too
+        self.assertEqual(qf.format('SELECT a {a:if: } b', a=0), 'SELECT a b')
+        self.assertEqual(qf.format('SELECT a {a:if: } b', a=1), 'SELECT a b')
+        self.assertEqual(qf.format('{v}{f:if:{f:if:{v}   b   }} ', v='x', f=True), 'xx b ')
+        self.assertEqual(qf.format('a {f:if:{g:if: b } c }', f=True, g=False), 'a c ')
+        for x in (False, True):
+            for y in (False, True):
+                text = ' '.join(['a'] + ['b'] * x + ['c'] * y + ['d'])
+                self.assertEqual(qf.format('a {x:if:b} {y:if:c}  d', x=x, y=y), text)
+        # the line break after the field closes the line comment of its value
+        self.assertEqual(
+            qf.format('SELECT {cols:tmpl}\n  FROM t  -- all\n  WHERE x = 1', cols='a -- the a column'),
+            'SELECT a -- the a column\nFROM t WHERE x = 1'
+        )
+        self.assertEqual(
+            qf.format('SELECT {a}  -- the a\n  {b:if:, b}\nFROM t', a='a -- a', b=False), 'SELECT a -- a\nFROM t'
+        )
+
+    def test_memoized_callables(self):
+        calls = []
+
+        def fetch(name):
+            return lambda: calls.append(name) or len(calls)
+
+        tmpl = 'SELECT {a}, {a}{a:gt:0: AND "Id" = {a}}{flag:if: AND {b}} {rows:repeat:, :({item}, {a})}'
+        kwargs = {'a': fetch('a'), 'b': fetch('b'), 'flag': False, 'rows': [1, 2]}
+        self.assertEqual(QF.format(tmpl, **kwargs), 'SELECT 1, 1 AND "Id" = 1 (1, 1), (2, 1)')
+        self.assertEqual(calls, ['a'])
+        # every rendering calls the callable again
+        self.assertEqual(''.join(QF.iter_format(tmpl, **kwargs)), 'SELECT 2, 2 AND "Id" = 2 (1, 2), (2, 2)')
+        self.assertEqual(calls, ['a', 'a'])
+
+    def test_format_async(self):
+        calls = []
+
+        async def fetch(name, value):
+            calls.append(name)
+            await asyncio.sleep(0.05)
+            return value
+
+        def never():
+            calls.append('never')
+
+        tmpl = 'SELECT {flag:if:{ids:exists:1: AND "Id" IN ({ids})}}{off:if: AND {never}} LIMIT {limit}'
+        ans = asyncio.run(QF.format_async(
+            tmpl, flag=lambda: fetch('flag', True), ids=lambda: fetch('ids', ['1', '2']), off=fetch('off', False),
+            never=never, limit=lambda: 10
+        ))
+        self.assertEqual(ans, 'SELECT  AND "Id" IN (1, 2) LIMIT 10')
+        # the values of the taken branches are resolved by the rounds
+        self.assertEqual(calls, ['flag', 'off', 'ids'])
+
+    def test_recursion_depth(self):
+        tmpl = 'SELECT 1' + '{flag:if:' * 12 + ' AND "Id" = {id}' + '}' * 12
+        with self.assertRaises(ValueError) as error:
+            QF.format(tmpl, flag=True, id=1)
+        self.assertEqual(str(error.exception), 'Max string recursion exceeded')
+        qf = QueryFormatter(SqlEscaper(), recursion_depth=12)
+        self.assertEqual(qf.format(tmpl, flag=True, id=1), 'SELECT 1 AND "Id" = 1')
+        self.assertEqual(''.join(qf.iter_format(tmpl, flag=True, id=1)), 'SELECT 1 AND "Id" = 1')
+        # included templates are evaluated without the recursion of the calls
+        kwargs = {f'sub{i}': f'({{sub{i + 1}:include}})' for i in range(500)}
+        self.assertEqual(QF.format('{sub0:include}', **kwargs), '(' * 500 + ')' * 500)
+        with self.assertRaises(ValueError) as error:
+            QF.format('{sub:include}', sub='{sub:include}')
+        self.assertIn('Error during processing variable "sub"', str(error.exception))
+        # the errors of the included and repeated templates are wrapped by their fields
+        with self.assertRaises(ValueError) as error:
+            QF.format('{sub:include}', sub='{rows:repeat:, :{item}}', rows=[1, 1.5])
+        messages = []
+        ex = error.exception
+        while ex is not None:
+            messages.append(str(ex).split(' with value')[0])
+            ex = ex.__cause__
+        self.assertEqual(messages[:3], [
+            'Error during processing variable "sub"', 'Error during processing variable "rows"',
+            'Error during processing variable "item"'
+        ])
+
+    def test_error_context(self):
+        tmpl = 'SELECT *\nFROM table1\nWHERE id IN ({ids}) AND {{ids}}' + ' ' * 100000 + '{ids:if: AND TRUE}'
+        with self.assertRaises(FieldError) as error:
+            QF.format(tmpl, ids=[1.5] * 100000)
+        ex = error.exception
+        self.assertIsInstance(ex, ValueError)
+        self.assertEqual((ex.field_name, ex.template.source), ('ids', tmpl))
+        self.assertEqual(str(ex).split('\n'), [
+            'Error during processing variable "ids" with value "[1.5, 1.5, 1.5, 1.5, 1.5, 1.5, ...]" '
+            'at line 3, column 14 of template:',
+            'WHERE id IN ({ids}) AND {{ids}}' + ' ' * 49 + '...',
+            ' ' * 13 + '^^^^^'
+        ])
+        # the value of the error of the worker process is replaced with its text
+        self.assertEqual(str(pickle.loads(pickle.dumps(ex))), str(ex))
+        with self.assertRaises(FieldError) as error:
+            QF.format('{sub:include}', sub='SELECT {item}, {item}', item=object())
+        self.assertTrue(str(error.exception.__cause__).endswith(
+            'at line 1, column 8 of template:\nSELECT {item}, {item}\n       ^^^^^^'
+        ))
+
+    def test_copy_format(self):
+        rows = [
+            (1, True, None, 'tab\tslash\\new\nline\rend', date(2020, 1, 2)),
+            (2, False, uuid.UUID(int=1), 'x\\N', datetime(2020, 1, 1, 12, 30, 0, 5))
+        ]
+        texts = [
+            ('1', 't', None, 'tab\tslash\\new\nline\rend', '2020-01-02'),
+            ('2', 'f', '00000000-0000-0000-0000-000000000001', 'x\\N', '2020-01-01 12:30:00.000005')
+        ]
+        self.assertEqual(
+            CopyEncoder.encode_row(rows[0]), '1\tt\t\\N\ttab\\tslash\\\\new\\nline\\rend\t2020-01-02\n'
+        )
+        self.assertEqual(list(decode_copy(CopyEncoder.iter_encode(rows))), texts)
+        # the stream is read by small parts and the lines split between the chunks are decoded
+        stream = CopyEncoder.open(rows * 1000)
+        parts = iter(lambda: stream.read(7), '')
+        self.assertEqual(list(decode_copy(parts)), texts * 1000)
+        self.assertEqual(list(decode_copy(CopyEncoder.open(rows))), texts)
+        self.assertEqual(list(decode_copy(['1\t\\x41\\101\\q\n\\.\n2\n'])), [('1', 'AAq')])
+        for bad_rows in ([(1.5,)], [(1, 2), (3,)], [('\x00',)]):
+            with self.assertRaises(ValueError):
+                list(CopyEncoder.iter_encode(bad_rows))
+        self.assertEqual(
+            QF.format('{columns:copy:public.person}; {none:copy:person}', columns=['id', 'name'], none=None),
+            'COPY public.person ("id", "name") FROM STDIN; COPY person FROM STDIN'
+        )
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_arrays(self):
+        arrays = (
+            numpy.arange(-5, 5), numpy.arange(10, dtype=numpy.uint8), numpy.array([True, False]),
+            numpy.array(["o'k", 'x']), numpy.array([1, 'a', None], dtype=object), numpy.array([[1, 2], [3, 4]]),
+            numpy.array(['2020-01-01', '1969-12-31'], dtype='datetime64[D]'),
+            numpy.array(['2020-01-01T12:30:00', '1969-12-31T23:59:59.5'], dtype='datetime64[ms]'),
+            numpy.array(['2020-01-01T12:30:00', 'NaT'], dtype='datetime64[s]'), numpy.array([], dtype=numpy.int64)
+        )
+        # the arrays are sqlized as the lists of their items
+        for value in arrays:
+            self.assertEqual(SqlEscaper.escape_literal(value), SqlEscaper.escape_literal(value.tolist()))
+        self.assertEqual(
+            QF.format('SELECT * FROM t WHERE id IN ({ids}) AND d = {d}', ids=numpy.arange(3), d=arrays[7][:1]),
+            "SELECT * FROM t WHERE id IN (0, 1, 2) AND d = '2020-01-01 12:30:00'::timestamp"
+        )
+        with self.assertRaises(ValueError):
+            SqlEscaper.escape_literal(numpy.array([1.5]))
+        # the datetimes of nanoseconds are sqlized as timestamps, not as integers
+        value = numpy.array(['2020-01-01T12:30:00.000001', 'NaT'], dtype='datetime64[ns]')
+        self.assertEqual(SqlEscaper.escape_literal(value), "'2020-01-01 12:30:00.000001'::timestamp, NULL")
+        self.assertEqual(SqlEscaper.escape_literal(value[:1]), "'2020-01-01 12:30:00.000001'::timestamp")
+        for value in (
+            numpy.array(['2020-01-01T12:30:00.000000001'], dtype='datetime64[ns]'),
+            numpy.array([1], dtype='timedelta64[ns]'), numpy.array([1], dtype='timedelta64[M]')
+        ):
+            with self.assertRaises(ValueError):
+                SqlEscaper.escape_literal(value)
+
+    def test_format_fingerprint(self):
+        tmpl = 'SELECT * FROM t WHERE id = {id}{name:if: AND name = {name}} AND kind IN ({kinds:repeat:, :{item}})'
+
+        def fingerprint(**kwargs):
+            text, res = QF.format_fingerprint(tmpl, **kwargs)
+            self.assertEqual(text, QF.format(tmpl, **kwargs))
+            self.assertEqual(len(res), 16)
+            return res
+
+        shape = fingerprint(id=1, name='x', kinds=[1, 2])
+        # the literal values don't change the shape, the branches and the numbers of the items do
+        self.assertEqual(fingerprint(id=2, name='y', kinds=[3, 4]), shape)
+        self.assertNotEqual(fingerprint(id=1, name='', kinds=[1, 2]), shape)
+        self.assertNotEqual(fingerprint(id=1, name='x', kinds=[1, 2, 3]), shape)
+        self.assertNotEqual(QF.format_fingerprint(tmpl + ' ', id=1, name='x', kinds=[1, 2])[1], shape)
+        sub = '{sub:include}'
+        self.assertNotEqual(QF.format_fingerprint(sub, sub='{a}')[1], QF.format_fingerprint(sub, sub='{b}', b=1)[1])
+        self.assertEqual(QF.format_fingerprint(sub, sub='{a}', a=1)[1], QF.format_fingerprint(sub, sub='{a}', a=2)[1])
+
+    def test_template_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'filters'))
+            for path, text in (
+                ('person.sql', 'SELECT * FROM Person WHERE TRUE{name:if:{filters.name:include}}'),
+                ('filters/name.sql', ' AND "Name" = \'{name}\''),
+                ('broken.sql', '{name')
+            ):
+                with open(os.path.join(directory, path), 'w') as file:
+                    file.write(text)
+            cache_path = os.path.join(directory, 'templates.cache')
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                self.assertEqual(tools_main(['precompile', directory, cache_path]), 0)
+            self.assertEqual(output.getvalue(), f'2 templates of 3 are compiled to {cache_path}\n')
+
+            def load(**kwargs):
+                qf = QueryFormatter(SqlEscaper(), registry=TemplateRegistry(directory), **kwargs)
+                info = load_templates(qf, cache_path)
+                return qf, info
+
+            qf, info = load()
+            self.assertEqual(info, (2, 0, False))
+            self.assertEqual(
+                qf.format(qf.get_template('person'), name='a'), 'SELECT * FROM Person WHERE TRUE AND "Name" = \'a\''
+            )
+            # the changed template is compiled and the cache file is written again
+            with open(os.path.join(directory, 'filters', 'name.sql'), 'w') as file:
+                file.write(' AND "Name" LIKE \'{name}%\'')
+            qf, info = load()
+            self.assertEqual(info, (1, 1, True))
+            self.assertEqual(
+                qf.format(qf.get_template('person'), name='a'), 'SELECT * FROM Person WHERE TRUE AND "Name" LIKE \'a%\''
+            )
+            self.assertEqual(load()[1], (2, 0, False))
+            # the templates of the other configuration of the formatter are compiled again
+            self.assertEqual(load(minify=True)[1], (0, 2, True))
+            with open(cache_path, 'wb') as file:
+                file.write(b'corrupted')
+            self.assertEqual(load()[1], (0, 2, True))
+            registry = TemplateRegistry(directory)
+            self.assertEqual(precompile_templates(QueryFormatter(SqlEscaper()), cache_path, registry), 2)
+
+            # the unchanged cached templates are not read and parsed, the malformed one only is
+            registry = TemplateRegistry(directory, autoload=False)
+            qf = QueryFormatter(SqlEscaper(), registry=registry)
+            read = mock.Mock(wraps=registry.read)
+            parse = mock.Mock(wraps=qf.parse_template)
+            with mock.patch.object(registry, 'read', read), mock.patch.object(qf, 'parse_template', parse), \
+                    mock.patch.object(TemplateRegistry, 'find_includes', side_effect=AssertionError):
+                self.assertEqual(load_templates(qf, cache_path), (2, 0, False))
+            self.assertEqual([os.path.basename(call.args[0]) for call in read.call_args_list], ['broken.sql'])
+            self.assertEqual(parse.call_args_list, [mock.call('{name')])
+            self.assertEqual(registry.get_includes('person'), frozenset(['filters.name']))
+            self.assertEqual(
+                qf.format(qf.get_template('person'), name='a'), 'SELECT * FROM Person WHERE TRUE AND "Name" LIKE \'a%\''
+            )
+
+    def test_render_session(self):
+        tmpl = (
+            'SELECT * FROM t WHERE kind IN ({kinds:repeat:, :{item}}){name:if: AND name = {name}}'
+            '{sub:include} LIMIT {limit}'
+        )
+        kwargs = dict(kinds=[1, 2], name='x', sub=[' AND {a} = {limit}', {'a': 'b'}], limit=10)
+        session = QF.render_session(tmpl, **kwargs)
+        self.assertEqual(session.text, QF.format(tmpl, **kwargs))
+        self.assertEqual(session.rendered, 4)
+
+        def update(rendered, **changed):
+            kwargs.update(changed)
+            self.assertEqual(session.update(**changed), QF.format(tmpl, **kwargs))
+            self.assertEqual(session.rendered, rendered)
+
+        # the repeat and the include are not rendered again
+        update(1, name='y')
+        # the include reads the variable too
+        update(2, limit=20)
+        update(0, limit=20, name='y')
+        update(1, name='')
+        # the list changed in place is rendered again
+        kwargs['kinds'].append(3)
+        update(1, kinds=kwargs['kinds'])
+        # the failed rendering keeps the state
+        with self.assertRaises(ValueError):
+            session.update(kinds=1.5)
+        self.assertEqual(session.update(), QF.format(tmpl, **kwargs))
+        # the equal instant of the other UTC offset is rendered again
+        session = QF.render_session('SELECT {at}', at=datetime(2020, 1, 1, 12, tzinfo=timezone.utc))
+        at = datetime(2020, 1, 1, 13, tzinfo=timezone(timedelta(hours=1)))
+        self.assertEqual(session.update(at=at), QF.format('SELECT {at}', at=at))
+        self.assertEqual(session.rendered, 1)
+        # the numbering of the positional fields is continued by the segments
+        session = QF.render_session('{f:if:{}}, {}', 'a', 'b', f=True)
+        self.assertEqual(session.text, 'a, b')
+        self.assertEqual(session.update(f=False), ', a')
+
+    def test_benchmarks(self):
+        from .benchmarks import CASES, run_benchmarks, save_results, load_results, compare_results
+
+        names = {case.name for case in CASES}
+        for directive in ('if', 'in', 'eq', 'gt', 'lt', 'exists', 'repeat', 'include', 'tmpl', 'idf'):
+            self.assertIn(f'directive.{directive}', names)
+        self.assertIn('depth.10', names)
+        self.assertIn('in_list.int.1M', names)
+
+        results = run_benchmarks(CASES, 'cast_to_type.int', quick=True)
+        self.assertEqual(list(results['results']), ['cast_to_type.int'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            save_results(results, path)
+            baseline = load_results(path)
+        self.assertEqual(baseline, results)
+        self.assertFalse(any(comparison.regression for comparison in compare_results(results, baseline)))
+        # the metric grown above the threshold is the regression
+        baseline['results']['cast_to_type.int']['time_us'] = results['results']['cast_to_type.int']['time_us'] / 2
+        self.assertEqual(
+            [(comparison.metric, comparison.regression) for comparison in compare_results(results, baseline)],
+            [('time_us', True), ('peak_kb', False)]
+        )